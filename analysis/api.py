@@ -0,0 +1,396 @@
+'''
+The JSON API used by dashboards. Every GET response carries an ETag and a
+Last-Modified date derived from the latest ingested day of foot traffic, and
+is checked against the request's conditional headers before anything is
+loaded, so polling clients get 304 Not Modified instead of a recomputation.
+'''
+import datetime
+from functools import wraps
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition, require_http_methods
+import numpy as np
+import orjson
+
+from .forms import UserQueryForm
+from .jobs import IN_FLIGHT, submit_job
+from .models import AnalysisJob, CenterReport, IngestWatermark, ShoppingCenter
+from .utils import anomalies, instrumentation
+from .utils.analysis import iso_to_gregorian
+from .utils.columnar import load_series
+from .utils.data_version import get_data_version
+from .utils.enums import LLMChoice
+from .utils.metrics import TrafficSeries
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+class ApiError(Exception):
+  '''
+  Raised by an API view when the request cannot be answered. The error, a
+  message or a dictionary of the invalid fields' errors, is returned to the
+  client.
+  '''
+
+  def __init__(self, error: str | dict, status: int = 400):
+    super().__init__(error)
+    self.error = error
+    self.status = status
+
+
+class OrjsonResponse(HttpResponse):
+  '''
+  A JSON response serialized with orjson, which handles dates and NumPy
+  values natively and writes NaN as null.
+  '''
+
+  def __init__(self, data, status: int = 200):
+    super().__init__(
+        orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+        status=status, content_type='application/json')
+
+
+def api_view(methods: list):
+  '''
+  Wrap an API view: restrict its methods, gzip its response, turn ApiErrors
+  into JSON errors and add the Server-Timing header. GET responses may be
+  cached by clients, but must be revalidated each time they are used.
+  '''
+  def decorator(view):
+    @csrf_exempt
+    @require_http_methods(methods)
+    @gzip_page
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+      with instrumentation.trace() as request_trace:
+        try:
+          response = view(request, *args, **kwargs)
+        except ApiError as e:
+          response = OrjsonResponse({'error': e.error}, status=e.status)
+      response['Server-Timing'] = request_trace.server_timing()
+      if request.method in ('GET', 'HEAD'):
+        patch_cache_control(response, private=True, no_cache=True)
+      return response
+    return wrapper
+  return decorator
+
+
+def paginate(request, items) -> tuple:
+  '''
+  Get the page of items a request asks for with its ``page`` and
+  ``page_size`` parameters.
+
+  :param request: The request
+  :param items: A queryset or list of items
+  :return: A tuple of the page's items and a dictionary describing the page
+  :raises ApiError: If the page does not exist
+  '''
+  try:
+    page_size = int(request.GET.get('page_size', settings.API_PAGE_SIZE))
+  except ValueError:
+    raise ApiError("page_size must be a number.")
+  page_size = min(max(page_size, 1), settings.API_MAX_PAGE_SIZE)
+
+  paginator = Paginator(items, page_size)
+  try:
+    page = paginator.page(request.GET.get('page', 1))
+  except PageNotAnInteger:
+    raise ApiError("page must be a number.")
+  except EmptyPage:
+    raise ApiError(f"There is no page {request.GET.get('page')}.", status=404)
+  return page.object_list, {
+      'page': page.number,
+      'page_size': page_size,
+      'pages': paginator.num_pages,
+      'count': paginator.count,
+  }
+
+
+def _etag(*parts) -> str:
+  return hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()[:32]
+
+
+def _last_modified(day: datetime.date | None) -> datetime.datetime | None:
+  if day is None:
+    return None
+  return datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+def _latest_day(request) -> datetime.date | None:
+  # The latest day ingested for any center, looked up once per request
+  if not hasattr(request, '_api_latest_day'):
+    request._api_latest_day = IngestWatermark.objects.aggregate(
+        latest=Max('last_day'))['latest']
+  return request._api_latest_day
+
+
+def _center_latest_day(request, center_id: str) -> datetime.date | None:
+  if not hasattr(request, '_api_center_latest_day'):
+    request._api_center_latest_day = IngestWatermark.objects.filter(
+        shopping_center_id=center_id).values_list('last_day', flat=True).first()
+  return request._api_center_latest_day
+
+
+def _centers_etag(request) -> str | None:
+  latest = _latest_day(request)
+  # The data version also changes when loading rewrites days before the
+  # latest one
+  return _etag('centers', latest, get_data_version()) if latest else None
+
+
+@api_view(['GET', 'HEAD'])
+@condition(etag_func=_centers_etag,
+           last_modified_func=lambda request: _last_modified(_latest_day(request)))
+def centers_view(request) -> HttpResponse:
+  '''
+  The shopping centers, optionally filtered by ``state`` and ``city``, with
+  the latest day of foot traffic loaded for each.
+  '''
+  centers = ShoppingCenter.objects.order_by('pk')
+  if state := request.GET.get('state'):
+    centers = centers.filter(state=state.upper())
+  if city := request.GET.get('city'):
+    centers = centers.filter(city__iexact=city)
+
+  with instrumentation.stage('db_fetch'):
+    page, pagination = paginate(request, centers.values(
+        'shopping_center_id', 'name', 'city', 'state', 'formatted_address',
+        'lat', 'lon'))
+    page = list(page)
+    latest_days = dict(IngestWatermark.objects.filter(
+        shopping_center_id__in=[center['shopping_center_id'] for center in page]
+    ).values_list('shopping_center_id', 'last_day'))
+
+  return OrjsonResponse({
+      'results': [{**center, 'latest_day': latest_days.get(center['shopping_center_id'])}
+                  for center in page],
+      **pagination,
+  })
+
+
+def _series_etag(request, center_id: str) -> str | None:
+  latest = _center_latest_day(request, center_id)
+  return _etag('series', center_id, latest, get_data_version()) if latest else None
+
+
+def _parse_date(request, name: str) -> datetime.date | None:
+  value = request.GET.get(name)
+  if not value:
+    return None
+  try:
+    return datetime.date.fromisoformat(value)
+  except ValueError:
+    raise ApiError(f"{name} must be a date like 2024-01-31.")
+
+
+@api_view(['GET', 'HEAD'])
+@condition(
+    etag_func=_series_etag,
+    last_modified_func=lambda request, center_id: _last_modified(
+        _center_latest_day(request, center_id)))
+def center_series_view(request, center_id: str) -> HttpResponse:
+  '''
+  A shopping center's foot traffic between the ``from`` and ``to`` days, by
+  ``day`` (the default), ``week`` or ``month``, with its mean, median,
+  standard deviation and anomalous days over that range.
+  '''
+  start, end = _parse_date(request, 'from'), _parse_date(request, 'to')
+  granularity = request.GET.get('granularity', 'day')
+  if granularity not in GRANULARITIES:
+    raise ApiError(f"granularity must be one of {', '.join(GRANULARITIES)}.")
+
+  with instrumentation.stage('db_fetch'):
+    center = ShoppingCenter.objects.filter(pk=center_id).values(
+        'shopping_center_id', 'name', 'city', 'state').first()
+    if center is None:
+      raise ApiError(f"There is no shopping center {center_id}.", status=404)
+    series = load_series(center_id, center['state'], start, end)
+
+  with instrumentation.stage('metrics'):
+    return OrjsonResponse({
+        'center': center,
+        'granularity': granularity,
+        'points': _points(series, granularity),
+        'metrics': _series_metrics(series),
+    })
+
+
+def _points(series: TrafficSeries, granularity: str) -> list:
+  if not len(series):
+    return []
+  if granularity == 'month':
+    averages = series.monthly_averages()
+    return [{'date': month.date().replace(day=1), 'ft': value}
+            for month, value in zip(averages.index, averages.to_numpy())]
+  if granularity == 'week':
+    return [{'date': iso_to_gregorian(week['year'], week['week']), 'ft': week['avg_ft']}
+            for week in series.weekly_averages()]
+  return [{'date': day, 'ft': ft}
+          for day, ft in zip(series.days.tolist(), series.ft.tolist())]
+
+
+def _series_metrics(series: TrafficSeries) -> dict | None:
+  if not len(series) or np.all(np.isnan(series.ft)):
+    return None
+  days, ft, weekday = anomalies.calendar(series.days, series.ft)
+  scores = anomalies.score(ft, settings.ANOMALY_METHOD, settings.ANOMALY_WINDOW, weekday)
+  return {
+      'days': len(series),
+      'first_day': series.earliest_date,
+      'last_day': series.latest_date,
+      'mean': series.mean,
+      'median': series.median,
+      'stddev': series.stddev,
+      'anomalies': [
+          {'date': anomaly.label.item(), 'ft': anomaly.value,
+           'expected': anomaly.expected, 'score': anomaly.score}
+          for anomaly in anomalies.find_anomalies(
+              days, ft, scores, settings.ANOMALY_THRESHOLD,
+              settings.ANOMALY_MAX_REPORTED)
+      ],
+  }
+
+
+def _reports(request):
+  reports = CenterReport.objects.order_by('center_id', 'llm_choice')
+  if center_id := request.GET.get('center'):
+    reports = reports.filter(center_id=center_id)
+  if llm_choice := request.GET.get('llm_choice'):
+    reports = reports.filter(llm_choice=llm_choice)
+  return reports
+
+
+def _reports_state(request) -> dict:
+  # When the listed reports were last generated, and how many there are, so
+  # deleting one changes the ETag too
+  if not hasattr(request, '_api_reports_state'):
+    request._api_reports_state = _reports(request).aggregate(
+        latest=Max('generated_at'), count=Count('pk'))
+  return request._api_reports_state
+
+
+def _reports_generated_at(request) -> datetime.datetime | None:
+  if request.method not in ('GET', 'HEAD'):
+    return None
+  return _reports_state(request)['latest']
+
+
+def _analyses_etag(request) -> str | None:
+  if request.method not in ('GET', 'HEAD'):
+    return None
+  state = _reports_state(request)
+  return _etag('analyses', request.GET.urlencode(), state['latest'], state['count'])
+
+
+@api_view(['GET', 'HEAD', 'POST'])
+@condition(etag_func=_analyses_etag, last_modified_func=_reports_generated_at)
+def analyses_view(request) -> HttpResponse:
+  '''
+  GET lists the reports pre-generated by the analyze_centers command,
+  optionally filtered by ``center`` and ``llm_choice``. POST queues an
+  analysis of a ``query`` with an ``llm_choice``, given as JSON or form data,
+  like the jobs endpoint, rather than hold the request while it runs.
+  '''
+  if request.method == 'POST':
+    return _queue_analysis(request)
+
+  with instrumentation.stage('db_fetch'):
+    page, pagination = paginate(request, _reports(request).values(
+        'center_id', 'center__name', 'center__city', 'center__state',
+        'llm_choice', 'response', 'fingerprint', 'generated_at'))
+    page = list(page)
+
+  return OrjsonResponse({
+      'results': [{
+          'center': {
+              'shopping_center_id': report['center_id'],
+              'name': report['center__name'],
+              'city': report['center__city'],
+              'state': report['center__state'],
+          },
+          'llm_choice': report['llm_choice'],
+          'response': report['response'],
+          'fingerprint': report['fingerprint'],
+          'generated_at': report['generated_at'],
+      } for report in page],
+      **pagination,
+  })
+
+
+def _query_form(request) -> tuple:
+  '''
+  The query and LLMChoice of a request to analyze, given as JSON or form data.
+  '''
+  if request.content_type == 'application/json':
+    try:
+      data = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+      raise ApiError("The request body is not valid JSON.")
+  else:
+    data = request.POST
+  form = UserQueryForm(data)
+  if not form.is_valid():
+    raise ApiError(form.errors.get_json_data())
+  return form.cleaned_data['query'], LLMChoice(form.cleaned_data['llm_choice'])
+
+
+def _queue_analysis(request) -> HttpResponse:
+  query, llm_choice = _query_form(request)
+  job, created = submit_job(query, llm_choice)
+  response = OrjsonResponse(_job(job, request), status=202)
+  response['Location'] = reverse('api_job', args=[job.id])
+  logger.info(f"{'Queued' if created else 'Joined'} analysis job {job.id}")
+  return response
+
+
+@api_view(['POST'])
+def jobs_view(request) -> HttpResponse:
+  '''
+  Queue an analysis of a ``query`` with an ``llm_choice``, given as JSON or
+  form data, and return its job at once. An identical analysis that is
+  already queued or running is returned instead of queuing another.
+  '''
+  return _queue_analysis(request)
+
+
+@api_view(['GET', 'HEAD'])
+def job_view(request, job_id) -> HttpResponse:
+  '''
+  The status of an analysis job, and its result once it is done.
+  '''
+  job = AnalysisJob.objects.filter(pk=job_id).first()
+  if job is None:
+    raise ApiError(f"There is no job {job_id}.", status=404)
+  response = OrjsonResponse(_job(job, request))
+  if job.status in IN_FLIGHT:
+    # When to poll again
+    response['Retry-After'] = str(max(round(settings.ANALYSIS_WORKER_POLL_INTERVAL), 1))
+  return response
+
+
+def _job(job: AnalysisJob, request) -> dict:
+  return {
+      'id': job.id,
+      'url': request.build_absolute_uri(reverse('api_job', args=[job.id])),
+      'status': job.status,
+      'query': job.query,
+      'llm_choice': job.llm_choice,
+      'created_at': job.created_at,
+      'started_at': job.started_at,
+      'finished_at': job.finished_at,
+      'response': job.response,
+      'chart': job.chart,
+      'stage_seconds': job.stage_seconds,
+      'error': job.error,
+  }
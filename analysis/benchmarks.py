@@ -0,0 +1,406 @@
+'''
+Benchmarks of the analysis pipeline, run by the benchmark management command
+against synthetic data and a local stand-in for the language models.
+'''
+from collections import Counter
+import io
+import logging
+import os
+import statistics
+import tempfile
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import override_settings
+import markdown as md
+import numpy as np
+
+from . import pipeline
+from .models import FootTraffic
+from .templatetags.markdown_filter import (
+    MARKDOWN_EXTENSIONS, markdown_format, render_markdown)
+from .utils import anomalies
+from .utils.analysis import calculate_daily_z_scores, calculate_weekly_z_scores
+from .utils.columnar import export_snapshot, load_matrix, load_series
+from .utils.comparison import ComparisonQuery
+from .utils.enums import LLMChoice
+from .utils.fake_llm import FakeChatModel
+from .utils.geo import build_geo_index
+from .utils.metrics import TrafficSeries
+from .utils.resolver import build_center_index
+
+logger = logging.getLogger(__name__)
+
+# Benchmark names to functions, in the order they run. Each function takes the
+# BenchmarkContext and returns a dictionary of results.
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+  '''
+  Register a benchmark function under a name.
+  '''
+  def register(fn):
+    BENCHMARKS[name] = fn
+    return fn
+  return register
+
+
+class BenchmarkContext:
+  '''
+  What the benchmarks share: the synthetic data that was loaded and how to
+  run them.
+  '''
+
+  def __init__(self, csv_file: str, data: dict, repeat: int, sample: int,
+               llm_latency: float):
+    '''
+    :param csv_file: The synthetic CSV file
+    :param data: The dictionary returned by write_synthetic_csv()
+    :param repeat: How many times each timed operation is run
+    :param sample: How many shopping centers the per-center benchmarks use
+    :param llm_latency: Seconds the stand-in language model takes to answer
+    '''
+    self.csv_file = csv_file
+    self.data = data
+    self.repeat = repeat
+    self.llm_latency = llm_latency
+    # Spread the sample over the whole range of generated centers
+    centers = data['centers']
+    step = max(len(centers) // max(sample, 1), 1)
+    self.sample = centers[::step][:sample]
+
+
+def measure(fn, repeat: int, warmup: int = 1) -> dict:
+  '''
+  Time a function over several runs.
+
+  :param fn: The function to time, called without arguments
+  :param repeat: The number of timed runs
+  :param warmup: The number of untimed runs before them
+  :return: A dictionary of the number of runs and the minimum, median, mean,
+           95th percentile and maximum milliseconds per run
+  '''
+  for _ in range(warmup):
+    fn()
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    timings.append((time.perf_counter() - start) * 1000)
+  timings.sort()
+  return {
+      'runs': repeat,
+      'min_ms': round(timings[0], 3),
+      'median_ms': round(statistics.median(timings), 3),
+      'mean_ms': round(statistics.fmean(timings), 3),
+      'p95_ms': round(timings[min(int(len(timings) * 0.95), len(timings) - 1)], 3),
+      'max_ms': round(timings[-1], 3),
+  }
+
+
+def load_data(context: BenchmarkContext) -> dict:
+  '''
+  Load the synthetic CSV into the empty database with load_csv_data. It can
+  only run once, and every other benchmark needs its data, so it is not
+  registered but always run first.
+  '''
+  start = time.perf_counter()
+  call_command('load_csv_data', context.csv_file, stdout=io.StringIO())
+  seconds = time.perf_counter() - start
+  rows = context.data['rows']
+  return {
+      'rows': rows,
+      'seconds': round(seconds, 3),
+      'rows_per_sec': round(rows / seconds),
+  }
+
+
+def _query(center: dict) -> str:
+  return f"How has foot traffic at {center['name']} in {center['city']} changed?"
+
+
+@benchmark('build_center_index')
+def bench_build_center_index(context: BenchmarkContext) -> dict:
+  return measure(build_center_index, context.repeat)
+
+
+@benchmark('resolve_center')
+def bench_resolve_center(context: BenchmarkContext) -> dict:
+  queries = [_query(center) for center in context.sample]
+  failures = 0
+
+  def resolve_all():
+    nonlocal failures
+    failures = 0
+    for query in queries:
+      try:
+        entities = pipeline.fast_extract_entities(query)
+        if entities is None:
+          failures += 1
+          continue
+        pipeline.resolve_center(*entities)
+      except pipeline.AnalysisError:
+        failures += 1
+
+  timings = measure(resolve_all, context.repeat)
+  return {
+      **timings,
+      'queries': len(queries),
+      'ms_per_query': round(timings['median_ms'] / len(queries), 3),
+      'unresolved': failures,
+  }
+
+
+@benchmark('daily_z_scores')
+def bench_daily_z_scores(context: BenchmarkContext) -> dict:
+  querysets = [FootTraffic.objects.filter(center_id=center['id'])
+               for center in context.sample]
+
+  def run():
+    for queryset in querysets:
+      calculate_daily_z_scores(queryset)
+
+  timings = measure(run, context.repeat)
+  return {**timings, 'centers': len(querysets),
+          'ms_per_center': round(timings['median_ms'] / len(querysets), 3)}
+
+
+@benchmark('weekly_z_scores')
+def bench_weekly_z_scores(context: BenchmarkContext) -> dict:
+  weekly = [TrafficSeries.from_queryset(
+                FootTraffic.objects.filter(center_id=center['id'])).weekly_averages()
+            for center in context.sample]
+
+  def run():
+    for weekly_averages in weekly:
+      calculate_weekly_z_scores(weekly_averages)
+
+  timings = measure(run, context.repeat)
+  return {**timings, 'centers': len(weekly),
+          'ms_per_center': round(timings['median_ms'] / len(weekly), 3)}
+
+
+@benchmark('monthly_averages')
+def bench_monthly_averages(context: BenchmarkContext) -> dict:
+  querysets = [FootTraffic.objects.filter(center_id=center['id'])
+               for center in context.sample]
+
+  def run():
+    for queryset in querysets:
+      pipeline.get_monthly_averages(queryset)
+
+  timings = measure(run, context.repeat)
+  return {**timings, 'centers': len(querysets),
+          'ms_per_center': round(timings['median_ms'] / len(querysets), 3)}
+
+
+@benchmark('anomaly_scores')
+def bench_anomaly_scores(context: BenchmarkContext) -> dict:
+  # Every center's days in one matrix, scored at once by each method, and
+  # checked against the anomalies injected into the synthetic data
+  center_ids, days, ft = zip(*FootTraffic.objects.values_list('center_id', 'day', 'ft'))
+  center_ids, rows = np.unique(np.array(center_ids), return_inverse=True)
+  days = np.array(days, dtype='datetime64[D]')
+  all_days = np.arange(days.min(), days.max() + 1)
+  matrix = np.full((len(center_ids), len(all_days)), np.nan)
+  matrix[rows, (days - all_days[0]).astype(np.int64)] = [
+      np.nan if value is None else value for value in ft]
+  weekday = (all_days.astype(np.int64) + 3) % 7
+
+  injected = np.zeros(matrix.shape, dtype=bool)
+  row_of = {center_id: row for row, center_id in enumerate(center_ids)}
+  for center_id, day in context.data['anomalies']:
+    injected[row_of[center_id], (np.datetime64(day) - all_days[0]).astype(np.int64)] = True
+
+  results = {'centers': len(center_ids), 'days': len(all_days)}
+  for method in anomalies.METHODS:
+    timings = measure(
+        lambda: anomalies.score(matrix, method, settings.ANOMALY_WINDOW, weekday),
+        context.repeat)
+    scores = anomalies.score(matrix, method, settings.ANOMALY_WINDOW, weekday)
+    with np.errstate(invalid='ignore'):
+      flagged = np.abs(scores.scores) > settings.ANOMALY_THRESHOLD
+    found = (flagged & injected).sum()
+    results[method] = {
+        **timings,
+        'flagged': int(flagged.sum()),
+        'precision': round(found / max(flagged.sum(), 1), 3),
+        'recall': round(found / max(injected.sum(), 1), 3),
+    }
+  return results
+
+
+@benchmark('compare_state')
+def bench_compare_state(context: BenchmarkContext) -> dict:
+  # Rank every center of the state with the most centers, without the LLM
+  states = Counter(center['state'] for center in context.data['centers'])
+  state, centers = states.most_common(1)[0]
+  comparison = ComparisonQuery(place=state, metric='growth')
+  timings = measure(lambda: pipeline.prepare_comparison(comparison), context.repeat)
+  return {**timings, 'state': state, 'centers': centers}
+
+
+@benchmark('geo_queries')
+def bench_geo_queries(context: BenchmarkContext) -> dict:
+  # Neighbor searches around each sampled center with the in-memory index
+  index = build_geo_index()
+  positions = [index.position(center['id']) for center in context.sample]
+  positions = [position for position in positions if position is not None]
+  found = 0
+
+  def within():
+    nonlocal found
+    found = sum(len(index.within(lat, lon, settings.GEO_DEFAULT_RADIUS_MILES,
+                                 settings.COMPARISON_MAX_CENTERS))
+                for lat, lon in positions)
+
+  def nearest():
+    for lat, lon in positions:
+      index.nearest(lat, lon, settings.COMPARISON_DEFAULT_LIMIT + 1)
+
+  within_timings = measure(within, context.repeat)
+  nearest_timings = measure(nearest, context.repeat)
+  return {
+      'build': measure(build_geo_index, context.repeat),
+      'within': {**within_timings,
+                 'ms_per_query': round(within_timings['median_ms'] / max(len(positions), 1), 3),
+                 'mean_found': round(found / max(len(positions), 1), 2)},
+      'nearest': {**nearest_timings,
+                  'ms_per_query': round(nearest_timings['median_ms'] / max(len(positions), 1), 3)},
+      'centers': len(index),
+      'queries': len(positions),
+  }
+
+
+@benchmark('columnar_scan')
+def bench_columnar_scan(context: BenchmarkContext) -> dict:
+  # Loading the sampled centers' series, and every center's matrix, from the
+  # database and from a snapshot exported to a temporary directory
+  states = {center['state'] for center in context.data['centers']}
+  with tempfile.TemporaryDirectory() as directory:
+    start = time.perf_counter()
+    _, manifest = export_snapshot(directory)
+    results = {'export': {'rows': manifest['rows'],
+                          'seconds': round(time.perf_counter() - start, 3)}}
+    # Without a snapshot in its directory, the database is read
+    for source, root in [('database', os.path.join(directory, 'none')),
+                         ('snapshot', directory)]:
+      with override_settings(FOOT_TRAFFIC_SNAPSHOT_DIR=root):
+        series = measure(lambda: [load_series(center['id'], center['state'])
+                                  for center in context.sample], context.repeat)
+        matrix = measure(lambda: load_matrix(states), context.repeat)
+      results[source] = {
+          'series': {**series, 'centers': len(context.sample),
+                     'ms_per_center': round(series['median_ms'] / len(context.sample), 3)},
+          'all_centers': matrix,
+      }
+  return results
+
+
+# Insights shaped like the models' responses, for the markdown benchmark
+_INSIGHTS = """## Foot traffic trends
+Foot traffic at **{name}** rose through the spring and peaked in December.
+- Weekends are about 25% busier than weekdays
+- The summer months were the quietest
+  - July was 12% below the yearly average
+  - August recovered most of the drop
+
+## Anomalies
+1. A spike of 3400 visits on March 12, about three times the usual Sunday
+2. A drop to 450 visits on a Friday in October
+
+Overall, the center is **stable**, with a clear seasonal pattern.
+"""
+
+
+@benchmark('markdown')
+def bench_markdown(context: BenchmarkContext) -> dict:
+  # Rendering insights with a new pipeline per render, as the template filter
+  # used to, with the thread's reused pipeline, and from the rendered HTML
+  # cache. Each run renders the insights of every sampled center.
+  texts = [_INSIGHTS.format(name=center['name']) for center in context.sample]
+  markdown_format(texts[0])  # builds this thread's pipeline
+
+  results = {'renders': len(texts)}
+  for name, render in [
+      ('new_pipeline', lambda text: md.markdown(text, extensions=MARKDOWN_EXTENSIONS)),
+      ('reused_pipeline', render_markdown),
+      ('cached', markdown_format),
+  ]:
+    timings = measure(lambda: [render(text) for text in texts], context.repeat)
+    results[name] = {**timings,
+                     'us_per_render': round(timings['median_ms'] * 1000 / len(texts), 1)}
+  return results
+
+
+def _run_analysis(context: BenchmarkContext, query: str, llm: FakeChatModel,
+                  cached: bool) -> dict:
+  llm_cache = caches[settings.LLM_CACHE_ALIAS]
+  analysis_cache = caches[settings.ANALYSIS_CACHE_ALIAS]
+
+  def run():
+    if not cached:
+      llm_cache.clear()
+      analysis_cache.clear()
+    result = pipeline.run_analysis(query, LLMChoice.CLAUDE3_HAIKU)
+    if result.monthly_averages is None:
+      raise RuntimeError(f"The analysis of {query!r} failed: {result.response}")
+
+  with mock.patch.object(pipeline, 'get_llm', lambda llm_choice: llm):
+    timings = measure(run, context.repeat)
+  # The trend and anomaly stages run concurrently, then the insights stage
+  llm_ms = 0 if cached else 2 * context.llm_latency * 1000
+  return {**timings, 'llm_ms': llm_ms,
+          'overhead_ms': round(timings['median_ms'] - llm_ms, 3)}
+
+
+@benchmark('run_analysis')
+def bench_run_analysis(context: BenchmarkContext) -> dict:
+  llm = FakeChatModel(latency=context.llm_latency)
+  return _run_analysis(context, _query(context.sample[0]), llm, cached=False)
+
+
+@benchmark('run_analysis_cached')
+def bench_run_analysis_cached(context: BenchmarkContext) -> dict:
+  llm = FakeChatModel(latency=context.llm_latency)
+  return _run_analysis(context, _query(context.sample[0]), llm, cached=True)
+
+
+@benchmark('run_analysis_llm_filtering')
+def bench_run_analysis_llm_filtering(context: BenchmarkContext) -> dict:
+  # A query the local extractor cannot match, so the filtering stage runs
+  center = context.sample[0]
+  llm = FakeChatModel(
+      latency=context.llm_latency,
+      xml_response=(f"<result><shopping_center>{center['name']}</shopping_center>"
+                    f"<city>{center['city']}</city></result>"))
+  results = _run_analysis(context, 'How busy is my favorite mall?', llm, cached=False)
+  results['llm_ms'] += context.llm_latency * 1000
+  results['overhead_ms'] = round(results['median_ms'] - results['llm_ms'], 3)
+  return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+  '''
+  Compare benchmark results with a baseline from an earlier run.
+
+  :param results: The results of this run, by benchmark name
+  :param baseline: The results of the earlier run, by benchmark name
+  :param threshold: The relative slowdown of the median reported as a
+                    regression, like 0.2 for 20%
+  :return: A list of (name, baseline median ms, median ms, relative change,
+           regressed) tuples for the benchmarks in both runs
+  '''
+  comparisons = []
+  for name, result in results.items():
+    old = baseline.get(name, {}).get('median_ms')
+    new = result.get('median_ms')
+    if not old or new is None:
+      continue
+    change = (new - old) / old
+    comparisons.append((name, old, new, change, change > threshold))
+  return comparisons
@@ -0,0 +1,150 @@
+'''
+A queue of analyses kept in the database and run by the run_analysis_worker
+command, so a web request submitting an analysis returns at once instead of
+holding a worker while the language models answer.
+'''
+import datetime
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import AnalysisJob
+from .pipeline import (
+    AnalysisError, chart_data, fast_extract_entities, find_comparison, resolve_center,
+    run_analysis)
+from .utils.data_version import get_data_version
+from .utils.enums import JobStatus, LLMChoice
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT = (JobStatus.QUEUED.value, JobStatus.RUNNING.value)
+
+# Queued jobs a worker tries to claim before giving up until its next poll,
+# in case other workers claim the oldest ones first
+_CLAIM_CANDIDATES = 10
+
+
+def dedupe_key(query: str, llm_choice: LLMChoice) -> str:
+  '''
+  The key identical analyses share: the shopping center when the query names
+  one the local extractor recognizes, or the normalized query otherwise, with
+  the model and the data version. Loading data changes the version, so a job
+  queued before a load is not reused for a query made after it.
+  '''
+  subject = ' '.join(query.lower().split())
+  if find_comparison(query)[0] is None:
+    entities = fast_extract_entities(query)
+    if entities is not None:
+      try:
+        subject = f"center:{resolve_center(*entities).shopping_center_id}"
+      except AnalysisError:
+        # The worker reports why the center could not be resolved
+        pass
+  key = f"{subject}\0{llm_choice.value}\0{get_data_version()}"
+  return hashlib.sha256(key.encode()).hexdigest()
+
+
+def submit_job(query: str, llm_choice: LLMChoice) -> tuple:
+  '''
+  Queue an analysis, unless an identical one is already queued or running.
+
+  :param query: The user's query
+  :param llm_choice: The user's choice of language model
+  :return: A tuple of the AnalysisJob and whether it was created
+  '''
+  key = dedupe_key(query, llm_choice)
+  job = AnalysisJob.objects.filter(dedupe_key=key, status__in=IN_FLIGHT).first()
+  if job is not None:
+    logger.info(f"Joining in-flight analysis job {job.id}")
+    return job, False
+
+  try:
+    with transaction.atomic():
+      return AnalysisJob.objects.create(
+          query=query, llm_choice=llm_choice.value, dedupe_key=key), True
+  except IntegrityError:
+    # An identical job was submitted at the same time
+    job = AnalysisJob.objects.filter(dedupe_key=key, status__in=IN_FLIGHT).first()
+    if job is not None:
+      return job, False
+    # It has already finished
+    return AnalysisJob.objects.create(
+        query=query, llm_choice=llm_choice.value, dedupe_key=key), True
+
+
+def claim_job(worker: str) -> AnalysisJob | None:
+  '''
+  Claim the oldest queued job. Each job is moved to running by a conditional
+  update that only one of the workers claiming it at the same time wins.
+
+  :param worker: The name of the claiming worker
+  :return: The claimed AnalysisJob, or None if no job is queued
+  '''
+  candidates = AnalysisJob.objects.filter(
+      status=JobStatus.QUEUED.value).order_by('created_at').values_list(
+          'pk', flat=True)[:_CLAIM_CANDIDATES]
+  for pk in candidates:
+    claimed = AnalysisJob.objects.filter(pk=pk, status=JobStatus.QUEUED.value).update(
+        status=JobStatus.RUNNING.value, worker=worker, started_at=timezone.now(),
+        attempts=F('attempts') + 1)
+    if claimed:
+      return AnalysisJob.objects.get(pk=pk)
+  return None
+
+
+def run_job(job: AnalysisJob) -> None:
+  '''
+  Run a claimed job's analysis and save its result, unless the job was
+  presumed lost and requeued while it ran, and another worker now has it.
+  '''
+  logger.info(f"Running analysis job {job.id}: {job.query}")
+  # Only this worker's claim of the job is finished
+  claim = AnalysisJob.objects.filter(
+      pk=job.pk, status=JobStatus.RUNNING.value, worker=job.worker)
+  try:
+    result = run_analysis(job.query, LLMChoice(job.llm_choice))
+  except Exception as e:
+    # Provider errors have already been retried by the model's client
+    logger.exception(f"Analysis job {job.id} failed")
+    finished = claim.update(
+        status=JobStatus.FAILED.value, error=str(e) or type(e).__name__,
+        finished_at=timezone.now())
+  else:
+    # An analysis that could not continue, like for an unknown center, is
+    # done and its response explains why, as in the form
+    finished = claim.update(
+        status=JobStatus.DONE.value,
+        response=result.response,
+        chart=(chart_data(result.monthly_averages)
+               if result.monthly_averages is not None else None),
+        stage_seconds=result.stage_seconds,
+        finished_at=timezone.now())
+
+  if not finished:
+    logger.warning(f"Analysis job {job.id} was requeued while {job.worker} "
+                   "ran it; discarding its result")
+
+
+def requeue_stale_jobs() -> int:
+  '''
+  Requeue the jobs that have been running for longer than
+  ANALYSIS_JOB_TIMEOUT seconds, presumably because their worker died, or
+  fail them once they have been started ANALYSIS_JOB_MAX_ATTEMPTS times.
+
+  :return: The number of jobs requeued or failed
+  '''
+  now = timezone.now()
+  stale = AnalysisJob.objects.filter(
+      status=JobStatus.RUNNING.value,
+      started_at__lt=now - datetime.timedelta(seconds=settings.ANALYSIS_JOB_TIMEOUT))
+  failed = stale.filter(attempts__gte=settings.ANALYSIS_JOB_MAX_ATTEMPTS).update(
+      status=JobStatus.FAILED.value, finished_at=now,
+      error="The analysis did not finish. Please try again.")
+  requeued = stale.update(status=JobStatus.QUEUED.value)
+  if failed or requeued:
+    logger.warning(f"Requeued {requeued} and failed {failed} stale analysis jobs")
+  return failed + requeued
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from analysis.models import CenterReport, ShoppingCenter
+from analysis.pipeline import (
+    AnalysisError, data_token_budget, generate_insights, prepare_inputs)
+from analysis.utils.enums import LLMChoice
+from analysis.utils.resolver import CenterMatch
+
+logger = logging.getLogger(__name__)
+
+GENERATED = 'generated'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class Command(BaseCommand):
+  help = ('Generates the insights report of every shopping center, or of the '
+          'centers in a state or city, so the web view can serve them instantly')
+
+  def add_arguments(self, parser) -> None:
+    parser.add_argument(
+        '--llm', default=LLMChoice.CLAUDE3_HAIKU.value,
+        choices=[choice.value for choice in LLMChoice],
+        help='The language model that generates the insights. The other '
+             'stages use the models routed by LLM_STAGE_MODELS.')
+    parser.add_argument('--state', help='Only analyze centers in this state')
+    parser.add_argument('--city', help='Only analyze centers in this city')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of centers analyzed concurrently')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Regenerate reports even if the center\'s data has not changed '
+             'since they were generated')
+
+  def handle(self, *args, **options) -> None:
+    self.llm_choice = LLMChoice(options['llm'])
+    self.token_budget = data_token_budget(self.llm_choice)
+    self.force = options['force']
+
+    centers = ShoppingCenter.objects.order_by('shopping_center_id')
+    if options['state']:
+      centers = centers.filter(state__iexact=options['state'])
+    if options['city']:
+      centers = centers.filter(city__iexact=options['city'])
+    centers = [
+        CenterMatch(shopping_center_id, name, city, 100)
+        for shopping_center_id, name, city
+        in centers.values_list('shopping_center_id', 'name', 'city')
+    ]
+
+    start = time.perf_counter()
+    counts = {GENERATED: 0, SKIPPED: 0, FAILED: 0}
+    with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+      futures = [executor.submit(self._analyze, center) for center in centers]
+      for done, future in enumerate(as_completed(futures), 1):
+        counts[future.result()] += 1
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{done}/{len(centers)} centers, {counts[GENERATED]} generated, "
+            f"{counts[SKIPPED]} up to date, {counts[FAILED]} failed "
+            f"({done / elapsed * 60:.1f} centers/min)")
+
+    summary = (
+        f"Analyzed {len(centers)} centers in {time.perf_counter() - start:.1f}s "
+        f"({counts[GENERATED]} generated, {counts[SKIPPED]} up to date, "
+        f"{counts[FAILED]} failed).")
+    if counts[FAILED]:
+      self.stdout.write(self.style.WARNING(
+          f"{summary} Run the command again to retry the failed centers."))
+    else:
+      self.stdout.write(self.style.SUCCESS(summary))
+
+  def _analyze(self, center: CenterMatch) -> str:
+    '''
+    Generate and save the report of one center, unless its saved report was
+    generated from the same data. Saving each report as soon as it is ready
+    checkpoints the run, so an interrupted run resumes where it stopped.
+    '''
+    try:
+      inputs = prepare_inputs(center, self.token_budget)
+      fingerprint = inputs.series.fingerprint()
+      if not self.force and CenterReport.objects.filter(
+              center_id=center.shopping_center_id,
+              llm_choice=self.llm_choice.value,
+              fingerprint=fingerprint).exists():
+        return SKIPPED
+
+      # The model's client holds each request until the provider's rate
+      # limits allow it, so the workers never send more than the quota
+      response = generate_insights(self.llm_choice, inputs)
+      CenterReport.objects.update_or_create(
+          center_id=center.shopping_center_id,
+          llm_choice=self.llm_choice.value,
+          defaults={'response': response, 'fingerprint': fingerprint},
+      )
+      return GENERATED
+    except AnalysisError as e:
+      logger.warning(f"Could not analyze {center.name}: {e}")
+      return FAILED
+    except Exception:
+      # One failing center, like a provider error, should not stop the run
+      logger.exception(f"Could not analyze {center.name}")
+      return FAILED
+    finally:
+      # Worker threads do not go through Django's request cycle, which would
+      # otherwise close their connections
+      connections.close_all()
@@ -0,0 +1,110 @@
+import datetime
+import json
+import os
+import platform
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from analysis.benchmarks import BENCHMARKS, BenchmarkContext, compare, load_data
+from analysis.utils.synthetic import write_synthetic_csv
+
+
+class Command(BaseCommand):
+  help = ('Benchmarks loading, entity resolution, the foot traffic statistics '
+          'and the full analysis on synthetic data, with a local stand-in for '
+          'the language models, and writes the results as JSON')
+
+  def add_arguments(self, parser) -> None:
+    parser.add_argument(
+        '--centers', type=int, default=200, help='Number of synthetic shopping centers')
+    parser.add_argument(
+        '--days', type=int, default=730, help='Number of days of each center')
+    parser.add_argument(
+        '--seed', type=int, default=0, help='Random seed of the synthetic data')
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='Timed runs of each benchmark')
+    parser.add_argument(
+        '--sample', type=int, default=20,
+        help='Number of centers the per-center benchmarks use')
+    parser.add_argument(
+        '--llm-latency', type=float, default=0.2,
+        help='Seconds the stand-in language model takes to answer')
+    parser.add_argument(
+        '--only', nargs='+', choices=list(BENCHMARKS), metavar='BENCHMARK',
+        help=f"Only run these benchmarks, of: {', '.join(BENCHMARKS)}")
+    parser.add_argument(
+        '--output', help='Write the results to this JSON file instead of stdout')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='Compare the results with an earlier run\'s JSON file')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Relative slowdown of a median reported as a regression')
+    parser.add_argument(
+        '--noinput', '--no-input', action='store_false', dest='interactive',
+        help='Do not ask before replacing a leftover benchmark database')
+
+  def handle(self, *args, **options) -> None:
+    baseline = None
+    if options['compare']:
+      with open(options['compare']) as file:
+        baseline = json.load(file)['results']
+
+    names = options['only'] or list(BENCHMARKS)
+    with tempfile.TemporaryDirectory() as directory:
+      csv_file = os.path.join(directory, 'foot_traffic.csv')
+      data = write_synthetic_csv(
+          csv_file, options['centers'], options['days'], seed=options['seed'])
+      context = BenchmarkContext(
+          csv_file, data, options['repeat'], options['sample'],
+          options['llm_latency'])
+
+      # The benchmarks load data and clear the LLM cache, so they run against
+      # a throwaway test database, never the configured one
+      old_name = connection.settings_dict['NAME']
+      connection.creation.create_test_db(
+          verbosity=0, autoclobber=not options['interactive'])
+      try:
+        results = {'load_csv_data': load_data(context)}
+        self.stderr.write(f"load_csv_data: {results['load_csv_data']}")
+        for name in names:
+          results[name] = BENCHMARKS[name](context)
+          self.stderr.write(f"{name}: {results[name]}")
+      finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = json.dumps({
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'centers': options['centers'],
+            'days': options['days'],
+            'rows': data['rows'],
+            'seed': options['seed'],
+            'repeat': options['repeat'],
+            'sample': len(context.sample),
+            'llm_latency': options['llm_latency'],
+        },
+        'results': results,
+    }, indent=2)
+    if options['output']:
+      with open(options['output'], 'w') as file:
+        file.write(report + '\n')
+    else:
+      self.stdout.write(report)
+
+    if baseline is not None:
+      regressions = 0
+      for name, old, new, change, regressed in compare(
+              results, baseline, options['threshold']):
+        line = f"{name}: {old:.1f}ms -> {new:.1f}ms ({change:+.0%})"
+        if regressed:
+          regressions += 1
+          self.stderr.write(self.style.ERROR(f"{line} REGRESSION"))
+        else:
+          self.stderr.write(line)
+      if regressions:
+        raise CommandError(f"{regressions} benchmarks regressed by more than "
+                           f"{options['threshold']:.0%}.")
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from analysis.utils.columnar import export_snapshot
+
+
+class Command(BaseCommand):
+  help = ('Exports the foot traffic to a columnar snapshot of Parquet files '
+          'partitioned by state and month, which the analyses read instead of '
+          'the database until data is loaded again')
+
+  def add_arguments(self, parser) -> None:
+    parser.add_argument(
+        '--output', default=settings.FOOT_TRAFFIC_SNAPSHOT_DIR,
+        help='Directory the snapshots are written to')
+    parser.add_argument(
+        '--batch-size', type=int, default=100000,
+        help='Number of rows read from the database at a time')
+    parser.add_argument(
+        '--keep', type=int, default=2,
+        help='Number of snapshots kept, including the new one')
+
+  def handle(self, *args, **options) -> None:
+    path, manifest = export_snapshot(
+        options['output'], options['batch_size'], max(options['keep'], 1))
+    self.stdout.write(self.style.SUCCESS(
+        f"Exported {manifest['rows']} rows to {path}"))
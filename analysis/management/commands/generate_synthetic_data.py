@@ -0,0 +1,43 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from analysis.utils.synthetic import write_synthetic_csv
+
+
+class Command(BaseCommand):
+  help = ('Writes synthetic foot traffic, with seasonality and injected '
+          'anomalies, to a CSV file that load_csv_data can load')
+
+  def add_arguments(self, parser) -> None:
+    parser.add_argument(
+        'csv_file', type=str, help='Path of the CSV file, gzipped if it ends with .gz')
+    parser.add_argument(
+        '--centers', type=int, default=100, help='Number of shopping centers')
+    parser.add_argument(
+        '--days', type=int, default=730, help='Number of days of each center')
+    parser.add_argument(
+        '--start', type=datetime.date.fromisoformat, default=datetime.date(2022, 1, 1),
+        help='The first day, as YYYY-MM-DD')
+    parser.add_argument(
+        '--anomaly-rate', type=float, default=0.01,
+        help='Share of days with an injected anomaly')
+    parser.add_argument(
+        '--missing-rate', type=float, default=0.0,
+        help='Share of days without a foot traffic value')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed, so the same arguments write the same file')
+
+  def handle(self, *args, **options) -> None:
+    data = write_synthetic_csv(
+        options['csv_file'],
+        centers=options['centers'],
+        days=options['days'],
+        seed=options['seed'],
+        start=options['start'],
+        anomaly_rate=options['anomaly_rate'],
+        missing_rate=options['missing_rate'],
+    )
+    self.stdout.write(self.style.SUCCESS(
+        f"Wrote {data['rows']} rows of {len(data['centers'])} centers, with "
+        f"{len(data['anomalies'])} anomalies, to {options['csv_file']}."))
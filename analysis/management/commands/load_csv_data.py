@@ -1,35 +1,279 @@
 import csv
+import datetime
+import gzip
+import hashlib
+import io
+from itertools import islice
+import time
+
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from analysis.models import FootTraffic
+from django.db import connection, transaction
+from analysis.models import FootTraffic, IngestedFile, IngestWatermark, ShoppingCenter
+from analysis.utils.data_version import bump_data_version
+from analysis.utils.rollups import RollupDeltas
+
+# ShoppingCenter fields and the CSV columns they are loaded from
+CENTER_FIELD_COLUMNS = [
+    ('shopping_center_id', 'id'),
+    ('name', 'name'),
+    ('state', 'state'),
+    ('city', 'city'),
+    ('formatted_address', 'formatted_address'),
+    ('lon', 'lon'),
+    ('lat', 'lat'),
+]
+# FootTraffic fields and the CSV columns they are loaded from
+FIELD_COLUMNS = [
+    ('day', 'day'),
+    ('center_id', 'id'),
+    ('ft', 'ft'),
+]
 
 
 class Command(BaseCommand):
   help = 'Loads data from a CSV file into the FootTraffic model'
 
   def add_arguments(self, parser) -> None:
-    parser.add_argument('csv_file', type=str, help='Path to the CSV file')
+    parser.add_argument(
+        'csv_file', type=str, help='Path to the CSV file, optionally gzipped (.gz)')
+    parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='Number of rows read and written at a time')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Skip files that were already loaded and rows whose foot traffic '
+             'is already loaded, and upsert the remaining rows, including '
+             'corrections of days loaded before. Also resumes a load that '
+             'was interrupted')
 
-  @transaction.atomic
   def handle(self, *args, **options) -> None:
     csv_file = options['csv_file']
-    with open(csv_file, 'r') as file:
-      reader = csv.DictReader(file)
-      foot_traffic_list = []
-      for row in reader:
-        foot_traffic = FootTraffic(
-            day=row['day'],
-            shopping_center_id=row['id'],
-            name=row['name'],
-            ft=row['ft'],
-            state=row['state'],
-            city=row['city'],
-            formatted_address=row['formatted_address'],
-            lon=row['lon'],
-            lat=row['lat']
-        )
-        foot_traffic_list.append(foot_traffic)
-
-      FootTraffic.objects.bulk_create(foot_traffic_list)
-
-    self.stdout.write(self.style.SUCCESS('Data loaded successfully.'))
+    batch_size = options['batch_size']
+    incremental = options['incremental']
+
+    sha256 = _file_sha256(csv_file)
+    if incremental and IngestedFile.objects.filter(sha256=sha256).exists():
+      self.stdout.write(self.style.WARNING(
+          f"{csv_file} was already loaded, skipping it."))
+      return
+
+    # Rows after their center's latest loaded day are new. Those at or before
+    # it are compared with the foot traffic already loaded, so corrections are
+    # upserted and unchanged rows skipped, and the rows of a file need not be
+    # sorted by day. Like the rollups of a batch, only one day per center is
+    # kept in memory.
+    self.last_days = dict(
+        IngestWatermark.objects.values_list('shopping_center_id', 'last_day'))
+    self.rollups = RollupDeltas()
+
+    if incremental:
+      write_batch = self._upsert_batch
+    elif _can_copy():
+      write_batch = self._copy_batch
+    else:
+      write_batch = self._bulk_create_batch
+
+    start = time.perf_counter()
+    total = 0
+    skipped = 0
+    try:
+      with _open_csv(csv_file) as file:
+        reader = csv.DictReader(file)
+        # Only one batch of rows is held in memory at a time, and each is
+        # committed with its rollups and watermarks, so an interrupted load
+        # keeps the batches before it and loading the file again with
+        # --incremental skips them
+        while batch := list(islice(reader, batch_size)):
+          replaced = {}
+          if incremental:
+            new_rows, replaced = self._changed_rows(batch)
+            skipped += len(batch) - len(new_rows)
+            batch = new_rows
+          if batch:
+            with transaction.atomic():
+              self._write(batch, write_batch, replaced)
+          total += len(batch)
+          elapsed = time.perf_counter() - start
+          self.stdout.write(
+              f"{total} rows loaded, {skipped} skipped "
+              f"({(total + skipped) / elapsed:.0f} rows/sec)")
+
+      # Written last, so a file is only skipped once all of it is loaded
+      IngestedFile.objects.update_or_create(
+          sha256=sha256, defaults={'path': csv_file, 'rows': total})
+    finally:
+      # Let running workers know to rebuild their center indexes and stop
+      # serving analyses of the data from before the load
+      if total:
+        bump_data_version()
+
+    self.stdout.write(self.style.SUCCESS(
+        f"Data loaded successfully ({total} rows in "
+        f"{time.perf_counter() - start:.1f}s, {skipped} already loaded rows "
+        f"skipped)."))
+
+  def _write(self, rows: list, write_batch, replaced: dict) -> None:
+    '''
+    Write a batch of rows, and adjust the rollups and watermarks by it.
+
+    :param rows: The rows to write
+    :param write_batch: The method writing the rows to the FootTraffic table
+    :param replaced: The foot traffic already loaded for the rows, by center
+                     and day
+    '''
+    self._upsert_centers(rows)
+    write_batch(rows)
+    # The rollups are adjusted by each row and the row it replaced, without
+    # regrouping the center's existing rows
+    self._add_to_rollups(rows, replaced)
+    self.rollups.save()
+    advanced = self._advance_watermarks(rows)
+    IngestWatermark.objects.bulk_create(
+        [IngestWatermark(shopping_center_id=center_id, last_day=self.last_days[center_id])
+         for center_id in advanced],
+        update_conflicts=True,
+        unique_fields=['shopping_center_id'],
+        update_fields=['last_day'],
+    )
+
+  def _changed_rows(self, rows: list) -> tuple:
+    '''
+    The rows that are new or correct the foot traffic already loaded, keeping
+    only the last row of each center and day, since Postgres cannot upsert the
+    same row twice in one statement.
+
+    :return: A tuple of the rows and the foot traffic already loaded for them,
+             by center and day, which they replace
+    '''
+    latest = {}
+    for row in rows:
+      row['day'] = datetime.date.fromisoformat(row['day'])
+      latest[(row['id'], row['day'])] = row
+    loaded = self._loaded_ft(list(latest.values()))
+    changed = []
+    for key, row in latest.items():
+      ft = int(row['ft']) if row['ft'] else None
+      if key not in loaded or loaded[key] != ft:
+        changed.append(row)
+    return changed, loaded
+
+  def _advance_watermarks(self, rows: list) -> set:
+    '''
+    Advance the latest loaded day of the rows' centers.
+
+    :return: The identifiers of the centers whose latest day advanced
+    '''
+    advanced = set()
+    for row in rows:
+      center_id = row['id']
+      day = row['day']
+      if isinstance(day, str):
+        day = datetime.date.fromisoformat(day)
+      last_day = self.last_days.get(center_id)
+      if last_day is None or day > last_day:
+        self.last_days[center_id] = day
+        advanced.add(center_id)
+    return advanced
+
+  def _loaded_ft(self, rows: list) -> dict:
+    '''
+    The foot traffic already loaded for the rows' centers and days, by center
+    and day. Only a row at or before its center's latest loaded day, including
+    the earlier batches', can have been, so the table is only read for those,
+    with one query.
+    '''
+    keys = set()
+    for row in rows:
+      last_day = self.last_days.get(row['id'])
+      if last_day is not None and row['day'] <= last_day:
+        keys.add((row['id'], row['day']))
+    if not keys:
+      return {}
+    loaded = FootTraffic.objects.filter(
+        center_id__in={center_id for center_id, _ in keys},
+        day__in={day for _, day in keys},
+    ).values_list('center_id', 'day', 'ft')
+    return {(center_id, day): ft for center_id, day, ft in loaded
+            if (center_id, day) in keys}
+
+  def _add_to_rollups(self, rows: list, replaced: dict) -> None:
+    for row in rows:
+      day = row['day']
+      if isinstance(day, str):
+        day = datetime.date.fromisoformat(day)
+      if (previous := replaced.get((row['id'], day))) is not None:
+        self.rollups.remove(row['id'], day, previous)
+      if row['ft']:
+        self.rollups.add(row['id'], day, int(row['ft']))
+
+  def _upsert_centers(self, rows: list) -> None:
+    '''
+    Create or update the shopping centers in a batch, using the attributes
+    from each center's last row.
+    '''
+    centers = {}
+    for row in rows:
+      centers[row['id']] = ShoppingCenter(**{
+          field: row[column] or None for field, column in CENTER_FIELD_COLUMNS})
+    ShoppingCenter.objects.bulk_create(
+        centers.values(),
+        update_conflicts=True,
+        unique_fields=['shopping_center_id'],
+        update_fields=[field for field, _ in CENTER_FIELD_COLUMNS[1:]],
+    )
+
+  def _upsert_batch(self, rows: list) -> None:
+    FootTraffic.objects.bulk_create(
+        [FootTraffic(**{field: row[column] for field, column in FIELD_COLUMNS})
+         for row in rows],
+        update_conflicts=True,
+        unique_fields=['center', 'day'],
+        update_fields=['ft'],
+    )
+
+  def _bulk_create_batch(self, rows: list) -> None:
+    FootTraffic.objects.bulk_create(
+        FootTraffic(**{field: row[column] for field, column in FIELD_COLUMNS})
+        for row in rows
+    )
+
+  def _copy_batch(self, rows: list) -> None:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+      writer.writerow(row[column] for _, column in FIELD_COLUMNS)
+    buffer.seek(0)
+
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(
+        quote_name(FootTraffic._meta.get_field(field).column)
+        for field, _ in FIELD_COLUMNS)
+    with connection.cursor() as cursor:
+      # Empty values are loaded as NULL
+      cursor.copy_expert(
+          f"COPY {quote_name(FootTraffic._meta.db_table)} ({columns}) "
+          f"FROM STDIN WITH (FORMAT csv)",
+          buffer,
+      )
+
+
+def _can_copy() -> bool:
+  # COPY is much faster than INSERT, but needs psycopg2's copy_expert
+  if connection.vendor != 'postgresql':
+    return False
+  from django.db.backends.postgresql.psycopg_any import is_psycopg3
+  return not is_psycopg3
+
+
+def _file_sha256(path: str) -> str:
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file:
+    while chunk := file.read(1024 * 1024):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _open_csv(path: str):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rt', newline='')
+  return open(path, 'r', newline='')
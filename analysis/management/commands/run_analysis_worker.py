@@ -0,0 +1,77 @@
+import logging
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from analysis.jobs import claim_job, requeue_stale_jobs, run_job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+  help = ('Runs the analysis jobs submitted through the API until it is '
+          'stopped with SIGINT or SIGTERM, which lets the running jobs finish')
+
+  def add_arguments(self, parser) -> None:
+    parser.add_argument(
+        '--threads', type=int, default=settings.ANALYSIS_WORKER_THREADS,
+        help='Number of jobs run concurrently')
+    parser.add_argument(
+        '--poll-interval', type=float, default=settings.ANALYSIS_WORKER_POLL_INTERVAL,
+        help='Seconds an idle thread waits before checking the queue again')
+    parser.add_argument(
+        '--once', action='store_true',
+        help='Exit once the queue is empty instead of waiting for new jobs')
+
+  def handle(self, *args, **options) -> None:
+    self.poll_interval = options['poll_interval']
+    self.once = options['once']
+    self.stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      signal.signal(signum, self._request_stop)
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=self._work, args=(f"{name}:{i}",), name=f"analysis-worker-{i}")
+        for i in range(options['threads'])
+    ]
+    for thread in threads:
+      thread.start()
+    self.stdout.write(f"Worker {name} running {len(threads)} threads")
+
+    # Jobs whose worker died are picked up again by the live workers
+    while threads:
+      requeue_stale_jobs()
+      threads[0].join(timeout=self.poll_interval * 10)
+      threads = [thread for thread in threads if thread.is_alive()]
+    self.stdout.write(self.style.SUCCESS(f"Worker {name} stopped"))
+
+  def _request_stop(self, signum, frame) -> None:
+    self.stdout.write("Stopping once the running jobs finish...")
+    self.stop.set()
+
+  def _work(self, worker: str) -> None:
+    try:
+      while not self.stop.is_set():
+        try:
+          job = claim_job(worker)
+          if job is None:
+            if self.once:
+              return
+            self.stop.wait(self.poll_interval)
+            continue
+          run_job(job)
+        except Exception:
+          # Like a lost database connection; keep polling
+          logger.exception(f"Analysis worker {worker} failed")
+          self.stop.wait(self.poll_interval)
+        finally:
+          # Threads do not go through Django's request cycle, which would
+          # otherwise replace their expired or broken connections
+          close_old_connections()
+    finally:
+      connections.close_all()
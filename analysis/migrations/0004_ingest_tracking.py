@@ -0,0 +1,41 @@
+# Generated by Django 5.0.3 on 2026-10-18 13:59
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_watermarks(apps, schema_editor):
+    FootTraffic = apps.get_model('analysis', 'FootTraffic')
+    IngestWatermark = apps.get_model('analysis', 'IngestWatermark')
+    IngestWatermark.objects.bulk_create(
+        IngestWatermark(shopping_center_id=row['shopping_center_id'], last_day=row['last_day'])
+        for row in FootTraffic.objects.values('shopping_center_id').annotate(last_day=Max('day'))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0003_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(help_text='The SHA-256 digest of the file contents', max_length=64, unique=True)),
+                ('path', models.CharField(help_text='The path the file was loaded from', max_length=1024)),
+                ('rows', models.IntegerField(help_text='The number of rows written from the file')),
+                ('loaded_at', models.DateTimeField(auto_now_add=True, help_text='When the file was loaded')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IngestWatermark',
+            fields=[
+                ('shopping_center_id', models.CharField(help_text='The unique identifier of the shopping center', max_length=255, primary_key=True, serialize=False)),
+                ('last_day', models.DateField(help_text='The latest day of foot traffic loaded for the shopping center')),
+            ],
+        ),
+        migrations.RunPython(seed_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_shopping_centers(apps, schema_editor):
+    FootTraffic = apps.get_model('analysis', 'FootTraffic')
+    ShoppingCenter = apps.get_model('analysis', 'ShoppingCenter')
+
+    # The center's attributes are repeated on each of its rows. If they ever
+    # differ between rows, keep the first distinct set.
+    centers = {}
+    rows = FootTraffic.objects.values(
+        'shopping_center_id', 'name', 'state', 'city', 'formatted_address', 'lon', 'lat'
+    ).distinct().order_by('shopping_center_id')
+    for row in rows.iterator():
+        centers.setdefault(row['shopping_center_id'], row)
+
+    ShoppingCenter.objects.bulk_create(
+        (ShoppingCenter(**{
+            **center,
+            'lon': None if center['lon'] is None else float(center['lon']),
+            'lat': None if center['lat'] is None else float(center['lat']),
+        }) for center in centers.values()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0004_ingest_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingCenter',
+            fields=[
+                ('shopping_center_id', models.CharField(help_text='The unique identifier of the shopping center', max_length=255, primary_key=True, serialize=False)),
+                ('name', models.CharField(db_index=True, help_text='The name of the shopping center', max_length=255)),
+                ('state', models.CharField(db_index=True, help_text='The state code where the shopping center is located', max_length=2, null=True)),
+                ('city', models.CharField(db_index=True, help_text='The city where the shopping center is located', max_length=255, null=True)),
+                ('formatted_address', models.CharField(help_text='The full address of the shopping center', max_length=255, null=True)),
+                ('lon', models.FloatField(help_text='The longitude coordinate of the shopping center', null=True)),
+                ('lat', models.FloatField(help_text='The latitude coordinate of the shopping center', null=True)),
+            ],
+        ),
+        migrations.RunPython(populate_shopping_centers, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='foottraffic',
+            unique_together=set(),
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='city',
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='formatted_address',
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='lat',
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='lon',
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='name',
+        ),
+        migrations.RemoveField(
+            model_name='foottraffic',
+            name='state',
+        ),
+        # Keep the existing shopping_center_id column, which already holds the
+        # ShoppingCenter primary keys, and turn it into the foreign key
+        migrations.AlterField(
+            model_name='foottraffic',
+            name='shopping_center_id',
+            field=models.CharField(db_column='shopping_center_id', help_text='The unique identifier of the shopping center', max_length=255),
+        ),
+        migrations.RenameField(
+            model_name='foottraffic',
+            old_name='shopping_center_id',
+            new_name='center',
+        ),
+        migrations.AlterField(
+            model_name='foottraffic',
+            name='center',
+            field=models.ForeignKey(db_column='shopping_center_id', db_index=False, help_text='The shopping center', on_delete=django.db.models.deletion.CASCADE, related_name='foot_traffic', to='analysis.shoppingcenter'),
+        ),
+        migrations.AddConstraint(
+            model_name='foottraffic',
+            constraint=models.UniqueConstraint(fields=('center', 'day'), include=('ft',), name='foottraffic_center_day_uniq'),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import BigIntegerField, Count, Sum
+from django.db.models.functions import Cast, ExtractWeekDay, TruncMonth, TruncWeek
+
+
+def populate_rollups(apps, schema_editor):
+    FootTraffic = apps.get_model('analysis', 'FootTraffic')
+    ft = Cast('ft', BigIntegerField())
+    totals = {
+        'count': Count('ft'),
+        'total': Sum(ft),
+        'total_sq': Sum(ft * ft),
+    }
+    rows = FootTraffic.objects.filter(ft__isnull=False)
+    for model_name, field, period in [
+        ('WeeklyTraffic', 'week_start', TruncWeek('day')),
+        ('MonthlyTraffic', 'month', TruncMonth('day')),
+        ('DayOfWeekTraffic', 'weekday', ExtractWeekDay('day')),
+    ]:
+        model = apps.get_model('analysis', model_name)
+        model.objects.bulk_create(
+            (model(**row) for row in rows.annotate(**{field: period}).values(
+                'center_id', field).annotate(**totals).order_by()),
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0005_shoppingcenter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DayOfWeekTraffic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(help_text='The number of days with a foot traffic value')),
+                ('total', models.BigIntegerField(help_text='The sum of the foot traffic values')),
+                ('total_sq', models.BigIntegerField(help_text='The sum of the squared foot traffic values')),
+                ('weekday', models.PositiveSmallIntegerField(help_text='The day of the week, from 1 (Sunday) to 7 (Saturday)')),
+                ('center', models.ForeignKey(db_index=False, help_text='The shopping center', on_delete=django.db.models.deletion.CASCADE, related_name='day_of_week_traffic', to='analysis.shoppingcenter')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MonthlyTraffic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(help_text='The number of days with a foot traffic value')),
+                ('total', models.BigIntegerField(help_text='The sum of the foot traffic values')),
+                ('total_sq', models.BigIntegerField(help_text='The sum of the squared foot traffic values')),
+                ('month', models.DateField(help_text='The first day of the month')),
+                ('center', models.ForeignKey(db_index=False, help_text='The shopping center', on_delete=django.db.models.deletion.CASCADE, related_name='monthly_traffic', to='analysis.shoppingcenter')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WeeklyTraffic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(help_text='The number of days with a foot traffic value')),
+                ('total', models.BigIntegerField(help_text='The sum of the foot traffic values')),
+                ('total_sq', models.BigIntegerField(help_text='The sum of the squared foot traffic values')),
+                ('week_start', models.DateField(help_text='The Monday that starts the ISO week')),
+                ('center', models.ForeignKey(db_index=False, help_text='The shopping center', on_delete=django.db.models.deletion.CASCADE, related_name='weekly_traffic', to='analysis.shoppingcenter')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dayofweektraffic',
+            constraint=models.UniqueConstraint(fields=('center', 'weekday'), name='dayofweektraffic_center_weekday_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='monthlytraffic',
+            constraint=models.UniqueConstraint(fields=('center', 'month'), name='monthlytraffic_center_month_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='weeklytraffic',
+            constraint=models.UniqueConstraint(fields=('center', 'week_start'), name='weeklytraffic_center_week_uniq'),
+        ),
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
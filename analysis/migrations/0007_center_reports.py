@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0006_traffic_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CenterReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('llm_choice', models.CharField(help_text='The LLMChoice value of the model that generated the report', max_length=32)),
+                ('response', models.TextField(help_text='The generated insights, in Markdown')),
+                ('fingerprint', models.CharField(help_text='The fingerprint of the foot traffic the report was generated from', max_length=64)),
+                ('generated_at', models.DateTimeField(auto_now=True, help_text='When the report was generated')),
+                ('center', models.ForeignKey(db_index=False, help_text='The shopping center', on_delete=django.db.models.deletion.CASCADE, related_name='reports', to='analysis.shoppingcenter')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='centerreport',
+            constraint=models.UniqueConstraint(fields=('center', 'llm_choice'), name='centerreport_center_llm_uniq'),
+        ),
+    ]
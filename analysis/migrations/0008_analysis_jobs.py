@@ -0,0 +1,40 @@
+# Generated by Django 5.0.3 on 2026-10-18 14:33
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0007_center_reports'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, help_text="The job's identifier", primary_key=True, serialize=False)),
+                ('query', models.TextField(help_text="The user's query")),
+                ('llm_choice', models.CharField(help_text='The LLMChoice value of the model the user chose', max_length=32)),
+                ('dedupe_key', models.CharField(help_text='The digest of the center or query, model and data version that identical jobs share', max_length=64)),
+                ('status', models.CharField(default='queued', help_text='The JobStatus value of the job', max_length=16)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, help_text='The number of times a worker has started the job')),
+                ('worker', models.CharField(blank=True, help_text='The worker that ran the job last', max_length=255)),
+                ('response', models.TextField(help_text='The generated insights, in Markdown, once the job is done', null=True)),
+                ('chart', models.JSONField(help_text='The labels and values of the monthly averages chart', null=True)),
+                ('stage_seconds', models.JSONField(help_text='The seconds each LLM stage took, by stage', null=True)),
+                ('error', models.TextField(help_text='Why the job failed', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, help_text='When the job was submitted')),
+                ('started_at', models.DateTimeField(help_text='When a worker last started the job', null=True)),
+                ('finished_at', models.DateTimeField(help_text='When the job finished', null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='analysisjob_status_created_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='analysisjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('dedupe_key',), name='analysisjob_inflight_dedupe_uniq'),
+        ),
+    ]
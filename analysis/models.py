@@ -1,29 +1,216 @@
+import uuid
+
 from django.db import models
 
-from .utils.enums import DayOfWeek
+from .utils.enums import DayOfWeek, JobStatus
 
 
-class FootTraffic(models.Model):
-  day = models.DateField(help_text='The date of the record')
+class ShoppingCenter(models.Model):
   shopping_center_id = models.CharField(
-      max_length=255, help_text='The unique identifier of the shopping center')
+      max_length=255, primary_key=True, help_text='The unique identifier of the shopping center')
   name = models.CharField(
       max_length=255, help_text='The name of the shopping center', db_index=True)
-  ft = models.IntegerField(
-      help_text='The foot traffic at the shopping center', null=True)
   state = models.CharField(
       max_length=2, help_text='The state code where the shopping center is located', db_index=True, null=True)
   city = models.CharField(
       max_length=255, help_text='The city where the shopping center is located', db_index=True, null=True)
   formatted_address = models.CharField(
-      max_length=255, help_text='The full address of the shopping center', db_index=True, null=True)
-  lon = models.DecimalField(max_digits=10, decimal_places=8,
-                            help_text='The longitude coordinate of the shopping center', null=True)
-  lat = models.DecimalField(max_digits=10, decimal_places=8,
-                            help_text='The latitude coordinate of the shopping center', null=True)
+      max_length=255, help_text='The full address of the shopping center', null=True)
+  lon = models.FloatField(
+      help_text='The longitude coordinate of the shopping center', null=True)
+  lat = models.FloatField(
+      help_text='The latitude coordinate of the shopping center', null=True)
+
+  def __str__(self) -> str:
+    return f"{self.name} ({self.city}, {self.state})"
+
+
+class FootTraffic(models.Model):
+  # The (center, day) unique constraint below indexes the center's rows, so
+  # the foreign key does not need an index of its own
+  center = models.ForeignKey(
+      ShoppingCenter, on_delete=models.CASCADE, db_column='shopping_center_id', db_index=False,
+      related_name='foot_traffic', help_text='The shopping center')
+  day = models.DateField(help_text='The date of the record')
+  ft = models.IntegerField(
+      help_text='The foot traffic at the shopping center', null=True)
+
+  def __str__(self) -> str:
+    return f"Name: {self.center.name}, Day: {self.day} ({DayOfWeek(self.day.weekday()).name}), City: {self.center.city}, State: {self.center.state}, Foot Traffic: {self.ft}"
+
+  class Meta:
+    constraints = [
+        # Including ft lets PostgreSQL answer a center's date range scan from
+        # the index alone
+        models.UniqueConstraint(
+            fields=['center', 'day'], include=['ft'], name='foottraffic_center_day_uniq'),
+    ]
+
+
+class TrafficRollup(models.Model):
+  # Running totals of a center's foot traffic over a period, kept up to date
+  # by load_csv_data so averages and deviations can be read without grouping
+  # the daily rows. Days without a foot traffic value are not counted.
+  count = models.IntegerField(
+      help_text='The number of days with a foot traffic value')
+  total = models.BigIntegerField(help_text='The sum of the foot traffic values')
+  total_sq = models.BigIntegerField(
+      help_text='The sum of the squared foot traffic values')
+
+  class Meta:
+    abstract = True
+
+
+class WeeklyTraffic(TrafficRollup):
+  center = models.ForeignKey(
+      ShoppingCenter, on_delete=models.CASCADE, db_index=False,
+      related_name='weekly_traffic', help_text='The shopping center')
+  week_start = models.DateField(help_text='The Monday that starts the ISO week')
+
+  def __str__(self) -> str:
+    return f"{self.center_id}: week of {self.week_start}"
+
+  class Meta:
+    constraints = [
+        models.UniqueConstraint(
+            fields=['center', 'week_start'], name='weeklytraffic_center_week_uniq'),
+    ]
+
+
+class MonthlyTraffic(TrafficRollup):
+  center = models.ForeignKey(
+      ShoppingCenter, on_delete=models.CASCADE, db_index=False,
+      related_name='monthly_traffic', help_text='The shopping center')
+  month = models.DateField(help_text='The first day of the month')
+
+  def __str__(self) -> str:
+    return f"{self.center_id}: {self.month:%B %Y}"
+
+  class Meta:
+    constraints = [
+        models.UniqueConstraint(
+            fields=['center', 'month'], name='monthlytraffic_center_month_uniq'),
+    ]
+
+
+class DayOfWeekTraffic(TrafficRollup):
+  center = models.ForeignKey(
+      ShoppingCenter, on_delete=models.CASCADE, db_index=False,
+      related_name='day_of_week_traffic', help_text='The shopping center')
+  weekday = models.PositiveSmallIntegerField(
+      help_text='The day of the week, from 1 (Sunday) to 7 (Saturday)')
+
+  def __str__(self) -> str:
+    return f"{self.center_id}: weekday {self.weekday}"
+
+  class Meta:
+    constraints = [
+        models.UniqueConstraint(
+            fields=['center', 'weekday'], name='dayofweektraffic_center_weekday_uniq'),
+    ]
+
+
+class CenterReport(models.Model):
+  # Insights pre-generated by the analyze_centers command, served by the
+  # views while the center's foot traffic still matches the fingerprint
+  center = models.ForeignKey(
+      ShoppingCenter, on_delete=models.CASCADE, db_index=False,
+      related_name='reports', help_text='The shopping center')
+  llm_choice = models.CharField(
+      max_length=32, help_text='The LLMChoice value of the model that generated the report')
+  response = models.TextField(help_text='The generated insights, in Markdown')
+  fingerprint = models.CharField(
+      max_length=64, help_text='The fingerprint of the foot traffic the report was generated from')
+  generated_at = models.DateTimeField(
+      auto_now=True, help_text='When the report was generated')
+
+  def __str__(self) -> str:
+    return f"{self.center_id} ({self.llm_choice}, {self.generated_at})"
+
+  class Meta:
+    constraints = [
+        models.UniqueConstraint(
+            fields=['center', 'llm_choice'], name='centerreport_center_llm_uniq'),
+    ]
+
+
+class IngestWatermark(models.Model):
+  shopping_center_id = models.CharField(
+      max_length=255, primary_key=True, help_text='The unique identifier of the shopping center')
+  last_day = models.DateField(
+      help_text='The latest day of foot traffic loaded for the shopping center')
+
+  def __str__(self) -> str:
+    return f"{self.shopping_center_id}: {self.last_day}"
+
+
+class IngestedFile(models.Model):
+  sha256 = models.CharField(
+      max_length=64, unique=True, help_text='The SHA-256 digest of the file contents')
+  path = models.CharField(
+      max_length=1024, help_text='The path the file was loaded from')
+  rows = models.IntegerField(
+      help_text='The number of rows written from the file')
+  loaded_at = models.DateTimeField(
+      auto_now_add=True, help_text='When the file was loaded')
+
+  def __str__(self) -> str:
+    return f"{self.path} ({self.sha256[:12]}, {self.rows} rows)"
+
+
+class DataVersion(models.Model):
+  # The single row counting the loads of foot traffic. Everything derived from
+  # the data, like the in-memory center index, is keyed by it.
+  version = models.BigIntegerField(
+      help_text='The version of the foot traffic data, incremented by each load')
+
+  def __str__(self) -> str:
+    return str(self.version)
+
+
+class AnalysisJob(models.Model):
+  # An analysis submitted through the API and run by the run_analysis_worker
+  # command, so web requests do not wait on the language models
+  id = models.UUIDField(
+      primary_key=True, default=uuid.uuid4, editable=False, help_text='The job\'s identifier')
+  query = models.TextField(help_text='The user\'s query')
+  llm_choice = models.CharField(
+      max_length=32, help_text='The LLMChoice value of the model the user chose')
+  dedupe_key = models.CharField(
+      max_length=64, help_text='The digest of the center or query, model and data '
+                               'version that identical jobs share')
+  status = models.CharField(
+      max_length=16, default=JobStatus.QUEUED.value,
+      help_text='The JobStatus value of the job')
+  attempts = models.PositiveSmallIntegerField(
+      default=0, help_text='The number of times a worker has started the job')
+  worker = models.CharField(
+      max_length=255, blank=True, help_text='The worker that ran the job last')
+  response = models.TextField(
+      null=True, help_text='The generated insights, in Markdown, once the job is done')
+  chart = models.JSONField(
+      null=True, help_text='The labels and values of the monthly averages chart')
+  stage_seconds = models.JSONField(
+      null=True, help_text='The seconds each LLM stage took, by stage')
+  error = models.TextField(null=True, help_text='Why the job failed')
+  created_at = models.DateTimeField(
+      auto_now_add=True, help_text='When the job was submitted')
+  started_at = models.DateTimeField(
+      null=True, help_text='When a worker last started the job')
+  finished_at = models.DateTimeField(null=True, help_text='When the job finished')
 
   def __str__(self) -> str:
-    return f"Name: {self.name}, Day: {self.day} ({DayOfWeek(self.day.weekday()).name}), City: {self.city}, State: {self.state}, Foot Traffic: {self.ft}"
+    return f"{self.id} ({self.status}): {self.query}"
 
   class Meta:
-    unique_together = ('day', 'shopping_center_id')
+    indexes = [
+        # Workers claim the oldest queued jobs
+        models.Index(fields=['status', 'created_at'], name='analysisjob_status_created_idx'),
+    ]
+    constraints = [
+        # At most one identical job is queued or running at a time
+        models.UniqueConstraint(
+            fields=['dedupe_key'],
+            condition=models.Q(status__in=[JobStatus.QUEUED.value, JobStatus.RUNNING.value]),
+            name='analysisjob_inflight_dedupe_uniq'),
+    ]
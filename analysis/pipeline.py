@@ -0,0 +1,1246 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+import functools
+import hashlib
+import logging
+import threading
+import time
+from typing import AsyncIterator
+import warnings
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.db.models import Q
+
+from langchain.output_parsers import XMLOutputParser
+from langchain.prompts import PromptTemplate
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.output_parsers.string import StrOutputParser
+from langchain_core.runnables import Runnable
+import numpy as np
+import pandas as pd
+
+from .utils.analysis import (
+    django_weekday_to_str,
+    iso_to_gregorian
+)
+from .utils import anomalies, instrumentation
+from .utils.columnar import load_matrix, load_series
+from .utils.comparison import (
+    ComparisonQuery, TrafficMatrix, parse_comparison, peer_ranks, peer_z_scores,
+    state_code)
+from .utils.data_version import get_data_version
+from .utils.enums import LLMChoice
+from .utils.llm_cache import ainvoke_cached, astream_cached, invoke_cached
+from .utils.llms import (
+    get_llm, get_model_name, get_prompt_token_budget, get_stage_llm_choice,
+    llm_deadline)
+from .utils.metrics import TrafficSeries
+from .utils.prompt_data import count_tokens, format_series
+from .utils.geo import get_geo_index
+from .utils.resolver import CenterMatch, get_center_index
+from .utils.rollups import CenterRollups
+from .utils.single_flight import SingleFlight
+
+from .models import CenterReport, ShoppingCenter
+
+from . import prompts
+
+
+logger = logging.getLogger(__name__)
+
+# Shared by all requests in this process to run independent LLM stages
+# concurrently without spawning unbounded threads
+_llm_stage_executor = ThreadPoolExecutor(
+    max_workers=settings.LLM_STAGE_MAX_WORKERS, thread_name_prefix='llm-stage')
+# Runs the blocking work of async views, like the database queries of a
+# streamed analysis or a whole analysis for the form, so it does not hold the
+# one thread each process runs thread-sensitive synchronous code on
+_blocking_executor = ThreadPoolExecutor(
+    max_workers=settings.ANALYSIS_BLOCKING_MAX_WORKERS,
+    thread_name_prefix='analysis-blocking')
+
+# Coalesces concurrent analyses of the same center, model and data
+_analysis_flight = SingleFlight('analysis')
+
+# How often the local entity extractor was confident enough to skip the
+# filtering LLM call in this process
+_fast_path_stats = {'hits': 0, 'misses': 0}
+_fast_path_lock = threading.Lock()
+
+
+class AnalysisResult:
+  def __init__(self, response: str, monthly_averages: pd.Series = None,
+               stage_seconds: dict = None):
+    self.response = response
+    self.monthly_averages = monthly_averages
+    # The seconds each LLM stage that ran took, by stage
+    self.stage_seconds = stage_seconds or {}
+
+
+class AnalysisError(Exception):
+  '''
+  Raised by a pipeline stage when the analysis cannot continue. The message is
+  shown to the user as the analysis response.
+  '''
+
+
+class AmbiguousCenterError(AnalysisError):
+  '''
+  Raised when the shopping center name matches centers in several cities and
+  no city was given.
+  '''
+
+  def __init__(self, message: str, matches: list):
+    super().__init__(message)
+    # The best matching center in each city
+    self.matches = matches
+
+
+class AnalysisInputs:
+  '''
+  The per-center data the LLM stages are prompted with, prepared from a single
+  query against the fact table.
+  '''
+
+  def __init__(self, trend_inputs: dict, anomaly_inputs: dict,
+               series: TrafficSeries, monthly_averages: pd.Series):
+    self.trend_inputs = trend_inputs
+    self.anomaly_inputs = anomaly_inputs
+    self.series = series
+    self.monthly_averages = monthly_averages
+
+  def insights_inputs(self, trend_summary: str, anomalies_summary: str) -> dict:
+    return {
+        "trend_summary": trend_summary,
+        "anomalies_summary": anomalies_summary,
+        "earliest_date": self.series.earliest_date.strftime("%b %d, %Y"),
+        "latest_date": self.series.latest_date.strftime("%b %d, %Y"),
+    }
+
+
+class ComparisonInputs:
+  '''
+  The compact summary of several shopping centers' statistics the comparison
+  stage is prompted with, prepared from a single query against the fact table.
+  '''
+
+  def __init__(self, summary: str, fingerprint: str):
+    self.summary = summary
+    self.fingerprint = fingerprint
+
+
+def filtering_chain(llm: BaseChatModel) -> Runnable:
+  parser = XMLOutputParser(tags=["result", "shopping_center", "city"])
+  filtering_prompt = PromptTemplate.from_template(
+      template=prompts.FILTERING_PROMPT,
+      partial_variables={
+          "format_instructions": parser.get_format_instructions()},
+  )
+  return filtering_prompt | llm | parser
+
+
+def trend_chain(llm: BaseChatModel) -> Runnable:
+  trend_analysis_prompt = PromptTemplate.from_template(
+      template=prompts.TREND_ANALYSIS_PROMPT,
+  )
+  return trend_analysis_prompt | llm | StrOutputParser()
+
+
+def anomaly_chain(llm: BaseChatModel) -> Runnable:
+  anomaly_detection_prompt = PromptTemplate.from_template(
+      template=prompts.ANOMALY_DETECTION_PROMPT,
+  )
+  return anomaly_detection_prompt | llm | StrOutputParser()
+
+
+def insights_chain(llm: BaseChatModel) -> Runnable:
+  insights_generation_prompt = PromptTemplate.from_template(
+      template=prompts.INSIGHTS_GENERATION_PROMPT,
+  )
+  return insights_generation_prompt | llm | StrOutputParser()
+
+
+def comparison_chain(llm: BaseChatModel) -> Runnable:
+  comparison_prompt = PromptTemplate.from_template(
+      template=prompts.COMPARISON_PROMPT,
+  )
+  return comparison_prompt | llm | StrOutputParser()
+
+
+def parse_entities(output: dict) -> tuple:
+  '''
+  Get the shopping center and city out of the filtering chain's output.
+
+  :param output: The parsed XML output of the filtering chain
+  :return: A tuple of the shopping center name and city, either may be None
+  '''
+  shopping_center = output.get("result", [{}])[0].get("shopping_center")
+  city = output.get("result", [{}, {}])[1].get("city")
+
+  logger.info(f"Shopping center: {shopping_center}, City: {city}")
+  return shopping_center, city
+
+
+@instrumentation.stage('extraction')
+def fast_extract_entities(query: str):
+  '''
+  Try to find the shopping center and city in the query by matching it against
+  the known names locally, skipping the filtering LLM call.
+
+  :param query: The user's query
+  :return: A tuple of the shopping center name and city, or None if the local
+           match is not confident enough and the LLM should be asked instead
+  '''
+  extracted = get_center_index().extract(query)
+  hit = (extracted.shopping_center is not None
+         and extracted.confidence >= settings.FAST_PATH_MIN_SCORE)
+
+  with _fast_path_lock:
+    _fast_path_stats['hits' if hit else 'misses'] += 1
+    hits, total = _fast_path_stats['hits'], sum(_fast_path_stats.values())
+  logger.info(f"Fast-path entity extraction {'hit' if hit else 'miss'} "
+              f"({extracted.shopping_center}, {extracted.city}, confidence "
+              f"{extracted.confidence:.1f}). Hit rate: {hits}/{total} "
+              f"({hits / total:.0%})")
+
+  if not hit:
+    return None
+  return extracted.shopping_center, extracted.city
+
+
+@instrumentation.stage('resolve')
+def resolve_center(shopping_center: str, city: str) -> CenterMatch:
+  '''
+  Fuzzy match an extracted shopping center name and city against the centers
+  in the database.
+
+  :param shopping_center: The shopping center name extracted from the query
+  :param city: The city extracted from the query, or None
+  :return: The best matching shopping center
+  :raises AnalysisError: If either cannot be matched, or the name matches
+                         centers in several cities and no city was given
+  '''
+  # Resolved names are shared by the workers until new data is loaded
+  key = _analysis_cache_key('resolve', shopping_center, city)
+  if (best := _analysis_cache().get(key)) is not None:
+    logger.info(f"Shopping center: {best.name}, City: {best.city} (cached)")
+    return best
+
+  index = get_center_index()
+
+  if city:
+    city_matches = index.match_cities(city)
+
+    # Print the ratio scores for each possible city exceeds MIN_RATIO
+    if city_matches:
+      logger.info("City Ratio Scores:")
+      for m in city_matches:
+        logger.info(f"{m[0]}: {m[1]}")
+
+      # Set city to the best match
+      city = city_matches[0][0]
+    else:
+      # If a city was extracted but does not match any in the database,
+      # short circuit and return an error message
+      logger.info("NO CITIES FOUND")
+      raise AnalysisError(
+          f"Could not recognize the city {city}. Please try again.")
+
+  if not shopping_center:
+    # If no shopping center was extracted, return an error message
+    raise AnalysisError(
+        "No shopping center could be extracted from the user query. Please try again.")
+
+  shopping_center_matches = index.search(shopping_center, city=city or None)
+
+  # Print the ratio scores for each possible shopping center that exceeds MIN_RATIO
+  if not shopping_center_matches:
+    logger.info("NO SHOPPING CENTERS FOUND")
+    if city:
+      raise AnalysisError(
+          f"No shopping center found with the name {shopping_center} "
+          f"in {city}. Please try again.")
+    else:
+      raise AnalysisError(
+          f"No shopping center found with the name {shopping_center}. Please try again.")
+
+  logger.info("Shopping Center Name Ratio Scores:")
+  for m in shopping_center_matches:
+    logger.info(f"{m.name} ({m.city}): {m.score}")
+
+  # Use the best match, unless its name belongs to centers in several cities
+  best = shopping_center_matches[0]
+  locations = {}
+  for m in shopping_center_matches:
+    if m.name == best.name:
+      locations.setdefault(m.city, m)
+  if len(locations) > 1:
+    # The caller may compare the locations instead of asking for the city
+    logger.info("WARNING: Multiple locations with the shopping center name "
+                f"found. ({', '.join(map(str, locations))})")
+    raise AmbiguousCenterError(
+        "Multiple locations with the shopping center name "
+        f"{best.name} found ({', '.join(map(str, locations))}). "
+        "Please specify the city.",
+        list(locations.values()),
+    )
+
+  logger.info(f"Shopping center: {best.name}, City: {best.city}")
+  _analysis_cache().set(key, best)
+  return best
+
+
+def prepare_inputs(center: CenterMatch, token_budget: int) -> AnalysisInputs:
+  '''
+  Load the foot traffic for a resolved shopping center and compute the
+  statistics the LLM stages are prompted with.
+
+  :param center: The resolved shopping center
+  :param token_budget: The maximum number of tokens of raw foot traffic data
+                       to include in a prompt
+  :return: The inputs for the trend, anomaly and insights stages
+  :raises AnalysisError: If there is no data for the center
+  '''
+  key = _analysis_cache_key('inputs', center.shopping_center_id, token_budget)
+  if (inputs := _analysis_cache().get(key)) is not None:
+    return inputs
+
+  with instrumentation.stage('db_fetch'):
+    state = ShoppingCenter.objects.filter(
+        pk=center.shopping_center_id).values_list('state', flat=True).first()
+    # This is the only read of the fact table, or of its columnar snapshot
+    # when it is current; every metric is computed from these rows
+    series = load_series(center.shopping_center_id, state)
+
+    # If no rows were returned, return an error now
+    if not len(series):
+      error_msg = f"No foot traffic data found for {
+          center.name}{' in ' + center.city if center.city else ''}."
+      raise AnalysisError(error_msg)
+
+    rollups = CenterRollups.load(center.shopping_center_id)
+
+  # The averages come from the precomputed rollups, falling back to the daily
+  # rows for a center whose rollups have not been built
+  inputs = _build_inputs(
+      f"{center.name}, {center.city}, {state}", series, rollups or series,
+      token_budget)
+  _analysis_cache().set(key, inputs)
+  return inputs
+
+
+@instrumentation.stage('metrics')
+def _build_inputs(label: str, series: TrafficSeries, aggregates,
+                  token_budget: int) -> AnalysisInputs:
+  '''
+  Compute the statistics the LLM stages are prompted with.
+
+  :param label: The shopping center's name and location
+  :param series: The center's daily foot traffic
+  :param aggregates: The center's CenterRollups, or the series itself
+  :param token_budget: The maximum number of tokens of raw foot traffic data
+                       to include in a prompt
+  '''
+  filtered_ft_str = format_series(series, label, token_budget)
+
+  logger.info(
+      f"Foot traffic data ({count_tokens(filtered_ft_str)} tokens) starts with:\n\n{'\n'.join(filtered_ft_str.split('\n')[:5])}\n\n")
+
+  # Collect some mathematical data to augment prompts
+  ft_mean = aggregates.mean
+  ft_median = series.median
+  ft_stddev = aggregates.stddev
+
+  logger.info(f"Mean: {ft_mean}, Median: {ft_median}, "
+              f"StdDev: {ft_stddev}\n")
+
+  # Calculate monthly averages
+  monthly_averages = aggregates.monthly_averages()
+  monthly_averages_str = '\n'.join(
+      f"{idx.strftime('%B %Y')} {val:.1f}" for idx, val in monthly_averages.items()
+  )
+  logger.info(f"Daily averages by month:\n{monthly_averages_str}\n")
+
+  # Calculate weekly averages
+  weekly_averages = aggregates.weekly_averages()
+  weekly_averages_str = '\n'.join(
+      f"Week of {iso_to_gregorian(week['year'], week['week']).strftime('%B %d, %Y')}: {
+          week['avg_ft']:.1f}"
+      for week in weekly_averages
+  )
+  logger.info(f"Weekly averages:\n{weekly_averages_str}\n")
+
+  # Calculate day of the week averages
+  day_of_week_averages = aggregates.day_of_week_averages()
+  day_of_week_averages_str = '\n'.join(
+      f"{django_weekday_to_str(weekday)}: {avg_ft:.1f}"
+      for weekday, avg_ft in day_of_week_averages.items()
+  )
+  logger.info(f"Day of the week averages:\n{day_of_week_averages_str}\n")
+
+  # Find the anomalous days against a baseline that follows the center's
+  # recent level and day-of-week pattern, so ordinary weekends and holiday
+  # seasons are not flagged
+  days, ft, weekday = anomalies.calendar(series.days, series.ft)
+  daily_scores = anomalies.score(
+      ft, settings.ANOMALY_METHOD, settings.ANOMALY_WINDOW, weekday)
+  daily_anomalies = anomalies.find_anomalies(
+      days, ft, daily_scores, settings.ANOMALY_THRESHOLD,
+      settings.ANOMALY_MAX_REPORTED)
+  daily_anomalies_str = '\n'.join(
+      anomalies.describe_anomaly(
+          anomaly, anomaly.label.item().strftime('%B %d, %Y (%A)'))
+      for anomaly in daily_anomalies
+  )
+  logger.info(f"Daily Anomalies:\n{daily_anomalies_str}\n")
+
+  # Weekly averages have no day-of-week pattern to remove
+  week_starts = [iso_to_gregorian(week['year'], week['week'])
+                 for week in weekly_averages]
+  week_ft = np.array([week['avg_ft'] for week in weekly_averages], dtype=np.float64)
+  weekly_method = ('rolling' if settings.ANOMALY_METHOD == 'seasonal'
+                   else settings.ANOMALY_METHOD)
+  weekly_scores = anomalies.score(
+      week_ft, weekly_method, settings.ANOMALY_WEEKLY_WINDOW)
+  weekly_anomalies = anomalies.find_anomalies(
+      week_starts, week_ft, weekly_scores, settings.ANOMALY_THRESHOLD,
+      settings.ANOMALY_MAX_REPORTED)
+  weekly_anomalies_str = '\n'.join(
+      anomalies.describe_anomaly(
+          anomaly, f"Week of {anomaly.label.strftime('%B %d, %Y')}")
+      for anomaly in weekly_anomalies
+  )
+  logger.info(f"Weekly Anomalies:\n{weekly_anomalies_str}\n")
+
+  return AnalysisInputs(
+      trend_inputs={
+          "data_str": filtered_ft_str,
+          "ft_mean": ft_mean,
+          "ft_median": ft_median,
+          "ft_stddev": ft_stddev,
+          "monthly_averages": monthly_averages_str,
+          "weekly_averages": weekly_averages_str,
+          "day_of_week_averages": day_of_week_averages_str,
+      },
+      # The anomalies are found here, so the anomaly stage is not given the
+      # raw data to find them in
+      anomaly_inputs={
+          "ft_mean": ft_mean,
+          "ft_median": ft_median,
+          "ft_stddev": ft_stddev,
+          "monthly_averages": monthly_averages_str,
+          "daily_anomalies": daily_anomalies_str,
+          "weekly_anomalies": weekly_anomalies_str,
+      },
+      series=series,
+      monthly_averages=monthly_averages,
+  )
+
+
+# Separators that may be part of a shopping center's name, like "Barnes &
+# Noble Plaza", rather than separate two names
+_NAME_SEPARATORS = {'&', 'and'}
+
+
+def find_comparison(query: str) -> tuple:
+  '''
+  Recognize a query asking to compare shopping centers. A query listing names,
+  like "compare Dolphin Mall with Skyview Plaza", only compares them if at
+  least two of the names resolve to different centers, so "compare Dolphin
+  Mall with last year" is analyzed as a query about Dolphin Mall. Likewise a
+  query about the centers near another only compares them if that one is
+  recognized, so "how did Orlando Premium Outlets do around Christmas" is
+  analyzed as a query about Orlando Premium Outlets.
+
+  :param query: The user's query
+  :return: A tuple of the ComparisonQuery and the centers it names, if they
+           were resolved, or (None, None) if the query is about a single center
+  '''
+  comparison = parse_comparison(query)
+  if comparison is not None and comparison.near is not None:
+    extracted = get_center_index().extract(comparison.near)
+    if (extracted.shopping_center is None
+        or extracted.confidence < settings.FAST_PATH_MIN_SCORE):
+      logger.info(f"\"{comparison.near}\" does not name a shopping center "
+                  "to find the neighbors of")
+      return None, None
+    return comparison, None
+  if comparison is None or not comparison.names:
+    return comparison, None
+  matches = resolve_compared_centers(comparison)
+  if matches is None:
+    return None, None
+  return comparison, matches
+
+
+def resolve_compared_centers(comparison: ComparisonQuery) -> list | None:
+  '''
+  Resolve the centers a comparison query names. Consecutive names are joined
+  back together where they make up the name of a single center.
+
+  :param comparison: The parsed comparison query
+  :return: The compared centers, with every location of a center named
+           without its city, or None if fewer than two of the names resolve to
+           different centers
+  '''
+  index = get_center_index()
+  names, separators = comparison.names, comparison.separators
+  matches = {}
+  resolved = 0
+  start = 0
+  while start < len(names):
+    # The longest run of names that matches a center's name as a whole, like
+    # "Barnes" and "Noble Plaza"
+    end = start + 1
+    for stop in range(len(names), start + 1, -1):
+      if all(separator in _NAME_SEPARATORS for separator in separators[start:stop - 1]):
+        best = index.search(_join_names(names, separators, start, stop), limit=1)
+        if best and best[0].score >= settings.FAST_PATH_MIN_SCORE:
+          end = stop
+          break
+    text = _join_names(names, separators, start, end)
+    start = end
+
+    extracted = index.extract(text)
+    if (extracted.shopping_center is None
+        or extracted.confidence < settings.FAST_PATH_MIN_SCORE):
+      logger.info(f"\"{text}\" does not name a shopping center to compare")
+      continue
+    try:
+      found = [resolve_center(extracted.shopping_center, extracted.city)]
+    except AmbiguousCenterError as e:
+      # Compare every location of a center named without its city
+      found = e.matches
+    except AnalysisError as e:
+      logger.info(f"\"{text}\" does not name a shopping center to compare: {e}")
+      continue
+    resolved += 1
+    for match in found:
+      matches.setdefault(match.shopping_center_id, match)
+
+  if resolved < 2 or len(matches) < 2:
+    return None
+  return list(matches.values())
+
+
+def _join_names(names: tuple, separators: tuple, start: int, stop: int) -> str:
+  text = names[start]
+  for i in range(start + 1, stop):
+    text = f"{text} {separators[i - 1]} {names[i]}"
+  return text
+
+
+def prepare_comparison(comparison: ComparisonQuery,
+                       matches: list = None) -> ComparisonInputs:
+  '''
+  Load the foot traffic of the compared shopping centers and their peers, the
+  other centers in their states, and compute the statistics the comparison
+  stage is prompted with.
+
+  :param comparison: The parsed comparison query
+  :param matches: The compared centers, if already resolved
+  :return: The inputs for the comparison stage
+  :raises AnalysisError: If a center or the place cannot be recognized, or
+                         there is no data for the centers
+  '''
+  description = None
+  anchor = None
+  distances = None
+  limit = settings.COMPARISON_MAX_CENTERS
+  if comparison.near is not None:
+    anchor, neighbors, description = find_neighbors(comparison)
+    matches = [CenterMatch(n.shopping_center_id, n.name, n.city, 100)
+               for n in neighbors]
+    distances = {n.shopping_center_id: n.miles for n in neighbors}
+  elif matches is None and comparison.names:
+    matches = resolve_compared_centers(comparison)
+    if matches is None:
+      raise AnalysisError("Could not recognize the shopping centers to compare. "
+                          "Please try again.")
+
+  with instrumentation.stage('db_fetch'):
+    if matches:
+      selected = ShoppingCenter.objects.filter(
+          pk__in=[m.shopping_center_id for m in matches])
+    else:
+      place = comparison.place
+      if state := state_code(place):
+        selected = ShoppingCenter.objects.filter(state=state)
+        description = f"in {state}"
+      else:
+        city_matches = get_center_index().match_cities(place)
+        if not city_matches:
+          raise AnalysisError(f"Could not recognize the place {place}. "
+                              "Please try again.")
+        selected = ShoppingCenter.objects.filter(city=city_matches[0][0])
+        description = f"in {city_matches[0][0]}"
+      limit = min(comparison.limit or settings.COMPARISON_DEFAULT_LIMIT, limit)
+
+    selected_states = dict(selected.values_list('shopping_center_id', 'state'))
+    selected_ids = set(selected_states)
+    states = set(selected_states.values())
+    # Each center is compared to its peers, every center in its state. This
+    # is the only read of the fact table, or of its columnar snapshot.
+    matrix = load_matrix(states - {None}, {
+        shopping_center_id for shopping_center_id, state in selected_states.items()
+        if state is None})
+    centers = {
+        shopping_center_id: (name, city, state)
+        for shopping_center_id, name, city, state in ShoppingCenter.objects.filter(
+            Q(state__in=states - {None}) | Q(pk__in=selected_ids)
+        ).values_list('shopping_center_id', 'name', 'city', 'state')
+    }
+
+  if not selected_ids & set(matrix.center_ids):
+    raise AnalysisError("No foot traffic data found for the shopping centers "
+                        "to compare.")
+  return _build_comparison(comparison, matrix, centers, selected_ids, limit,
+                           description, distances, anchor)
+
+
+@instrumentation.stage('geo')
+def find_neighbors(comparison: ComparisonQuery) -> tuple:
+  '''
+  Find the shopping centers near the center a comparison query names.
+
+  :param comparison: The parsed comparison query
+  :return: A tuple of the named center's CenterMatch, the GeoMatch of each
+           center near it, including itself, and a description of them
+  :raises AnalysisError: If the center cannot be resolved or has no location
+  '''
+  extracted = get_center_index().extract(comparison.near)
+  anchor = resolve_center(extracted.shopping_center, extracted.city)
+  index = get_geo_index()
+  position = index.position(anchor.shopping_center_id)
+  if position is None:
+    raise AnalysisError(f"The location of {anchor.name} is not known, so its "
+                        "neighbors cannot be found.")
+
+  if comparison.nearest:
+    k = min(comparison.limit or settings.COMPARISON_DEFAULT_LIMIT,
+            settings.COMPARISON_MAX_CENTERS - 1)
+    # The center itself is the nearest one
+    neighbors = index.nearest(*position, k + 1)
+    description = f"nearest to {anchor.name}"
+  else:
+    miles = comparison.radius_miles or settings.GEO_DEFAULT_RADIUS_MILES
+    neighbors = index.within(*position, miles, limit=settings.COMPARISON_MAX_CENTERS)
+    description = f"within {miles:g} miles of {anchor.name}"
+  logger.info(f"Found {len(neighbors) - 1} centers {description}")
+  return anchor, neighbors, description
+
+
+@instrumentation.stage('metrics')
+def _build_comparison(comparison: ComparisonQuery, matrix: TrafficMatrix,
+                      centers: dict, selected_ids: set, limit: int,
+                      description: str = None, distances: dict = None,
+                      anchor: CenterMatch = None) -> ComparisonInputs:
+  '''
+  Compute the comparison statistics of every center in the matrix at once,
+  and summarize those of the selected centers.
+
+  :param comparison: The parsed comparison query
+  :param matrix: The foot traffic of the selected centers and their peers
+  :param centers: The (name, city, state) of each center, by identifier
+  :param selected_ids: The identifiers of the centers to compare
+  :param limit: The most centers to list
+  :param description: How the centers were selected, like "in FL", if they
+                      were not named
+  :param distances: The miles from the anchor to each center, if the centers
+                    are the anchor's neighbors
+  :param anchor: The center whose neighbors are compared
+  '''
+  window = settings.COMPARISON_WINDOW
+  traffic = matrix.recent_means(window)
+  growth, growth_basis = matrix.growth_rates(window)
+  anomaly_counts = matrix.anomaly_counts(
+      window, settings.ANOMALY_THRESHOLD, settings.ANOMALY_METHOD,
+      settings.ANOMALY_WINDOW)
+
+  # Peer groups are states
+  states = np.array([centers[c][2] or '' for c in matrix.center_ids])
+  state_names, groups = np.unique(states, return_inverse=True)
+  group_sizes = np.bincount(groups, minlength=len(state_names))
+  traffic_z = peer_z_scores(traffic, groups)
+  traffic_ranks = peer_ranks(traffic, groups)
+  growth_z = peer_z_scores(growth, groups)
+  growth_ranks = peer_ranks(growth, groups)
+
+  # The selected centers ordered by the metric, with the centers that have
+  # no recent data last
+  values = growth if comparison.metric == 'growth' else traffic
+  rows = np.array([i for i, c in enumerate(matrix.center_ids) if c in selected_ids])
+  sort_key = values[rows] if comparison.ascending else -values[rows]
+  rows = rows[np.argsort(np.where(np.isnan(sort_key), np.inf, sort_key),
+                         kind='stable')]
+  listed = rows[:limit]
+
+  last_day = matrix.days[-1].item()
+  lines = [
+      f"Comparison of {len(rows)} shopping center{'' if len(rows) == 1 else 's'}"
+      f"{' ' + description if description else ''} by "
+      f"{'growth' if comparison.metric == 'growth' else 'foot traffic'}"
+      f"{f', {len(listed)} listed' if len(listed) < len(rows) else ''}, "
+      f"{'lowest' if comparison.ascending else 'highest'} first.",
+      f"Foot traffic is the mean daily count over the {window} days through "
+      f"{last_day.strftime('%B %d, %Y')}, and growth is {growth_basis}.",
+      "Each center's peers are the centers in its state, and its peer score is "
+      "how far above (positive) or below (negative) its peers it is, in "
+      "standard deviations.",
+      "",
+  ]
+  for group in np.unique(groups[listed]):
+    in_group = groups == group
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning)
+      median_traffic = np.nanmedian(traffic[in_group])
+      median_growth = np.nanmedian(growth[in_group])
+    lines.append(
+        f"{state_names[group] or 'Unknown state'}: {group_sizes[group]} "
+        f"center{'s' if group_sizes[group] != 1 else ''}, "
+        f"median foot traffic {median_traffic:.0f}, median growth "
+        f"{median_growth:+.1%}")
+  lines.append("")
+
+  def standing(rank: int, size: int, z_score: float) -> str:
+    # A center without peers has no peer score
+    if np.isnan(z_score):
+      return f"rank {rank} of {size}"
+    return f"rank {rank} of {size}, peer score {z_score:+.1f}"
+
+  for position, i in enumerate(listed, 1):
+    name, city, state = centers[matrix.center_ids[i]]
+    size = group_sizes[groups[i]]
+    line = f"{position}. {name} ({', '.join(filter(None, (city, state)))}): "
+    if np.isnan(traffic[i]):
+      line += "no foot traffic data in this period"
+    else:
+      line += (f"foot traffic {traffic[i]:.0f} "
+               f"({standing(traffic_ranks[i], size, traffic_z[i])})")
+      if not np.isnan(growth[i]):
+        line += (f", growth {growth[i]:+.1%} "
+                 f"({standing(growth_ranks[i], size, growth_z[i])})")
+      line += f", {anomaly_counts[i]} anomalous days"
+    center_id = matrix.center_ids[i]
+    if anchor is not None and center_id == anchor.shopping_center_id:
+      line += " (the center asked about)"
+    elif distances is not None:
+      line += f", {distances[center_id]:.1f} miles away"
+    lines.append(line)
+
+  summary = '\n'.join(lines)
+  logger.info(f"Comparison summary ({count_tokens(summary)} tokens):\n{summary}\n")
+  return ComparisonInputs(summary, matrix.fingerprint())
+
+
+def run_comparison(query: str, llm_choice: LLMChoice, inputs: ComparisonInputs,
+                   timings: dict = None, deadline: float = None) -> str:
+  '''
+  Run the comparison stage for prepared comparison inputs.
+
+  :param query: The user's query
+  :param llm_choice: The user's choice of language model
+  :param inputs: The inputs returned by prepare_comparison()
+  :param timings: A dictionary the seconds the stage took are added to
+  :param deadline: The time.monotonic() value by which the whole analysis
+                   must finish, if any
+  :return: The comparison text
+  :raises AnalysisError: If the stage takes too long to respond
+  '''
+  llm = stage_llm('comparison', llm_choice)
+  start = time.monotonic()
+  stage_deadline = _stage_deadline(deadline)
+  future = _submit_stage(
+      _run_stage, 'comparison', comparison_chain(llm), llm,
+      {"query": query, "summary": inputs.summary}, inputs.fingerprint, timings,
+      stage_deadline)
+  try:
+    output = _wait_for_stage(future, stage_deadline)
+  except TimeoutError:
+    logger.warning("The comparison stage timed out after "
+                   f"{time.monotonic() - start:.0f} seconds")
+    raise AnalysisError(
+        "The comparison took too long to respond. Please try again.")
+  logger.info(f"Output of comparison chain is:\n\n{output}\n\n")
+  return output
+
+
+def run_analysis(query: str, llm_choice: LLMChoice = LLMChoice.CHATGPT45) -> AnalysisResult:
+  timings = {}
+  # Every stage must also finish within what is left of the whole analysis's
+  # time, so the request is answered before gunicorn kills its worker
+  deadline = time.monotonic() + settings.ANALYSIS_TIMEOUT
+
+  try:
+    # Queries about several centers are answered from their compared
+    # statistics instead
+    comparison, matches = find_comparison(query)
+    if comparison is not None:
+      output = run_comparison(
+          query, llm_choice, prepare_comparison(comparison, matches), timings,
+          deadline)
+      return AnalysisResult(output, stage_seconds=timings)
+
+    # *** Filtering ***
+    entities = fast_extract_entities(query)
+    if entities is None:
+      llm = stage_llm('filtering', llm_choice)
+      start = time.monotonic()
+      stage_deadline = _stage_deadline(deadline)
+      future = _submit_stage(_run_stage, 'filtering', filtering_chain(llm), llm,
+                             {"query": query}, '', timings, stage_deadline)
+      try:
+        output = _wait_for_stage(future, stage_deadline)
+      except TimeoutError:
+        logger.warning("The filtering stage timed out after "
+                       f"{time.monotonic() - start:.0f} seconds")
+        raise AnalysisError("The shopping center lookup took too long to "
+                            "respond. Please try again.")
+      entities = parse_entities(output)
+    try:
+      center = resolve_center(*entities)
+    except AmbiguousCenterError as e:
+      # Compare the center's locations rather than ask which one was meant
+      output = run_comparison(
+          query, llm_choice,
+          prepare_comparison(ComparisonQuery(), e.matches), timings, deadline)
+      return AnalysisResult(output, stage_seconds=timings)
+
+    # Concurrent analyses of the same center share one computation
+    result, shared = _analysis_flight.do(
+        f"{center.shopping_center_id}\0{llm_choice.value}\0{get_data_version()}",
+        lambda: analyze_center(center, llm_choice, deadline))
+  except AnalysisError as e:
+    return AnalysisResult(str(e))
+
+  if shared:
+    logger.info(f"Shared the concurrent analysis of {center.name}")
+    return AnalysisResult(result.response, result.monthly_averages, timings)
+  return AnalysisResult(result.response, result.monthly_averages,
+                        {**timings, **result.stage_seconds})
+
+
+def analyze_center(center: CenterMatch, llm_choice: LLMChoice,
+                   deadline: float = None) -> AnalysisResult:
+  '''
+  Analyze a resolved shopping center.
+
+  :param center: The resolved shopping center
+  :param llm_choice: The user's choice of language model
+  :param deadline: The time.monotonic() value by which the whole analysis
+                   must finish, if any
+  :return: The AnalysisResult
+  :raises AnalysisError: If the analysis cannot be completed
+  '''
+  timings = {}
+  inputs = prepare_inputs(center, data_token_budget(llm_choice))
+
+  # Serve the report pre-generated by the analyze_centers command if it was
+  # generated from the same data
+  output = find_report(center, llm_choice, inputs.series.fingerprint())
+  if output is None:
+    output = generate_insights(llm_choice, inputs, timings, deadline)
+  return AnalysisResult(output, inputs.monthly_averages, timings)
+
+
+def generate_insights(llm_choice: LLMChoice, inputs: AnalysisInputs,
+                      timings: dict = None, deadline: float = None) -> str:
+  '''
+  Run the trend analysis, anomaly detection and insights generation stages for
+  a shopping center's prepared inputs.
+
+  :param llm_choice: The user's choice of language model, which each stage's
+                     model is routed from
+  :param inputs: The inputs returned by prepare_inputs()
+  :param timings: A dictionary the seconds each stage took are added to
+  :param deadline: The time.monotonic() value by which the whole analysis
+                   must finish, if any
+  :return: The insights text
+  :raises AnalysisError: If a stage takes too long to respond
+  '''
+  # *** Trend Analysis and Anomaly Detection ***
+  # Neither chain depends on the other, so they run concurrently and only the
+  # insights chain waits for both.
+  fingerprint = inputs.series.fingerprint()
+  trend_llm = stage_llm('trend', llm_choice)
+  anomaly_llm = stage_llm('anomaly', llm_choice)
+  # Both stages start at the same time, so they share one deadline
+  start = time.monotonic()
+  stage_deadline = _stage_deadline(deadline)
+  trend_future = _submit_stage(
+      _run_stage, 'trend', trend_chain(trend_llm), trend_llm,
+      inputs.trend_inputs, fingerprint, timings, stage_deadline)
+  anomaly_future = _submit_stage(
+      _run_stage, 'anomaly', anomaly_chain(anomaly_llm), anomaly_llm,
+      inputs.anomaly_inputs, fingerprint, timings, stage_deadline)
+
+  try:
+    trend_summary = _wait_for_stage(trend_future, stage_deadline)
+    logger.info(f"Output of trend analysis chain is\n\n{trend_summary}\n\n")
+    anomalies_summary = _wait_for_stage(anomaly_future, stage_deadline)
+    logger.info(f"Output of anomaly detection chain is:\n\n{
+                anomalies_summary}\n\n")
+  except TimeoutError:
+    stage = 'trend analysis' if not trend_future.done() else 'anomaly detection'
+    trend_future.cancel()
+    anomaly_future.cancel()
+    logger.warning(f"The {stage} stage timed out after "
+                   f"{time.monotonic() - start:.0f} seconds")
+    raise AnalysisError(
+        f"The {stage} took too long to respond. Please try again.")
+
+  # *** Insights Generation ***
+  insights_llm = stage_llm('insights', llm_choice)
+  start = time.monotonic()
+  stage_deadline = _stage_deadline(deadline)
+  insights_future = _submit_stage(
+      _run_stage, 'insights', insights_chain(insights_llm), insights_llm,
+      inputs.insights_inputs(trend_summary, anomalies_summary), fingerprint,
+      timings, stage_deadline)
+  try:
+    output = _wait_for_stage(insights_future, stage_deadline)
+  except TimeoutError:
+    logger.warning("The insights generation stage timed out after "
+                   f"{time.monotonic() - start:.0f} seconds")
+    raise AnalysisError(
+        "The insights generation took too long to respond. Please try again.")
+  logger.info(f"Output of insights generation chain is:\n\n{output}\n\n")
+
+  return output
+
+
+def stage_llm(stage: str, llm_choice: LLMChoice) -> BaseChatModel:
+  '''
+  Get the language model that runs a pipeline stage for the user's choice of
+  model, as routed by the LLM_STAGE_MODELS setting.
+  '''
+  return get_llm(get_stage_llm_choice(stage, llm_choice))
+
+
+def data_token_budget(llm_choice: LLMChoice) -> int:
+  '''
+  The maximum number of tokens of raw foot traffic data to put in the trend
+  analysis prompt, the only one given it, for the user's choice of model.
+  '''
+  return get_prompt_token_budget(get_stage_llm_choice('trend', llm_choice))
+
+
+def stage_latency() -> dict:
+  '''
+  Get the latency of the LLM stages run by this process so far, to tune the
+  LLM_STAGE_MODELS routing with. Responses served from the LLM cache are
+  included.
+
+  :return: A dictionary keyed by (stage, model name) tuples, with ``count``
+           and ``mean`` seconds values
+  '''
+  return {
+      key: {'count': count, 'mean': total / count}
+      for key, (count, total) in instrumentation.LLM_STAGE_SECONDS.totals().items()
+  }
+
+
+def _record_llm_stage(stage: str, chain: Runnable, llm: BaseChatModel,
+                      inputs: dict, output, seconds: float,
+                      timings: dict = None) -> None:
+  if timings is not None:
+    timings[stage] = seconds
+  model = get_model_name(llm)
+  instrumentation.LLM_STAGE_SECONDS.observe(seconds, stage=stage, model=model)
+  # Every provider's tokens are estimated the same way, including for cached
+  # responses, which cost nothing
+  instrumentation.LLM_TOKENS.inc(
+      count_tokens(chain.first.format(**inputs)), stage=stage, model=model,
+      kind='prompt')
+  instrumentation.LLM_TOKENS.inc(
+      count_tokens(str(output)), stage=stage, model=model, kind='completion')
+
+  count, total = instrumentation.LLM_STAGE_SECONDS.totals()[(stage, model)]
+  logger.info(f"The {stage} stage took {seconds:.2f}s on {model} (mean "
+              f"{total / count:.2f}s over {count} runs)")
+
+
+def _run_stage(stage: str, chain: Runnable, llm: BaseChatModel, inputs: dict,
+               fingerprint: str = '', timings: dict = None, deadline: float = None):
+  # Past the deadline the caller has given up on the stage, and its provider
+  # requests fail instead of holding this executor thread
+  with instrumentation.stage(f"llm_{stage}", count_queries=False):
+    start = time.perf_counter()
+    with llm_deadline(deadline):
+      output = invoke_cached(chain, llm, inputs, fingerprint)
+    _record_llm_stage(stage, chain, llm, inputs, output,
+                      time.perf_counter() - start, timings)
+  return output
+
+
+async def _arun_stage(stage: str, chain: Runnable, llm: BaseChatModel,
+                      inputs: dict, fingerprint: str = '', timings: dict = None):
+  with instrumentation.stage(f"llm_{stage}", count_queries=False):
+    start = time.perf_counter()
+    output = await ainvoke_cached(chain, llm, inputs, fingerprint)
+    _record_llm_stage(stage, chain, llm, inputs, output,
+                      time.perf_counter() - start, timings)
+  return output
+
+
+@instrumentation.stage('report_lookup')
+def find_report(center: CenterMatch, llm_choice: LLMChoice, fingerprint: str) -> str | None:
+  '''
+  Find the pre-generated report for a shopping center.
+
+  :param center: The resolved shopping center
+  :param llm_choice: The language model the report must have been generated by
+  :param fingerprint: The fingerprint of the center's current foot traffic
+  :return: The report's insights text, or None if there is no report generated
+           from the current data
+  '''
+  report = CenterReport.objects.filter(
+      center_id=center.shopping_center_id, llm_choice=llm_choice.value,
+      fingerprint=fingerprint).values_list('response', flat=True).first()
+  if report is not None:
+    logger.info(f"Serving the pre-generated report for {center.name}")
+  return report
+
+
+async def astream_analysis(query: str, llm_choice: LLMChoice = LLMChoice.CHATGPT45) -> AsyncIterator[tuple]:
+  '''
+  Run the analysis pipeline without blocking the event loop, streaming the
+  insights text as the LLM generates it.
+
+  Yields ``(event, data)`` tuples:
+    - ``('status', {'message': ...})`` as each stage starts
+    - ``('chart', {'labels': [...], 'data': [...]})`` once the data is loaded,
+      unless the query compares several centers
+    - ``('token', {'text': ...})`` for each chunk of the insights text
+    - ``('error', {'message': ...})`` if the analysis cannot continue
+    - ``('done', {'response': ..., 'stage_seconds': {...}})`` with the full
+      insights text and the seconds each LLM stage took
+
+  :param query: The user's query
+  :param llm_choice: The user's choice of language model
+  '''
+  timings = {}
+  # As in run_analysis(), every stage must also finish within what is left of
+  # the whole analysis's time
+  deadline = time.monotonic() + settings.ANALYSIS_TIMEOUT
+
+  try:
+    comparison, matches = await run_blocking(find_comparison, query)
+    if comparison is None:
+      yield 'status', {'message': 'Finding the shopping center...'}
+      entities = await run_blocking(fast_extract_entities, query)
+      if entities is None:
+        llm = stage_llm('filtering', llm_choice)
+        output = await asyncio.wait_for(
+            _arun_stage('filtering', filtering_chain(llm), llm,
+                        {"query": query}, timings=timings),
+            _stage_deadline(deadline) - time.monotonic())
+        entities = parse_entities(output)
+      try:
+        center = await run_blocking(resolve_center, *entities)
+      except AmbiguousCenterError as e:
+        # Compare the center's locations rather than ask which one was meant
+        comparison, matches = ComparisonQuery(), e.matches
+
+    if comparison is not None:
+      yield 'status', {'message': 'Comparing the shopping centers...'}
+      comparison_inputs = await run_blocking(
+          prepare_comparison, comparison, matches)
+    else:
+      inputs = await run_blocking(
+          prepare_inputs, center, data_token_budget(llm_choice))
+  except AnalysisError as e:
+    yield 'error', {'message': str(e)}
+    return
+  except TimeoutError:
+    yield 'error', {'message': 'The shopping center lookup took too long to '
+                    'respond. Please try again.'}
+    return
+
+  if comparison is not None:
+    llm = stage_llm('comparison', llm_choice)
+    async for event in _astream_stage(
+        'comparison', 'comparison', comparison_chain(llm), llm,
+        {"query": query, "summary": comparison_inputs.summary},
+        comparison_inputs.fingerprint, timings, deadline):
+      yield event
+    return
+
+  yield 'chart', chart_data(inputs.monthly_averages)
+
+  fingerprint = inputs.series.fingerprint()
+  report = await run_blocking(find_report, center, llm_choice, fingerprint)
+  if report is not None:
+    yield 'token', {'text': report}
+    yield 'done', {'response': report, 'stage_seconds': timings}
+    return
+
+  yield 'status', {'message': 'Analyzing trends and anomalies...'}
+  trend_llm = stage_llm('trend', llm_choice)
+  anomaly_llm = stage_llm('anomaly', llm_choice)
+  start = time.monotonic()
+  timeout = _stage_deadline(deadline) - start
+  trend_task = asyncio.ensure_future(asyncio.wait_for(
+      _arun_stage('trend', trend_chain(trend_llm), trend_llm,
+                  inputs.trend_inputs, fingerprint, timings),
+      timeout))
+  anomaly_task = asyncio.ensure_future(asyncio.wait_for(
+      _arun_stage('anomaly', anomaly_chain(anomaly_llm), anomaly_llm,
+                  inputs.anomaly_inputs, fingerprint, timings),
+      timeout))
+  try:
+    trend_summary, anomalies_summary = await asyncio.gather(
+        trend_task, anomaly_task)
+  except TimeoutError:
+    trend_timed_out = (trend_task.done() and not trend_task.cancelled()
+                       and isinstance(trend_task.exception(), TimeoutError))
+    stage = 'trend analysis' if trend_timed_out else 'anomaly detection'
+    trend_task.cancel()
+    anomaly_task.cancel()
+    logger.warning(f"The {stage} stage timed out after "
+                   f"{time.monotonic() - start:.0f} seconds")
+    yield 'error', {'message': f"The {stage} took too long to respond. "
+                    "Please try again."}
+    return
+  logger.info(f"Output of trend analysis chain is\n\n{trend_summary}\n\n")
+  logger.info(f"Output of anomaly detection chain is:\n\n{
+              anomalies_summary}\n\n")
+
+  yield 'status', {'message': 'Generating insights...'}
+  llm = stage_llm('insights', llm_choice)
+  async for event in _astream_stage(
+      'insights', 'insights generation', insights_chain(llm), llm,
+      inputs.insights_inputs(trend_summary, anomalies_summary), fingerprint,
+      timings, deadline):
+    yield event
+
+
+async def _astream_stage(stage: str, description: str, chain: Runnable,
+                         llm: BaseChatModel, inputs: dict, fingerprint: str,
+                         timings: dict, deadline: float) -> AsyncIterator[tuple]:
+  '''
+  Stream the output of the last LLM stage of an analysis as ``token`` events,
+  followed by a ``done`` event with the full text, or an ``error`` event if
+  the stage takes too long.
+
+  :param stage: The pipeline stage
+  :param description: The stage's name in messages to the user
+  :param deadline: The time.monotonic() value by which the whole analysis
+                   must finish
+  '''
+  timeout = _stage_deadline(deadline) - time.monotonic()
+  chunks = []
+  start = time.perf_counter()
+  try:
+    with instrumentation.stage(f"llm_{stage}", count_queries=False):
+      async with asyncio.timeout(timeout):
+        async for chunk in astream_cached(chain, llm, inputs, fingerprint):
+          chunks.append(chunk)
+          yield 'token', {'text': chunk}
+  except TimeoutError:
+    logger.warning(f"The {description} stage timed out after "
+                   f"{time.perf_counter() - start:.0f} seconds")
+    yield 'error', {'message': f"The {description} took too long to respond. "
+                    "Please try again."}
+    return
+  output = ''.join(chunks)
+  _record_llm_stage(stage, chain, llm, inputs, output,
+                    time.perf_counter() - start, timings)
+  logger.info(f"Output of {description} chain is:\n\n{output}\n\n")
+
+  yield 'done', {'response': output, 'stage_seconds': timings}
+
+
+def _analysis_cache():
+  return caches[settings.ANALYSIS_CACHE_ALIAS]
+
+
+def _analysis_cache_key(kind: str, *parts) -> str:
+  '''
+  The analysis cache key of something derived from the data, which changes
+  when new data is loaded.
+  '''
+  digest = hashlib.sha256(
+      '\0'.join(map(str, (*parts, get_data_version()))).encode()).hexdigest()
+  return f"{kind}:{digest}"
+
+
+def chart_data(monthly_averages: pd.Series) -> dict:
+  '''
+  The labels and values for the monthly averages chart.
+  '''
+  return {
+      'labels': list(monthly_averages.index.strftime('%Y-%m')),
+      'data': [None if pd.isna(val) else float(val)
+               for val in monthly_averages.values],
+  }
+
+
+async def run_blocking(fn, *args, **kwargs):
+  '''
+  Call a blocking function from async code on a thread of the blocking
+  executor, in a copy of the caller's context.
+
+  :return: The function's return value
+  '''
+  return await sync_to_async(
+      _with_connections(fn), thread_sensitive=False,
+      executor=_blocking_executor)(*args, **kwargs)
+
+
+def _with_connections(fn):
+  '''
+  Wrap a function run on one of this module's executors. Their threads live
+  as long as the process and do not go through Django's request cycle, which
+  would otherwise replace their expired or broken database connections.
+  '''
+  @functools.wraps(fn)
+  def run(*args, **kwargs):
+    close_old_connections()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      close_old_connections()
+  return run
+
+
+def _submit_stage(fn, *args) -> Future:
+  '''
+  Run a function on the stage executor in a copy of the caller's context, so
+  the stage is recorded in the caller's request trace. The stages read and
+  write the LLM cache in the database.
+  '''
+  return _llm_stage_executor.submit(
+      contextvars.copy_context().run, _with_connections(fn), *args)
+
+
+def _stage_deadline(deadline: float = None) -> float:
+  '''
+  The time.monotonic() value by which an LLM stage starting now must finish:
+  LLM_STAGE_TIMEOUT from now, or the whole analysis's deadline if sooner.
+
+  :param deadline: The time.monotonic() value by which the whole analysis
+                   must finish, if any
+  '''
+  stage_deadline = time.monotonic() + settings.LLM_STAGE_TIMEOUT
+  return stage_deadline if deadline is None else min(stage_deadline, deadline)
+
+
+def _wait_for_stage(future: Future, deadline: float):
+  '''
+  Wait for an LLM stage submitted to the stage executor to finish.
+
+  :param future: The future returned by submitting the stage's chain
+  :param deadline: The time.monotonic() value by which the stage must finish
+  :return: The output of the stage's chain
+  :raises TimeoutError: If the stage has not finished by the deadline
+  '''
+  return future.result(timeout=max(deadline - time.monotonic(), 0))
+
+
+def get_monthly_averages(filtered_ft) -> pd.Series:
+  return TrafficSeries.from_queryset(filtered_ft).monthly_averages()
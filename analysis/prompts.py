@@ -68,21 +68,20 @@ if the shopping center is in Florida, you might consider the impact of peak
 tourism season on foot traffic. Avoid mentioning advanced statistic
 metrics like standard deviations explicitly.
 
-The data to analyze is here:
-
-<data>
-{data_str}
-</data>
+The daily foot traffic averages by month, in ascending order of date, are:
+<monthly_averages>
+{monthly_averages}
+</monthly_averages>
 
-To help with your analysis, here are some days that are especially anomalous.
-Each of these must be mentioned in your analysis. Include days that are 
-both significantly above and below the mean.
+Here are the days that are especially anomalous, with the foot traffic that
+was expected for each. Each of these must be mentioned in your analysis.
+Include days that are both significantly above and below what was expected.
 
 <daily_anomalies>
 {daily_anomalies}
 </daily_anomalies>
 
-And here are some weekly anomalies:
+And here are the weeks whose average daily foot traffic was anomalous:
 <weekly_anomalies>
 {weekly_anomalies}
 </weekly_anomalies>
@@ -156,3 +155,22 @@ Anomalies Data:
 {anomalies_summary}
 </anomalies_summary>
 '''
+
+COMPARISON_PROMPT = '''
+A user asked the following question about the foot traffic of several
+shopping centers:
+{query}
+
+Answer the question by comparing the shopping centers using the statistics
+below, which were computed from their daily foot traffic. Highlight the
+centers that stand out from the others and from their peers, and point out
+notable growth or decline. Consider concrete and specific reasons related to
+holidays, seasonal cycles or the location. Avoid mentioning advanced statistic
+metrics like standard deviations or peer scores explicitly; describe how far
+a center is above or below its peers instead. Use Markdown to format your
+response nicely, with a table if it helps the comparison.
+
+<comparison>
+{summary}
+</comparison>
+'''
@@ -1,15 +1,46 @@
+import hashlib
+import threading
+
 from django import template
+from django.conf import settings
 import markdown as md
 from django.utils.safestring import SafeText, mark_safe
 
+from analysis.utils.instrumentation import stage
+from analysis.utils.tiered_cache import LRUCache
+
 register = template.Library()
 
+MARKDOWN_EXTENSIONS = ['mdx_truly_sane_lists', 'prependnewline']
+
+# Building a Markdown pipeline loads and registers its extensions, which costs
+# more than converting a response, so each thread builds one and reuses it
+_local = threading.local()
+# The HTML of recently rendered texts, by the digest of the text
+_rendered = LRUCache(settings.MARKDOWN_CACHE_SIZE)
+
+
+def _renderer() -> md.Markdown:
+  renderer = getattr(_local, 'renderer', None)
+  if renderer is None:
+    renderer = _local.renderer = md.Markdown(extensions=MARKDOWN_EXTENSIONS)
+  return renderer
+
+
+def render_markdown(text: str) -> str:
+  '''
+  Convert Markdown to HTML with this thread's pipeline, without the cache.
+  '''
+  # Resetting clears the state the previous conversion left, like references
+  return _renderer().reset().convert(text)
+
 
 @register.filter(name='markdown')
+@stage('markdown', count_queries=False)
 def markdown_format(text) -> SafeText:
-  return mark_safe(
-      md.markdown(
-          text,
-          extensions=['mdx_truly_sane_lists', 'prependnewline']
-      )
-  )
+  key = hashlib.sha256(str(text).encode()).digest()
+  html = _rendered.get(key)
+  if html is None:
+    html = render_markdown(str(text))
+    _rendered.set(key, html)
+  return mark_safe(html)
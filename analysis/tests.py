@@ -1,3 +1,474 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase, override_settings, skipUnlessDBFeature
+import numpy as np
+
+from . import pipeline
+from .management.commands.load_csv_data import Command as LoadCsvCommand
+from .models import (
+    DayOfWeekTraffic, FootTraffic, IngestedFile, IngestWatermark, MonthlyTraffic,
+    ShoppingCenter, WeeklyTraffic)
+from .utils import anomalies
+from .utils.comparison import parse_comparison, split_names
+from .utils.metrics import TrafficSeries
+from .utils.resolver import CenterIndex
+from .utils.rollups import CenterRollups, RollupDeltas
+from .utils.single_flight import SingleFlight
+
+# (shopping_center_id, name, city, state) of the centers the tests know
+CENTERS = [
+    ('c1', 'Skyview Plaza', 'Satellite Beach', 'FL'),
+    ('c2', 'Dolphin Mall', 'Miami', 'FL'),
+    ('c3', 'Dolphin Mall', 'Austin', 'TX'),
+    ('c4', 'Mall of America', 'Bloomington', 'MN'),
+    ('c5', 'Barnes & Noble Plaza', 'Orlando', 'FL'),
+    ('c6', 'Orlando Premium Outlets', 'Orlando', 'FL'),
+]
+
+CSV_COLUMNS = ['id', 'name', 'state', 'city', 'formatted_address', 'lon', 'lat', 'day', 'ft']
+
+
+def _center_index() -> CenterIndex:
+  return CenterIndex((center_id, name, city) for center_id, name, city, _ in CENTERS)
+
+
+def _day(offset: int) -> datetime.date:
+  return datetime.date(2024, 1, 1) + datetime.timedelta(days=offset)
+
+
+class RollupDeltasTests(TestCase):
+
+  @classmethod
+  def setUpTestData(cls):
+    ShoppingCenter.objects.create(shopping_center_id='c1', name='Skyview Plaza')
+
+  def test_save_adds_to_existing_rollups(self):
+    MonthlyTraffic.objects.create(
+        center_id='c1', month=datetime.date(2024, 1, 1), count=1, total=10, total_sq=100)
+    deltas = RollupDeltas()
+    deltas.add('c1', datetime.date(2024, 1, 2), 20)
+    deltas.add('c1', datetime.date(2024, 2, 1), 30)
+    deltas.save()
+
+    self.assertEqual(
+        list(MonthlyTraffic.objects.order_by('month').values_list(
+            'month', 'count', 'total', 'total_sq')),
+        [(datetime.date(2024, 1, 1), 2, 30, 500),
+         (datetime.date(2024, 2, 1), 1, 30, 900)])
+    # Tuesday 2 January and Thursday 1 February
+    self.assertEqual(
+        list(DayOfWeekTraffic.objects.order_by('weekday').values_list('weekday', 'total')),
+        [(3, 20), (5, 30)])
+    self.assertEqual(WeeklyTraffic.objects.count(), 2)
+
+  def test_remove_takes_back_a_replaced_row(self):
+    deltas = RollupDeltas()
+    deltas.add('c1', datetime.date(2024, 1, 2), 20)
+    deltas.remove('c1', datetime.date(2024, 1, 2), 20)
+    deltas.add('c1', datetime.date(2024, 1, 2), 25)
+    deltas.save()
+
+    self.assertEqual(
+        list(MonthlyTraffic.objects.values_list('count', 'total', 'total_sq')),
+        [(1, 25, 625)])
+
+  def test_emptied_periods_are_deleted(self):
+    deltas = RollupDeltas()
+    deltas.add('c1', datetime.date(2024, 1, 2), 20)
+    deltas.save()
+    deltas.remove('c1', datetime.date(2024, 1, 2), 20)
+    deltas.save()
+
+    self.assertFalse(MonthlyTraffic.objects.exists())
+    self.assertFalse(WeeklyTraffic.objects.exists())
+    self.assertFalse(DayOfWeekTraffic.objects.exists())
+
+  def test_periods_without_days_are_skipped(self):
+    deltas = RollupDeltas()
+    deltas.add('c1', datetime.date(2024, 1, 2), 20)
+    deltas.save()
+    MonthlyTraffic.objects.create(
+        center_id='c1', month=datetime.date(2024, 2, 1), count=0, total=0, total_sq=0)
+    WeeklyTraffic.objects.create(
+        center_id='c1', week_start=datetime.date(2024, 2, 5), count=0, total=0, total_sq=0)
+
+    rollups = CenterRollups.load('c1')
+    self.assertEqual(list(rollups.monthly_averages()), [20.0])
+    self.assertEqual([week['avg_ft'] for week in rollups.weekly_averages()], [20.0])
+
+  def test_rollups_match_the_series_statistics(self):
+    values = [120, 80, 100, 95, 130, 60, 110, 90]
+    deltas = RollupDeltas()
+    for offset, ft in enumerate(values):
+      deltas.add('c1', _day(offset), ft)
+    deltas.save()
+
+    rollups = CenterRollups.load('c1')
+    series = TrafficSeries.from_rows((_day(offset), ft) for offset, ft in enumerate(values))
+    self.assertAlmostEqual(rollups.mean, series.mean)
+    self.assertAlmostEqual(rollups.stddev, series.stddev)
+    self.assertEqual(rollups.day_of_week_averages(), series.day_of_week_averages())
+
+
+class LoadCsvDataTests(TestCase):
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.directory = directory.name
+
+  def _write_csv(self, name: str, rows: list) -> str:
+    path = os.path.join(self.directory, name)
+    with open(path, 'w', newline='') as file:
+      writer = csv.writer(file)
+      writer.writerow(CSV_COLUMNS)
+      for center_id, day, ft in rows:
+        writer.writerow([center_id, f"Mall {center_id}", 'FL', 'Miami', '', -80.3, 25.8,
+                         day.isoformat(), ft])
+    return path
+
+  def _load(self, path: str, *args) -> None:
+    call_command('load_csv_data', path, *args, stdout=io.StringIO())
+
+  def assertRollupsMatchRows(self):
+    for rollup in MonthlyTraffic.objects.all():
+      rows = FootTraffic.objects.filter(
+          center_id=rollup.center_id, day__year=rollup.month.year,
+          day__month=rollup.month.month).aggregate(total=Sum('ft'), count=Count('ft'))
+      self.assertEqual((rollup.count, rollup.total), (rows['count'], rows['total']))
+
+  def test_changed_rows_skips_the_loaded_foot_traffic(self):
+    ShoppingCenter.objects.create(shopping_center_id='a', name='Mall a')
+    FootTraffic.objects.bulk_create(
+        FootTraffic(center_id='a', day=_day(offset), ft=offset) for offset in range(11))
+    command = LoadCsvCommand()
+    command.last_days = {'a': _day(10)}
+    rows = [
+        {'id': 'a', 'day': _day(12).isoformat(), 'ft': '1'},
+        {'id': 'a', 'day': _day(10).isoformat(), 'ft': '10'},
+        {'id': 'a', 'day': _day(9).isoformat(), 'ft': '2'},
+        {'id': 'a', 'day': _day(12).isoformat(), 'ft': '3'},
+        {'id': 'b', 'day': _day(0).isoformat(), 'ft': '4'},
+    ]
+
+    changed, replaced = command._changed_rows(rows)
+
+    # The unchanged day is skipped, the corrected one is not, and the last
+    # row of a day wins
+    self.assertEqual([(row['id'], row['day'], row['ft']) for row in changed],
+                     [('a', _day(12), '3'), ('a', _day(9), '2'), ('b', _day(0), '4')])
+    self.assertEqual(replaced, {('a', _day(10)): 10, ('a', _day(9)): 9})
+
+  def test_unsorted_load(self):
+    rows = [('a', _day(offset), offset + 1) for offset in (5, 1, 9, 3, 0)]
+    self._load(self._write_csv('unsorted.csv', rows), '--batch-size', '2')
+
+    self.assertEqual(FootTraffic.objects.count(), 5)
+    self.assertEqual(IngestWatermark.objects.get(shopping_center_id='a').last_day, _day(9))
+    self.assertRollupsMatchRows()
+
+  def test_interrupted_load_keeps_the_batches_before_it(self):
+    path = self._write_csv('interrupted.csv', [('a', _day(offset), 10) for offset in range(5)])
+    with open(path, 'a', newline='') as file:
+      csv.writer(file).writerow(['a', 'Mall a', 'FL', 'Miami', '', -80.3, 25.8, 'not a day', 1])
+
+    with self.assertRaises(ValidationError):
+      self._load(path, '--batch-size', '2')
+
+    # The third batch, holding the bad row, is rolled back
+    self.assertEqual(FootTraffic.objects.count(), 4)
+    self.assertEqual(IngestWatermark.objects.get(shopping_center_id='a').last_day, _day(3))
+    self.assertFalse(IngestedFile.objects.exists())
+    self.assertRollupsMatchRows()
+
+  @skipUnlessDBFeature('supports_covering_indexes')
+  def test_incremental_load_upserts_corrections_of_loaded_days(self):
+    self._load(self._write_csv('first.csv', [('a', _day(offset), 10) for offset in range(5)]),
+               '--incremental')
+    # Days after the watermark come before and after a corrected older day,
+    # one day is repeated in a later batch, and an older day is cleared
+    rows = [('a', _day(7), 70), ('a', _day(2), 99), ('a', _day(5), 50),
+            ('a', _day(6), 60), ('a', _day(7), 75), ('a', _day(3), '')]
+    self._load(self._write_csv('second.csv', rows), '--incremental', '--batch-size', '2')
+
+    self.assertEqual(
+        list(FootTraffic.objects.filter(center_id='a').order_by('day').values_list('day', 'ft')),
+        [(_day(0), 10), (_day(1), 10), (_day(2), 99), (_day(3), None), (_day(4), 10),
+         (_day(5), 50), (_day(6), 60), (_day(7), 75)])
+    self.assertEqual(IngestWatermark.objects.get(shopping_center_id='a').last_day, _day(7))
+    self.assertRollupsMatchRows()
+
+
+class ParseComparisonTests(SimpleTestCase):
+
+  def test_names(self):
+    comparison = parse_comparison('Compare Dolphin Mall and Skyview Plaza')
+    self.assertEqual(comparison.names, ('Dolphin Mall', 'Skyview Plaza'))
+    self.assertEqual(comparison.separators, ('and',))
+
+  def test_versus(self):
+    comparison = parse_comparison('Dolphin Mall vs. Skyview Plaza by growth')
+    self.assertEqual(comparison.names, ('Dolphin Mall', 'Skyview Plaza by growth'))
+    self.assertEqual(comparison.metric, 'growth')
+
+  def test_place(self):
+    comparison = parse_comparison('Top 5 centers in FL by growth')
+    self.assertEqual((comparison.place, comparison.limit, comparison.metric),
+                     ('FL', 5, 'growth'))
+
+  def test_near(self):
+    comparison = parse_comparison('Centers within 10 miles of Skyview Plaza')
+    self.assertEqual((comparison.near, comparison.radius_miles), ('Skyview Plaza', 10.0))
+
+  def test_single_center(self):
+    self.assertIsNone(parse_comparison('How busy is Dolphin Mall in Miami?'))
+
+  def test_split_names(self):
+    self.assertEqual(split_names('A, and B & C vs. D'),
+                     (('A', 'B', 'C', 'D'), ('and', '&', 'vs.')))
+
+
+@override_settings(RESOLVER_REFRESH_INTERVAL=0)
+class FindComparisonTests(TestCase):
+
+  @classmethod
+  def setUpTestData(cls):
+    ShoppingCenter.objects.bulk_create(
+        ShoppingCenter(shopping_center_id=center_id, name=name, city=city, state=state)
+        for center_id, name, city, state in CENTERS)
+
+  def setUp(self):
+    patcher = mock.patch.object(pipeline, 'get_center_index', return_value=_center_index())
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _compared(self, query: str):
+    comparison, matches = pipeline.find_comparison(query)
+    if comparison is None:
+      return None
+    return sorted(match.shopping_center_id for match in matches)
+
+  def test_named_centers(self):
+    self.assertEqual(self._compared('Compare Skyview Plaza and Mall of America'),
+                     ['c1', 'c4'])
+
+  def test_every_location_of_an_ambiguous_center(self):
+    self.assertEqual(self._compared('Compare Dolphin Mall vs Skyview Plaza'),
+                     ['c1', 'c2', 'c3'])
+
+  def test_one_center_is_not_a_comparison(self):
+    self.assertIsNone(self._compared(
+        'Compare foot traffic at Dolphin Mall in Miami with last year'))
+
+  def test_names_with_separators(self):
+    self.assertEqual(self._compared('Compare Barnes & Noble Plaza and Skyview Plaza'),
+                     ['c1', 'c5'])
+    self.assertIsNone(self._compared('Compare Barnes & Noble Plaza'))
+
+  def test_neighbors_of_a_named_center(self):
+    comparison, matches = pipeline.find_comparison(
+        'Centers within 10 miles of Skyview Plaza')
+    self.assertEqual(comparison.near, 'Skyview Plaza')
+    self.assertIsNone(matches)
+
+  def test_time_around_a_center_is_not_a_comparison(self):
+    self.assertEqual(pipeline.find_comparison(
+        'How did Orlando Premium Outlets do around Christmas?'), (None, None))
+
+  def test_places_are_not_resolved(self):
+    comparison, matches = pipeline.find_comparison('Top 5 centers in FL by growth')
+    self.assertEqual(comparison.place, 'FL')
+    self.assertIsNone(matches)
+
+
+class FastPathTests(SimpleTestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(pipeline, 'get_center_index', return_value=_center_index())
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_center_and_city(self):
+    self.assertEqual(pipeline.fast_extract_entities('How busy is Dolphin Mall in Miami?'),
+                     ('Dolphin Mall', 'Miami'))
+
+  def test_center_without_city(self):
+    self.assertEqual(pipeline.fast_extract_entities('Foot traffic at skyview plaza'),
+                     ('Skyview Plaza', None))
+
+  def test_misspelled_center(self):
+    self.assertEqual(pipeline.fast_extract_entities('Trends at Skyveiw Plaza'),
+                     ('Skyview Plaza', None))
+
+  def test_unknown_center_falls_back_to_the_llm(self):
+    self.assertIsNone(pipeline.fast_extract_entities('How busy is my favorite mall?'))
+
+
+class AnomalyScoreTests(SimpleTestCase):
+
+  def test_zscore(self):
+    values = np.array([1.0, 2.0, 3.0, np.nan])
+    scores = anomalies.score(values, 'zscore')
+    np.testing.assert_allclose(scores.scores[:3], [-np.sqrt(1.5), 0, np.sqrt(1.5)])
+    self.assertTrue(np.isnan(scores.scores[3]))
+    np.testing.assert_allclose(scores.expected, 2.0)
+
+  def test_mad_ignores_the_outlier(self):
+    values = np.array([10.0, 11.0, 9.0, 10.0, 100.0])
+    scores = anomalies.score(values, 'mad')
+    np.testing.assert_allclose(scores.expected, 10.0)
+    self.assertAlmostEqual(scores.scores[4], 90 / anomalies.MAD_SCALE)
+
+  def test_rolling_needs_a_full_enough_window(self):
+    values = np.array([10.0, 12.0] * 10 + [50.0])
+    scores = anomalies.score(values, 'rolling', window=4)
+    self.assertTrue(np.isnan(scores.scores[:2]).all())
+    self.assertGreater(scores.scores[-1], 10)
+    self.assertAlmostEqual(scores.expected[-1], 11.0)
+
+  def test_seasonal_flags_a_quiet_weekend_day(self):
+    weekday = np.arange(8 * 7) % 7
+    values = np.where(weekday >= 5, 200.0, 100.0) + np.arange(8 * 7) % 3
+    values[-2] = 100.0
+    scores = anomalies.score(values, 'seasonal', window=14, weekday=weekday)
+    self.assertLess(scores.scores[-2], -3)
+    self.assertLess(np.nanmax(np.abs(scores.scores[:-2])), 3)
+
+  def test_invalid_methods(self):
+    with self.assertRaises(ValueError):
+      anomalies.score(np.ones(3), 'seasonal')
+    with self.assertRaises(ValueError):
+      anomalies.score(np.ones(3), 'unknown')
+
+  def test_find_anomalies(self):
+    values = np.array([10.0, 11.0, 9.0, 10.0, 100.0, 0.0])
+    found = anomalies.find_anomalies(
+        np.arange(6), values, anomalies.score(values, 'mad'), threshold=3, limit=1)
+    self.assertEqual([anomaly.label for anomaly in found], [4])
+
+
+class TrafficSeriesTests(SimpleTestCase):
+
+  def setUp(self):
+    # Out of order, with a missing value and no rows in February
+    self.series = TrafficSeries.from_rows([
+        (datetime.date(2024, 3, 1), 30),
+        (datetime.date(2024, 1, 1), 10),
+        (datetime.date(2024, 1, 2), None),
+        (datetime.date(2024, 1, 3), 20),
+    ])
+
+  def test_statistics_ignore_missing_values(self):
+    self.assertEqual(len(self.series), 4)
+    self.assertEqual(self.series.earliest_date, datetime.date(2024, 1, 1))
+    self.assertEqual(self.series.latest_date, datetime.date(2024, 3, 1))
+    self.assertEqual(self.series.mean, 20)
+    self.assertEqual(self.series.median, 20)
+    self.assertAlmostEqual(self.series.stddev, np.std([10, 20, 30]))
+
+  def test_monthly_averages(self):
+    averages = self.series.monthly_averages()
+    self.assertEqual([day.date() for day in averages.index],
+                     [datetime.date(2024, 1, 31), datetime.date(2024, 2, 29),
+                      datetime.date(2024, 3, 31)])
+    np.testing.assert_array_equal(averages.to_numpy(), [15, np.nan, 30])
+
+  def test_weekly_and_day_of_week_averages(self):
+    self.assertEqual(self.series.weekly_averages(), [
+        {'year': 2024, 'week': 1, 'avg_ft': 15.0},
+        {'year': 2024, 'week': 9, 'avg_ft': 30.0},
+    ])
+    # Monday 1 January, Wednesday 3 January and Friday 1 March
+    self.assertEqual(self.series.day_of_week_averages(), {2: 10.0, 4: 20.0, 6: 30.0})
+
+  def test_daily_z_scores_skip_missing_values(self):
+    z_scores = self.series.daily_z_scores()
+    self.assertNotIn(datetime.date(2024, 1, 2), z_scores)
+    self.assertEqual(z_scores[datetime.date(2024, 1, 3)], (20, 0.0))
+
+  def test_fingerprint(self):
+    changed = TrafficSeries.from_rows([
+        (datetime.date(2024, 3, 1), 31),
+        (datetime.date(2024, 1, 1), 10),
+        (datetime.date(2024, 1, 2), None),
+        (datetime.date(2024, 1, 3), 20),
+    ])
+    self.assertNotEqual(self.series.fingerprint(), changed.fingerprint())
+
+
+@override_settings(SHARED_CACHE_ALIAS='default')
+class SingleFlightTests(SimpleTestCase):
+
+  def test_concurrent_calls_share_one_computation(self):
+    flight = SingleFlight('test-shared')
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+      calls.append(1)
+      started.set()
+      release.wait(5)
+      return 'result'
+
+    results = []
+
+    def call():
+      results.append(flight.do('key', compute))
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+      thread.start()
+    # Let the other callers join the computation in flight
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+      thread.join(5)
+
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(sorted(results), [('result', False)] + [('result', True)] * 3)
+
+  def test_errors_reach_the_waiting_callers(self):
+    flight = SingleFlight('test-errors')
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+      started.set()
+      release.wait(5)
+      raise ValueError('failed')
+
+    errors = []
+
+    def call():
+      try:
+        flight.do('key', compute)
+      except ValueError as e:
+        errors.append(e)
+
+    leader, follower = threading.Thread(target=call), threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower.start()
+    time.sleep(0.2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    self.assertEqual(len(errors), 2)
+    self.assertIs(errors[0], errors[1])
+
+  def test_later_calls_compute_again(self):
+    flight = SingleFlight('test-sequential')
+    self.assertEqual(flight.do('key', lambda: 1), (1, False))
+    self.assertEqual(flight.do('key', lambda: 2), (2, False))
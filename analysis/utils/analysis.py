@@ -3,7 +3,8 @@ import logging
 
 from django.db.models.query import QuerySet
 import numpy as np
-from scipy.stats import zscore
+
+from .metrics import TrafficSeries, calculate_z_scores
 
 logger = logging.getLogger(__name__)
 
@@ -18,54 +19,29 @@ def calculate_daily_z_scores(queryset: QuerySet) -> dict:
   :param queryset: A Django QuerySet of FootTraffic objects
   :return: A dictionary of dates to tuples of foot traffic values and z-scores
   '''
-  ft_values = queryset.values_list('ft', flat=True)
-  ft_array = np.array(list(ft_values))
-  z_scores = zscore(ft_array)
-  logger.debug(logger.debug("Z SCORES = ", z_scores))
-
-  for i, z_score in enumerate(z_scores):
-    row = queryset[i]
-    logger.debug("Row:", row)
-    logger.debug("Z-score:", z_score)
-
-  logger.debug("Mean Z-score:", np.mean(z_scores))
-  logger.debug("Standard Deviation of Z-scores:", np.std(z_scores))
-  z_score_dict = {}
-  for i, z_score in enumerate(z_scores):
-    row = queryset[i]
-    date = row.day
-    ft = row.ft
-    z_score_dict[date] = (ft, z_score)
+  return TrafficSeries.from_queryset(queryset).daily_z_scores()
 
-  return z_score_dict
 
-
-def calculate_weekly_z_scores(queryset: QuerySet) -> dict:
+def calculate_weekly_z_scores(weekly_averages) -> dict:
   '''
-  Calculate the z-scores for the foot traffic values in the queryset at the
-  weekly level.
+  Calculate the z-scores for the foot traffic values in the weekly averages.
 
   Returns a dictionary where the keys are the ISO year and week, and the values
   are tuples of the foot traffic value and the z-score for that value.
 
-  :param queryset: A Django QuerySet of FootTraffic objects
+  :param weekly_averages: An iterable of dictionaries with ``year``, ``week``
+                          and ``avg_ft`` keys, such as the output of
+                          TrafficSeries.weekly_averages()
   :return: A dictionary of ISO year and week to tuples of foot traffic values
            and z-scores
   '''
-  ft_values = queryset.values_list('avg_ft', flat=True)
-  ft_array = np.array(list(ft_values))
-  z_scores = zscore(ft_array)
+  weekly_averages = list(weekly_averages)
+  ft_array = np.array([week['avg_ft'] for week in weekly_averages],
+                      dtype=np.float64)
+  z_scores = calculate_z_scores(ft_array)
   z_score_dict = {}
-  for i, z_score in enumerate(z_scores):
-    row = queryset[i]
-    logger.debug("Row:", row)
-    logger.debug("Z-score:", z_score)
-    ft = row['avg_ft']
-    iso_year = row['year']
-    iso_week = row['week']
-    z_score_dict[(iso_year, iso_week)] = (ft, z_score)
-    logger.debug(f"{iso_to_gregorian(iso_year, iso_week)}: {
-                 ft} (Z-score: {z_score})")
+  for week, z_score in zip(weekly_averages, z_scores):
+    z_score_dict[(week['year'], week['week'])] = (week['avg_ft'], z_score)
   return z_score_dict
 
 
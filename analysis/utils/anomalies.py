@@ -0,0 +1,228 @@
+import datetime
+from typing import NamedTuple
+import warnings
+
+import numpy as np
+
+# Scales the median absolute deviation to the standard deviation of normally
+# distributed values, so robust scores read like z-scores
+MAD_SCALE = 1.4826
+
+METHODS = ('zscore', 'rolling', 'mad', 'seasonal')
+
+
+class Scores(NamedTuple):
+  '''
+  The anomaly scores of a series, and the value each point was expected to
+  have. Both have the shape of the scored values, and are NaN where a point
+  could not be scored.
+  '''
+  scores: np.ndarray
+  expected: np.ndarray
+
+
+class Anomaly(NamedTuple):
+  label: object
+  value: float
+  expected: float
+  score: float
+
+
+def global_z_scores(values: np.ndarray) -> Scores:
+  '''
+  Score each point against the mean and standard deviation of its whole
+  series.
+
+  :param values: Values of one series, or a 2D array with one series per row,
+                 with NaN for missing values
+  :return: The Scores of every value
+  '''
+  mean = _nanmean(values)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    stddev = np.sqrt(_nanmean((values - mean) ** 2))
+    scores = (values - mean) / np.where(stddev == 0, np.nan, stddev)
+  return Scores(scores, np.broadcast_to(mean, values.shape))
+
+
+def rolling_z_scores(values: np.ndarray, window: int = 28,
+                     min_periods: int = None) -> Scores:
+  '''
+  Score each point against the mean and standard deviation of the points in
+  the trailing window before it, so trends and slow seasonal swings are not
+  flagged. Runs in O(n) using cumulative sums.
+
+  :param values: Consecutive values of one series, or a 2D array with one
+                 series per row, with NaN for missing values
+  :param window: The number of preceding points each point is compared to
+  :param min_periods: The number of values the window must have for a point to
+                      be scored, by default half the window
+  :return: The Scores of every value
+  '''
+  if min_periods is None:
+    min_periods = max(window // 2, 2)
+  # Centering each series first keeps the sums of squares small, so the
+  # variance does not lose precision to cancellation
+  offset = _nanmean(values)
+  centered = values - offset
+  present = ~np.isnan(centered)
+  filled = np.where(present, centered, 0.0)
+
+  end = np.arange(values.shape[-1])
+  start = np.maximum(end - window, 0)
+
+  def trailing_sum(array):
+    cumulative = np.concatenate(
+        [np.zeros(array.shape[:-1] + (1,)), np.cumsum(array, axis=-1)], axis=-1)
+    return cumulative[..., end] - cumulative[..., start]
+
+  counts = trailing_sum(present.astype(np.float64))
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean = trailing_sum(filled) / counts
+    variance = np.maximum(trailing_sum(filled ** 2) / counts - mean ** 2, 0)
+    stddev = np.sqrt(variance)
+    stddev[(counts < min_periods) | (stddev == 0)] = np.nan
+    scores = (centered - mean) / stddev
+  expected = mean + offset
+  expected[counts < min_periods] = np.nan
+  return Scores(scores, expected)
+
+
+def robust_z_scores(values: np.ndarray) -> Scores:
+  '''
+  Score each point against the median and median absolute deviation of its
+  whole series, which the outliers themselves barely move.
+
+  :param values: Values of one series, or a 2D array with one series per row,
+                 with NaN for missing values
+  :return: The Scores of every value
+  '''
+  median = _nanmedian(values)
+  mad = _nanmedian(np.abs(values - median)) * MAD_SCALE
+  with np.errstate(invalid='ignore', divide='ignore'):
+    scores = (values - median) / np.where(mad == 0, np.nan, mad)
+  return Scores(scores, np.broadcast_to(median, values.shape))
+
+
+def seasonal_z_scores(values: np.ndarray, weekday: np.ndarray, window: int = 28,
+                      min_periods: int = None) -> Scores:
+  '''
+  Remove each series' day-of-week pattern, then score each point against the
+  trailing window before it, so busy weekends are not flagged but a quiet
+  Saturday is.
+
+  :param values: Consecutive daily values of one series, or a 2D array with
+                 one series per row on the same days, with NaN for missing
+                 values
+  :param weekday: The weekday (0-6) of each day
+  :param window: The number of preceding days each day is compared to
+  :param min_periods: The number of values the window must have for a day to
+                      be scored, by default half the window
+  :return: The Scores of every value
+  '''
+  # Each weekday's typical share of the series' typical day
+  overall = _nanmedian(values)
+  factors = np.stack(
+      [_nanmedian(values[..., weekday == day])[..., 0] for day in range(7)],
+      axis=-1)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    factors = factors / overall
+  factors[~np.isfinite(factors) | (factors <= 0)] = 1.0
+  seasonal = factors[..., weekday]
+
+  adjusted = rolling_z_scores(values / seasonal, window, min_periods)
+  return Scores(adjusted.scores, adjusted.expected * seasonal)
+
+
+def score(values: np.ndarray, method: str, window: int = 28,
+          weekday: np.ndarray = None) -> Scores:
+  '''
+  Score a series, or a 2D array with one series per row, with one of METHODS.
+
+  :param values: The values, with NaN for missing values
+  :param method: 'zscore', 'rolling', 'mad' or 'seasonal'
+  :param window: The trailing window of the rolling and seasonal methods
+  :param weekday: The weekday (0-6) of each value, needed by the seasonal
+                  method
+  :return: The Scores of every value
+  '''
+  if method == 'zscore':
+    return global_z_scores(values)
+  if method == 'rolling':
+    return rolling_z_scores(values, window)
+  if method == 'mad':
+    return robust_z_scores(values)
+  if method == 'seasonal':
+    if weekday is None:
+      raise ValueError("The seasonal method needs the weekday of each value")
+    return seasonal_z_scores(values, weekday, window)
+  raise ValueError(f"Unknown anomaly detection method {method!r}")
+
+
+def find_anomalies(labels, values: np.ndarray, scores: Scores, threshold: float,
+                   limit: int = None) -> list:
+  '''
+  Get the points of one series whose score exceeds a threshold.
+
+  :param labels: The label of each point, like its date
+  :param values: The values of the series
+  :param scores: The Scores of the series
+  :param threshold: The absolute score above which a point is an anomaly
+  :param limit: The maximum number of anomalies, keeping the highest scores
+  :return: A list of Anomaly tuples, in the order of the series
+  '''
+  with np.errstate(invalid='ignore'):
+    indices = np.flatnonzero(np.abs(scores.scores) > threshold)
+  if limit is not None and len(indices) > limit:
+    strongest = np.argsort(-np.abs(scores.scores[indices]), kind='stable')[:limit]
+    indices = np.sort(indices[strongest])
+  return [
+      Anomaly(labels[i], float(values[i]), float(scores.expected[i]),
+              float(scores.scores[i]))
+      for i in indices
+  ]
+
+
+def calendar(days: np.ndarray, ft: np.ndarray) -> tuple:
+  '''
+  Lay a daily series out on consecutive days, with NaN on the days it lacks,
+  as the rolling and seasonal methods expect.
+
+  :param days: The sorted days of the series, as datetime64[D]
+  :param ft: The foot traffic of each day
+  :return: A tuple of the consecutive days, the foot traffic on them and
+           their Monday-based weekday (0-6)
+  '''
+  all_days = np.arange(days[0], days[-1] + 1)
+  all_ft = np.full(len(all_days), np.nan)
+  all_ft[(days - days[0]).astype(np.int64)] = ft
+  # 1970-01-01 was a Thursday
+  weekday = (all_days.astype(np.int64) + 3) % 7
+  return all_days, all_ft, weekday
+
+
+def describe_anomaly(anomaly: Anomaly, label: str) -> str:
+  '''
+  Describe an anomaly for a prompt, like
+  ``March 12, 2023 (Sunday): 3400, expected about 1210 (+181%)``.
+  '''
+  line = f"{label}: {anomaly.value:.0f}"
+  if anomaly.expected and not np.isnan(anomaly.expected):
+    change = anomaly.value / anomaly.expected - 1
+    line += f", expected about {anomaly.expected:.0f} ({change:+.0%})"
+  return line
+
+
+def _nanmean(values: np.ndarray) -> np.ndarray:
+  present = ~np.isnan(values)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return (np.where(present, values, 0.0).sum(axis=-1, keepdims=True)
+            / present.sum(axis=-1, keepdims=True))
+
+
+def _nanmedian(values: np.ndarray) -> np.ndarray:
+  # Series without any values get a NaN median, which is expected here
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', RuntimeWarning)
+    if values.shape[-1] == 0:
+      return np.full(values.shape[:-1] + (1,), np.nan)
+    return np.nanmedian(values, axis=-1, keepdims=True)
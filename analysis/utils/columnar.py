@@ -0,0 +1,291 @@
+'''
+Columnar snapshots of the foot traffic. The export_foot_traffic command writes
+the fact table to Parquet files partitioned by state and month, and the
+analyses scan the current snapshot instead of the database for as long as no
+data has been loaded since it was exported.
+'''
+import datetime
+from itertools import batched
+import json
+import logging
+import os
+import shutil
+import threading
+
+from django.conf import settings
+from django.db.models import Max, Q
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+from ..models import FootTraffic, IngestedFile
+from .comparison import TrafficMatrix
+from .data_version import get_data_version, read_data_version
+from .metrics import TrafficSeries
+
+logger = logging.getLogger(__name__)
+
+# The file naming the current snapshot's directory, under the snapshot root
+CURRENT_FILE = 'CURRENT'
+# The snapshot's metadata, under its directory. Files starting with an
+# underscore are not read as part of the dataset.
+MANIFEST_FILE = '_manifest.json'
+
+SCHEMA = pa.schema([
+    ('center_id', pa.string()),
+    ('day', pa.date32()),
+    ('ft', pa.int32()),
+])
+# Directories like state=FL/month=2024-01, so a scan of some states or months
+# only opens their files
+PARTITIONING = ds.partitioning(
+    pa.schema([('state', pa.string()), ('month', pa.string())]), flavor='hive')
+# Rows are written sorted by center and day, so the statistics of row groups
+# this small let a scan for a center skip most of a file
+ROW_GROUP_ROWS = 16384
+
+# The files' columns and the partitions'
+DATASET_SCHEMA = SCHEMA.append(pa.field('state', pa.string())).append(
+    pa.field('month', pa.string()))
+
+
+class FootTrafficSnapshot:
+  '''
+  An exported snapshot of the foot traffic, read through memory-mapped files.
+  Filters on the state and month are answered from the directory names, and
+  filters on the center and day from the Parquet row groups' statistics, so a
+  scan only reads the row groups that can match.
+  '''
+
+  def __init__(self, path: str):
+    '''
+    :param path: The snapshot's directory
+    :raises OSError: If the snapshot or its manifest cannot be read
+    '''
+    self.path = path
+    with open(os.path.join(path, MANIFEST_FILE)) as file:
+      self.manifest = json.load(file)
+    self.dataset = ds.dataset(
+        path, schema=DATASET_SCHEMA, format='parquet', partitioning=PARTITIONING,
+        filesystem=fs.LocalFileSystem(use_mmap=True))
+
+  def center_series(self, center_id: str, state: str = None,
+                    start: datetime.date = None,
+                    end: datetime.date = None) -> TrafficSeries:
+    '''
+    Read a shopping center's daily foot traffic.
+
+    :param center_id: The shopping center's ID
+    :param state: The shopping center's state, so only its partitions are read
+    :param start: The first day read, or None for the earliest
+    :param end: The last day read, or None for the latest
+    :return: A TrafficSeries
+    '''
+    condition = ds.field('center_id') == center_id
+    if state is not None:
+      condition &= ds.field('state') == state
+    if start is not None:
+      condition &= (ds.field('month') >= _month(start)) & (ds.field('day') >= start)
+    if end is not None:
+      condition &= (ds.field('month') <= _month(end)) & (ds.field('day') <= end)
+    table = self.dataset.to_table(columns=['day', 'ft'], filter=condition)
+    return TrafficSeries(table.column('day').to_numpy(), _ft(table))
+
+  def matrix(self, states, center_ids=()) -> TrafficMatrix:
+    '''
+    Read the daily foot traffic of every shopping center in some states, and
+    of some shopping centers without a state.
+
+    :param states: The states whose centers are read
+    :param center_ids: The IDs of centers without a state that are read
+    :return: A TrafficMatrix
+    '''
+    condition = ds.field('state').isin(list(states))
+    if center_ids:
+      condition |= ds.field('state').is_null() & ds.field('center_id').isin(list(center_ids))
+    table = self.dataset.to_table(columns=['center_id', 'day', 'ft'], filter=condition)
+    return TrafficMatrix.from_columns(
+        table.column('center_id').to_numpy(), table.column('day').to_numpy(), _ft(table))
+
+
+def _month(day: datetime.date) -> str:
+  return f"{day.year:04d}-{day.month:02d}"
+
+
+def _ft(table: pa.Table) -> np.ndarray:
+  # Missing values become NaN
+  return table.column('ft').cast(pa.float64()).to_numpy()
+
+
+def _latest_load() -> str | None:
+  '''
+  When data was last loaded into this database. With the data version, it
+  tells a snapshot of this data from a snapshot of another database's, like
+  the benchmarks' test database, whose version may be the same.
+  '''
+  loaded_at = IngestedFile.objects.aggregate(Max('loaded_at'))['loaded_at__max']
+  return loaded_at.isoformat() if loaded_at else None
+
+
+def current_snapshot_path(root: str = None) -> str | None:
+  '''
+  The directory of the current snapshot, or None if none has been exported.
+
+  :param root: The snapshot root, by default FOOT_TRAFFIC_SNAPSHOT_DIR
+  '''
+  root = root or settings.FOOT_TRAFFIC_SNAPSHOT_DIR
+  try:
+    with open(os.path.join(root, CURRENT_FILE)) as file:
+      return os.path.join(root, file.read().strip())
+  except FileNotFoundError:
+    return None
+
+
+def export_snapshot(root: str = None, batch_size: int = 100000, keep: int = 2) -> tuple:
+  '''
+  Write the foot traffic to a new snapshot and make it the current one.
+
+  :param root: The snapshot root, by default FOOT_TRAFFIC_SNAPSHOT_DIR
+  :param batch_size: The number of rows read from the database at a time
+  :param keep: The number of snapshots kept, including the new one. Keep the
+               previous one too, so the processes still reading it can finish.
+  :return: A tuple of the new snapshot's directory and manifest
+  '''
+  root = root or settings.FOOT_TRAFFIC_SNAPSHOT_DIR
+  os.makedirs(root, exist_ok=True)
+  created_at = datetime.datetime.now(datetime.timezone.utc)
+  name = created_at.strftime('%Y%m%dT%H%M%S%fZ')
+  path = os.path.join(root, name)
+  partial = f"{path}.partial"
+  # Read before the rows, so data loaded during the export leaves the snapshot
+  # stale instead of passing it off as current
+  manifest = {
+      'data_version': read_data_version(),
+      'loaded_at': _latest_load(),
+      'created_at': created_at.isoformat(),
+      'rows': 0,
+  }
+
+  def record_batches():
+    # A single query, streamed with a server-side cursor where the database
+    # supports one
+    rows = FootTraffic.objects.order_by('center__state', 'center_id', 'day').values_list(
+        'center_id', 'day', 'ft', 'center__state').iterator(chunk_size=batch_size)
+    for chunk in batched(rows, batch_size):
+      center_ids, days, ft, states = zip(*chunk)
+      manifest['rows'] += len(chunk)
+      yield pa.RecordBatch.from_arrays([
+          pa.array(center_ids, pa.string()),
+          pa.array(days, pa.date32()),
+          pa.array(ft, pa.int32()),
+          pa.array(states, pa.string()),
+          pa.array([_month(day) for day in days], pa.string()),
+      ], schema=DATASET_SCHEMA)
+
+  try:
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(DATASET_SCHEMA, record_batches()),
+        partial, format='parquet', partitioning=PARTITIONING,
+        basename_template='part-{i}.parquet', min_rows_per_group=ROW_GROUP_ROWS,
+        max_rows_per_group=ROW_GROUP_ROWS)
+    os.makedirs(partial, exist_ok=True)
+    with open(os.path.join(partial, MANIFEST_FILE), 'w') as file:
+      json.dump(manifest, file)
+    os.rename(partial, path)
+  except BaseException:
+    shutil.rmtree(partial, ignore_errors=True)
+    raise
+
+  # Readers see either the previous snapshot or the complete new one
+  current = os.path.join(root, f"{CURRENT_FILE}.{name}")
+  with open(current, 'w') as file:
+    file.write(name)
+  os.replace(current, os.path.join(root, CURRENT_FILE))
+  logger.info(f"Exported {manifest['rows']} rows of foot traffic to {path}")
+
+  snapshots = sorted(entry.name for entry in os.scandir(root)
+                     if entry.is_dir() and not entry.name.endswith('.partial'))
+  for old in snapshots[:-keep]:
+    shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+  return path, manifest
+
+
+_lock = threading.Lock()
+# The snapshot last opened, whether it is current, and the (path, data
+# version) that was checked for
+_snapshot = None
+_snapshot_current = False
+_snapshot_checked = None
+
+
+def get_snapshot() -> FootTrafficSnapshot | None:
+  '''
+  Get the current snapshot, if one has been exported and no data has been
+  loaded since. Each check costs a read of the CURRENT file and of this
+  process's data version; the snapshot is only opened again once either
+  changes.
+
+  :return: The FootTrafficSnapshot, or None to read from the database
+  '''
+  global _snapshot, _snapshot_current, _snapshot_checked
+  path = current_snapshot_path()
+  if path is None:
+    return None
+  version = get_data_version()
+  with _lock:
+    if _snapshot_checked != (path, version):
+      try:
+        if _snapshot is None or _snapshot.path != path:
+          _snapshot = FootTrafficSnapshot(path)
+        _snapshot_current = (_snapshot.manifest['data_version'] == version and
+                             _snapshot.manifest['loaded_at'] == _latest_load())
+        if not _snapshot_current:
+          logger.info(f"The foot traffic snapshot {path} is out of date; "
+                      "reading from the database until it is exported again")
+      except (OSError, ValueError, KeyError, pa.ArrowException):
+        logger.exception(f"Could not open the foot traffic snapshot {path}")
+        _snapshot, _snapshot_current = None, False
+      _snapshot_checked = (path, version)
+    return _snapshot if _snapshot_current else None
+
+
+def load_series(center_id: str, state: str = None, start: datetime.date = None,
+                end: datetime.date = None) -> TrafficSeries:
+  '''
+  Load a shopping center's daily foot traffic from the current snapshot, or
+  with one query against the fact table when there is none.
+
+  :param center_id: The shopping center's ID
+  :param state: The shopping center's state
+  :param start: The first day loaded, or None for the earliest
+  :param end: The last day loaded, or None for the latest
+  :return: A TrafficSeries
+  '''
+  if (snapshot := get_snapshot()) is not None:
+    return snapshot.center_series(center_id, state, start, end)
+  # The (center, day) index covers ft, so the rows are read from the index
+  # alone, already in order
+  rows = FootTraffic.objects.filter(center_id=center_id)
+  if start is not None:
+    rows = rows.filter(day__gte=start)
+  if end is not None:
+    rows = rows.filter(day__lte=end)
+  return TrafficSeries.from_rows(rows.order_by('day').values_list('day', 'ft'))
+
+
+def load_matrix(states, center_ids=()) -> TrafficMatrix:
+  '''
+  Load the daily foot traffic of every shopping center in some states, and of
+  some shopping centers without a state, from the current snapshot, or with
+  one query against the fact table when there is none.
+
+  :param states: The states whose centers are loaded
+  :param center_ids: The IDs of centers without a state that are loaded
+  :return: A TrafficMatrix
+  '''
+  if (snapshot := get_snapshot()) is not None:
+    return snapshot.matrix(states, center_ids)
+  return TrafficMatrix.from_queryset(FootTraffic.objects.filter(
+      Q(center__state__in=states) |
+      Q(center__state__isnull=True, center_id__in=center_ids)))
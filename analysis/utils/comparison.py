@@ -0,0 +1,304 @@
+import hashlib
+import re
+from typing import NamedTuple
+
+from django.db.models.query import QuerySet
+import numpy as np
+import pandas as pd
+
+from . import anomalies
+
+US_STATES = {
+    'alabama': 'AL', 'alaska': 'AK', 'arizona': 'AZ', 'arkansas': 'AR',
+    'california': 'CA', 'colorado': 'CO', 'connecticut': 'CT', 'delaware': 'DE',
+    'district of columbia': 'DC', 'florida': 'FL', 'georgia': 'GA',
+    'hawaii': 'HI', 'idaho': 'ID', 'illinois': 'IL', 'indiana': 'IN',
+    'iowa': 'IA', 'kansas': 'KS', 'kentucky': 'KY', 'louisiana': 'LA',
+    'maine': 'ME', 'maryland': 'MD', 'massachusetts': 'MA', 'michigan': 'MI',
+    'minnesota': 'MN', 'mississippi': 'MS', 'missouri': 'MO', 'montana': 'MT',
+    'nebraska': 'NE', 'nevada': 'NV', 'new hampshire': 'NH', 'new jersey': 'NJ',
+    'new mexico': 'NM', 'new york': 'NY', 'north carolina': 'NC',
+    'north dakota': 'ND', 'ohio': 'OH', 'oklahoma': 'OK', 'oregon': 'OR',
+    'pennsylvania': 'PA', 'rhode island': 'RI', 'south carolina': 'SC',
+    'south dakota': 'SD', 'tennessee': 'TN', 'texas': 'TX', 'utah': 'UT',
+    'vermont': 'VT', 'virginia': 'VA', 'washington': 'WA',
+    'west virginia': 'WV', 'wisconsin': 'WI', 'wyoming': 'WY',
+}
+
+_COMPARE_RE = re.compile(
+    r'\b(?:compare|comparing|comparison (?:of|between))\s+(?P<rest>.+)', re.I)
+_VERSUS_RE = re.compile(r'\s(?:vs\.?|versus)\s', re.I)
+_SPLIT_RE = re.compile(r'\s*(,|;|&|\band\b|\bvs\b\.?|\bversus\b|\bwith\b)\s*', re.I)
+_GROUP_RE = re.compile(
+    r'\b(?:centers|centres|malls|plazas|locations|outlets|galleries)\b', re.I)
+_RANK_RE = re.compile(
+    r'\b(?:top|bottom|best|worst|rank|ranked|ranking|busiest|quietest|'
+    r'fastest|slowest|all|compare|comparing)\b', re.I)
+_LIMIT_RE = re.compile(r'\b(?:top|bottom|best|worst)\s+(?P<limit>\d+)\b', re.I)
+_ASCENDING_RE = re.compile(r'\b(?:bottom|worst|quietest|slowest|least)\b', re.I)
+_PLACE_RE = re.compile(
+    r"\bin\s+(?P<place>[a-z][a-z .'-]*?)\s*(?:\bby\b|\branked\b|\bfor\b|"
+    r"\bover\b|\bduring\b|[?.!,;]|$)", re.I)
+_NEAR_RE = re.compile(
+    r'\b(?:within\s+(?P<miles>\d+(?:\.\d+)?)\s*(?:mi|mile|miles)\s+(?:of|from)|'
+    r'near|nearby|around|close\s+to|'
+    r'(?:nearest|closest)\b(?:\s+\S+){0,3}?\s+(?:to|from))\s+'
+    r'(?P<anchor>.+?)\s*[?.!]*$', re.I)
+_PRONOUNS = {'it', 'this', 'that', 'them', 'there', 'here', 'this one', 'that one'}
+_NEAREST_RE = re.compile(r'\b(?:nearest|closest)\s+(?P<limit>\d+)\b', re.I)
+_GROWTH_RE = re.compile(r'\b(?:grow\w*|growth|increas\w*|declin\w*|chang\w*|trend\w*)\b', re.I)
+
+
+class ComparisonQuery(NamedTuple):
+  '''
+  A query asking to compare several shopping centers: the centers named in
+  it, the centers in a place ranked by a metric, or the centers near one.
+  '''
+  # The parts of the query naming each center, like "Dolphin Mall in Miami".
+  # They may not all name a center, and one center's name may have been split
+  # in two, like "Barnes & Noble Plaza".
+  names: tuple = ()
+  # The separator between each name and the next, like "&" or "vs"
+  separators: tuple = ()
+  # The state or city whose centers are ranked
+  place: str = None
+  # 'growth' or 'traffic'
+  metric: str = 'traffic'
+  # How many centers to list, or None for the default
+  limit: int = None
+  # Whether to list the lowest values first
+  ascending: bool = False
+  # The part of the query naming the center whose neighbors are compared
+  near: str = None
+  # The distance from it, in miles, or None for the default
+  radius_miles: float = None
+  # Whether to compare its nearest centers instead of those within a distance
+  nearest: bool = False
+
+
+def parse_comparison(query: str) -> ComparisonQuery | None:
+  '''
+  Recognize a query asking to compare shopping centers, like "compare Dolphin
+  Mall and Skyview Plaza", "top 10 centers in FL by growth" or "centers within
+  10 miles of Skyview Plaza".
+
+  :param query: The user's query
+  :return: A ComparisonQuery, or None if the query is about a single center
+  '''
+  metric = 'growth' if _GROWTH_RE.search(query) else 'traffic'
+  ascending = bool(_ASCENDING_RE.search(query))
+
+  near = _NEAR_RE.search(query)
+  if near and _GROUP_RE.search(query[:near.start('anchor')]):
+    anchor = near.group('anchor')
+    if anchor.lower() in _PRONOUNS:
+      # "How does Dolphin Mall compare with the centers around it?"
+      anchor = query[:near.start()]
+    limit = _NEAREST_RE.search(query) or _LIMIT_RE.search(query)
+    return ComparisonQuery(
+        near=anchor, metric=metric, ascending=ascending,
+        radius_miles=float(near.group('miles')) if near.group('miles') else None,
+        nearest=bool(re.match(r'nearest|closest', near.group(0), re.I)),
+        limit=int(limit.group('limit')) if limit else None)
+
+  place = _PLACE_RE.search(query)
+  if place and _GROUP_RE.search(query[:place.start()]) and _RANK_RE.search(query):
+    limit = _LIMIT_RE.search(query)
+    return ComparisonQuery(
+        place=place.group('place').strip(), metric=metric,
+        limit=int(limit.group('limit')) if limit else None, ascending=ascending)
+
+  compare = _COMPARE_RE.search(query)
+  if compare or _VERSUS_RE.search(query):
+    rest = compare.group('rest') if compare else query
+    names, separators = split_names(rest)
+    if len(names) >= 2:
+      return ComparisonQuery(names=names, separators=separators, metric=metric,
+                             ascending=ascending)
+  return None
+
+
+def split_names(text: str) -> tuple:
+  '''
+  Split the part of a query listing shopping centers at each separator.
+
+  :param text: The list, like "Dolphin Mall, Skyview Plaza and Aventura Mall"
+  :return: A tuple of the names and of the separator between each name and
+           the next
+  '''
+  names, separators = [], []
+  parts = _SPLIT_RE.split(text)
+  for i in range(0, len(parts), 2):
+    separator = parts[i - 1].lower() if i else None
+    if not parts[i].strip():
+      continue
+    if names:
+      separators.append(separator)
+    names.append(parts[i].strip())
+  return tuple(names), tuple(separators)
+
+
+def state_code(place: str) -> str | None:
+  '''
+  The two letter code of a US state given by name or code, or None if the
+  place is not a state.
+  '''
+  place = place.strip().rstrip('.')
+  if len(place) == 2 and place.upper() in US_STATES.values():
+    return place.upper()
+  return US_STATES.get(place.lower())
+
+
+class TrafficMatrix:
+  '''
+  The daily foot traffic of many shopping centers in one (centers x days)
+  NumPy matrix over a shared range of consecutive days, with NaN where a
+  center has no value. Every comparison statistic is computed on the whole
+  matrix at once.
+  '''
+
+  def __init__(self, center_ids: np.ndarray, days: np.ndarray, ft: np.ndarray):
+    '''
+    :param center_ids: The shopping center of each row
+    :param days: The consecutive days of the columns, as datetime64[D]
+    :param ft: The foot traffic matrix
+    '''
+    self.center_ids = center_ids
+    self.days = days
+    self.ft = ft
+
+  @classmethod
+  def from_rows(cls, rows) -> 'TrafficMatrix':
+    '''
+    Build a matrix from an iterable of (center_id, day, ft) rows.
+    '''
+    rows = list(rows)
+    if not rows:
+      return cls.from_columns(np.array([], dtype=object),
+                              np.array([], dtype='datetime64[D]'), np.array([]))
+    center_ids, days, ft = zip(*rows)
+    return cls.from_columns(np.array(center_ids, dtype=object),
+                            np.array(days, dtype='datetime64[D]'),
+                            np.array(ft, dtype=np.float64))  # None becomes NaN
+
+  @classmethod
+  def from_columns(cls, center_ids: np.ndarray, days: np.ndarray,
+                   ft: np.ndarray) -> 'TrafficMatrix':
+    '''
+    Build a matrix from the columns of (center_id, day, ft) rows.
+
+    :param center_ids: The shopping center of each row
+    :param days: The day of each row, as datetime64[D]
+    :param ft: The foot traffic of each row, NaN where it is missing
+    '''
+    if not len(center_ids):
+      return cls(np.array([], dtype=object), np.array([], dtype='datetime64[D]'),
+                 np.empty((0, 0)))
+    # Hashing the IDs is much faster than np.unique's sort of Python strings
+    row_indexes, center_ids = pd.factorize(center_ids, sort=True)
+    first = days.min()
+    all_days = np.arange(first, days.max() + 1)
+    matrix = np.full((len(center_ids), len(all_days)), np.nan)
+    matrix[row_indexes, (days - first).astype(np.int64)] = ft
+    return cls(center_ids, all_days, matrix)
+
+  @classmethod
+  def from_queryset(cls, queryset: QuerySet) -> 'TrafficMatrix':
+    '''
+    Build a matrix from a queryset of FootTraffic objects with a single query.
+    '''
+    return cls.from_rows(queryset.values_list('center_id', 'day', 'ft'))
+
+  def __len__(self) -> int:
+    return len(self.center_ids)
+
+  def fingerprint(self) -> str:
+    '''
+    A digest of the whole matrix, which changes whenever any row changes.
+    '''
+    digest = hashlib.sha256('\0'.join(self.center_ids).encode())
+    digest.update(self.days.tobytes())
+    digest.update(self.ft.tobytes())
+    return digest.hexdigest()
+
+  def recent_means(self, window: int) -> np.ndarray:
+    '''
+    Each center's mean daily foot traffic over the last ``window`` days.
+    '''
+    return _row_means(self.ft[:, -window:])
+
+  def growth_rates(self, window: int) -> tuple:
+    '''
+    Each center's growth of mean daily foot traffic over the last ``window``
+    days, compared to the same days a year earlier when the matrix covers
+    them, and to the ``window`` days before otherwise.
+
+    :return: A tuple of the growth rates (0.1 for 10%) and a description of
+             what they compare to
+    '''
+    n = self.ft.shape[1]
+    if n >= window + 365:
+      earlier = self.ft[:, n - window - 365:n - 365]
+      basis = 'year over year'
+    else:
+      earlier = self.ft[:, max(n - 2 * window, 0):max(n - window, 0)]
+      basis = f'compared to the {window} days before'
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return self.recent_means(window) / _row_means(earlier) - 1, basis
+
+  def anomaly_counts(self, window: int, threshold: float, method: str,
+                     baseline_window: int) -> np.ndarray:
+    '''
+    The number of anomalous days of each center in the last ``window`` days.
+    '''
+    weekday = (self.days.astype(np.int64) + 3) % 7
+    scores = anomalies.score(self.ft, method, baseline_window, weekday).scores
+    with np.errstate(invalid='ignore'):
+      return (np.abs(scores[:, -window:]) > threshold).sum(axis=1)
+
+
+def peer_z_scores(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+  '''
+  The z-score of each value within its peer group, ignoring NaNs.
+
+  :param values: One value per center
+  :param groups: The integer peer group (0 to n - 1) of each center
+  '''
+  present = ~np.isnan(values)
+  n_groups = groups.max() + 1 if len(groups) else 0
+  counts = np.bincount(groups[present], minlength=n_groups)
+  sums = np.bincount(groups[present], weights=values[present], minlength=n_groups)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    means = sums / counts
+    deviations = np.where(present, values - means[groups], 0.0)
+    stddevs = np.sqrt(
+        np.bincount(groups, weights=deviations ** 2, minlength=n_groups) / counts)
+    stddevs[stddevs == 0] = np.nan
+    return (values - means[groups]) / stddevs[groups]
+
+
+def peer_ranks(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+  '''
+  The rank (1 for the highest value) of each value within its peer group.
+  Centers without a value rank after the others.
+
+  :param values: One value per center
+  :param groups: The integer peer group of each center
+  '''
+  # Sort by group, then by descending value with NaNs last
+  order = np.lexsort((np.where(np.isnan(values), np.inf, -values), groups))
+  sorted_groups = groups[order]
+  group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+  first_of_group = np.repeat(group_starts, np.diff(np.r_[group_starts, len(order)]))
+  ranks = np.empty(len(values), dtype=np.int64)
+  ranks[order] = np.arange(len(order)) - first_of_group + 1
+  return ranks
+
+
+def _row_means(matrix: np.ndarray) -> np.ndarray:
+  '''
+  The mean of each row, ignoring NaNs. Rows without any values get NaN.
+  '''
+  present = ~np.isnan(matrix)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.where(present, matrix, 0.0).sum(axis=1) / present.sum(axis=1)
@@ -0,0 +1,91 @@
+import threading
+import time
+from typing import Callable
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from ..models import DataVersion
+
+# The primary key of the DataVersion row
+_PK = 1
+
+
+# This process's copy of the data version, and when it was read
+_cached = (None, 0.0)
+
+
+def get_data_version() -> int:
+  '''
+  Get the version of the foot traffic data shared by every process. It changes
+  each time data is loaded, so in-process indexes and the cache keys derived
+  from the data know when to rebuild. Each process reads it from the database
+  at most once every RESOLVER_REFRESH_INTERVAL seconds.
+  '''
+  version, read_at = _cached
+  if version is None or time.monotonic() - read_at >= settings.RESOLVER_REFRESH_INTERVAL:
+    version = read_data_version()
+  return version
+
+
+def read_data_version() -> int:
+  '''
+  Read the current data version from the database, and keep it as this
+  process's copy.
+  '''
+  global _cached
+  version = DataVersion.objects.filter(pk=_PK).values_list('version', flat=True).first()
+  version = 0 if version is None else version
+  _cached = (version, time.monotonic())
+  return version
+
+
+def bump_data_version() -> int:
+  '''
+  Mark the foot traffic data as changed. Called in the transaction loading
+  the data, other processes see the new version when the data is committed.
+
+  :return: The new data version
+  '''
+  if not DataVersion.objects.filter(pk=_PK).update(version=F('version') + 1):
+    # The first load, or the row was deleted; start from the current time so
+    # no earlier version is repeated
+    try:
+      with transaction.atomic():
+        DataVersion.objects.create(pk=_PK, version=int(time.time()))
+    except IntegrityError:
+      # Created by a concurrent load
+      DataVersion.objects.filter(pk=_PK).update(version=F('version') + 1)
+  # So this process does not wait for the refresh interval to see it
+  return read_data_version()
+
+
+class VersionedValue:
+  '''
+  A value built from the data once per process, like an in-memory index of the
+  shopping centers, and rebuilt when this process's data version changes.
+  '''
+
+  def __init__(self, build: Callable):
+    '''
+    :param build: Builds the value from the current data
+    '''
+    self.build = build
+    self._value = None
+    self._version = None
+    self._lock = threading.Lock()
+
+  def get(self):
+    '''
+    Get the value, building it on first use or if the data has changed.
+    '''
+    version = get_data_version()
+    if self._value is not None and version == self._version:
+      return self._value
+
+    with self._lock:
+      if self._value is None or version != self._version:
+        self._value = self.build()
+        self._version = version
+    return self._value
@@ -18,3 +18,10 @@ class DayOfWeek(Enum):
   Fri = 4
   Sat = 5
   Sun = 6
+
+
+class JobStatus(Enum):
+  QUEUED = "queued"
+  RUNNING = "running"
+  DONE = "done"
+  FAILED = "failed"
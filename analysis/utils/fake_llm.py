@@ -0,0 +1,83 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun)
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+DEFAULT_RESPONSE = (
+    'Foot traffic at the shopping center has been broadly stable, with a '
+    'seasonal peak in December and weekend visits well above weekdays. A few '
+    'isolated days stand out as unusually high or low compared to the rest.'
+)
+
+
+class FakeChatModel(BaseChatModel):
+  '''
+  A local stand-in for a provider's chat model that answers every prompt with
+  canned text after a fixed delay, so the pipeline can be run and timed
+  without API keys or paying for requests.
+
+  Prompts that ask for XML, like the filtering prompt, are answered with
+  ``xml_response`` and every other prompt with ``response``.
+  '''
+  model_name: str = 'fake-chat-model'
+  # Seconds to wait before answering, standing in for the provider's latency
+  latency: float = 0.5
+  response: str = DEFAULT_RESPONSE
+  xml_response: str = (
+      '<result><shopping_center></shopping_center><city></city></result>')
+  # Number of chunks a streamed response is split into, with the latency
+  # spread evenly between them
+  stream_chunks: int = 10
+
+  @property
+  def _llm_type(self) -> str:
+    return 'fake-chat-model'
+
+  def _respond(self, messages: List[BaseMessage]) -> str:
+    prompt = '\n'.join(str(message.content) for message in messages)
+    return self.xml_response if 'XML' in prompt else self.response
+
+  def _chunks(self, text: str) -> list:
+    size = max(len(text) // max(self.stream_chunks, 1), 1)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+  def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> ChatResult:
+    time.sleep(self.latency)
+    message = AIMessage(content=self._respond(messages))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  async def _agenerate(self, messages: List[BaseMessage],
+                       stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> ChatResult:
+    await asyncio.sleep(self.latency)
+    message = AIMessage(content=self._respond(messages))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None,
+              **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+    chunks = self._chunks(self._respond(messages))
+    for chunk in chunks:
+      time.sleep(self.latency / len(chunks))
+      if run_manager:
+        run_manager.on_llm_new_token(chunk)
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+
+  async def _astream(self, messages: List[BaseMessage],
+                     stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                     **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+    chunks = self._chunks(self._respond(messages))
+    for chunk in chunks:
+      await asyncio.sleep(self.latency / len(chunks))
+      if run_manager:
+        await run_manager.on_llm_new_token(chunk)
+      yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
@@ -0,0 +1,127 @@
+from collections import namedtuple
+import logging
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from ..models import ShoppingCenter
+from .data_version import VersionedValue
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_MILES = 3958.8
+
+GeoMatch = namedtuple(
+    'GeoMatch', ['shopping_center_id', 'name', 'city', 'state', 'miles'])
+
+
+class CenterGeoIndex:
+  '''
+  An in-memory KD-tree of the shopping centers' locations, used to find the
+  centers near a point without scanning the centers table.
+
+  Each location is stored as a point on the unit sphere, so the straight-line
+  (chord) distance between two points grows with their great-circle distance
+  and the tree's Euclidean queries answer great-circle queries exactly.
+  '''
+
+  def __init__(self, centers):
+    '''
+    :param centers: An iterable of (shopping_center_id, name, city, state,
+                    lat, lon) tuples. Centers without a location are left out.
+    '''
+    centers = sorted(
+        (c for c in centers if c[4] is not None and c[5] is not None),
+        key=lambda c: c[0])
+    self.ids = [c[0] for c in centers]
+    self.names = [c[1] for c in centers]
+    self.cities = [c[2] for c in centers]
+    self.states = [c[3] for c in centers]
+    self.positions = {c[0]: (c[4], c[5]) for c in centers}
+    points = _unit_vectors(np.array([c[4] for c in centers], dtype=np.float64),
+                           np.array([c[5] for c in centers], dtype=np.float64))
+    self.tree = cKDTree(points.reshape(-1, 3))
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  def position(self, shopping_center_id: str) -> tuple | None:
+    '''
+    The (lat, lon) of a shopping center, or None if its location is unknown.
+    '''
+    return self.positions.get(shopping_center_id)
+
+  def within(self, lat: float, lon: float, miles: float, limit: int = None) -> list:
+    '''
+    Find the shopping centers within a distance of a point.
+
+    :param lat: The point's latitude
+    :param lon: The point's longitude
+    :param miles: The distance in miles
+    :param limit: The maximum number of centers to return, keeping the nearest
+    :return: A list of GeoMatch tuples, nearest first
+    '''
+    if not len(self):
+      return []
+    point = _unit_vectors(np.array([lat]), np.array([lon]))[0]
+    indexes = np.array(self.tree.query_ball_point(point, _chord(miles)), dtype=np.int64)
+    distances = np.linalg.norm(self.tree.data[indexes] - point, axis=1)
+    order = np.argsort(distances, kind='stable')[:limit]
+    return [self._match(i, d) for i, d in zip(indexes[order], distances[order])]
+
+  def nearest(self, lat: float, lon: float, k: int) -> list:
+    '''
+    Find the shopping centers nearest to a point.
+
+    :param lat: The point's latitude
+    :param lon: The point's longitude
+    :param k: The number of centers to return
+    :return: A list of GeoMatch tuples, nearest first
+    '''
+    k = min(k, len(self))
+    if not k:
+      return []
+    point = _unit_vectors(np.array([lat]), np.array([lon]))[0]
+    distances, indexes = self.tree.query(point, k=k)
+    return [self._match(i, d) for i, d in zip(np.atleast_1d(indexes),
+                                              np.atleast_1d(distances))]
+
+  def _match(self, i: int, chord: float) -> GeoMatch:
+    return GeoMatch(self.ids[i], self.names[i], self.cities[i], self.states[i],
+                    _miles(chord))
+
+
+def _unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+  lat, lon = np.radians(lat), np.radians(lon)
+  return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                          np.sin(lat)))
+
+
+def _chord(miles: float) -> float:
+  # Great-circle distance to the length of the chord between its ends
+  return 2 * np.sin(min(miles / EARTH_RADIUS_MILES, np.pi) / 2)
+
+
+def _miles(chord: float) -> float:
+  return float(2 * EARTH_RADIUS_MILES * np.arcsin(min(chord / 2, 1.0)))
+
+
+def get_geo_index() -> CenterGeoIndex:
+  '''
+  Get this process's geospatial index, building it on first use and rebuilding
+  it when data has been loaded since it was built.
+  '''
+  return _index.get()
+
+
+def build_geo_index() -> CenterGeoIndex:
+  start = time.perf_counter()
+  index = CenterGeoIndex(ShoppingCenter.objects.values_list(
+      'shopping_center_id', 'name', 'city', 'state', 'lat', 'lon'))
+  logger.info(f"Built geospatial index of {len(index)} centers in "
+              f"{time.perf_counter() - start:.2f}s")
+  return index
+
+
+_index = VersionedValue(build_geo_index)
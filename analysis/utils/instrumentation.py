@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+from django.db import connection
+
+
+class Counter:
+  '''
+  A Prometheus-style counter with labels, kept in this process.
+  '''
+
+  def __init__(self, name: str, help_text: str, labelnames: tuple):
+    self.name = name
+    self.help_text = help_text
+    self.labelnames = labelnames
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def inc(self, amount: float = 1, **labels) -> None:
+    key = tuple(str(labels[name]) for name in self.labelnames)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+    with self.lock:
+      for key, value in sorted(self.values.items()):
+        lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+    return lines
+
+
+class Histogram:
+  '''
+  A Prometheus-style histogram with labels, kept in this process.
+  '''
+
+  def __init__(self, name: str, help_text: str, labelnames: tuple,
+               buckets: tuple = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+                                 10, 25, 60)):
+    self.name = name
+    self.help_text = help_text
+    self.labelnames = labelnames
+    self.buckets = buckets
+    # Labels to [count per bucket..., count, sum]
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def observe(self, value: float, **labels) -> None:
+    key = tuple(str(labels[name]) for name in self.labelnames)
+    with self.lock:
+      values = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          values[i] += 1
+      values[-2] += 1
+      values[-1] += value
+
+  def totals(self) -> dict:
+    '''
+    The number and sum of the observed values, by label values.
+    '''
+    with self.lock:
+      return {key: (values[-2], values[-1]) for key, values in self.values.items()}
+
+  def render(self) -> list:
+    lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+    with self.lock:
+      for key, values in sorted(self.values.items()):
+        for bound, count in zip((*self.buckets, '+Inf'), (*values[:-2], values[-2])):
+          lines.append(f"{self.name}_bucket"
+                       f"{_labels((*self.labelnames, 'le'), (*key, bound))} {count}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {values[-2]}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {values[-1]}")
+    return lines
+
+
+STAGE_SECONDS = Histogram(
+    'analysis_stage_seconds', 'Wall time of each analysis stage.', ('stage',))
+STAGE_DB_QUERIES = Counter(
+    'analysis_stage_db_queries_total',
+    'Database queries made by each analysis stage.', ('stage',))
+LLM_STAGE_SECONDS = Histogram(
+    'analysis_llm_stage_seconds',
+    'Wall time of each LLM stage, including cached responses, by model.',
+    ('stage', 'model'))
+LLM_TOKENS = Counter(
+    'analysis_llm_tokens_total',
+    'Estimated prompt and completion tokens of each LLM stage, by model.',
+    ('stage', 'model', 'kind'))
+LLM_CACHE_REQUESTS = Counter(
+    'analysis_llm_cache_requests_total',
+    'LLM cache lookups of each stage, by result (hit or miss).',
+    ('stage', 'result'))
+CACHE_REQUESTS = Counter(
+    'analysis_cache_requests_total',
+    'Lookups of each tiered cache, by its shared cache and result: l1_hit (in '
+    'this process), l2_hit (in the shared cache) or miss.',
+    ('cache', 'result'))
+SINGLE_FLIGHT_CALLS = Counter(
+    'analysis_single_flight_calls_total',
+    'Coalesced computations, by result: computed, joined (waited on another '
+    'thread), shared (waited on another process) or timeout.',
+    ('name', 'result'))
+
+METRICS = [STAGE_SECONDS, STAGE_DB_QUERIES, LLM_STAGE_SECONDS, LLM_TOKENS,
+           LLM_CACHE_REQUESTS, CACHE_REQUESTS, SINGLE_FLIGHT_CALLS]
+
+
+def render_metrics() -> str:
+  '''
+  Render every metric of this process in the Prometheus text format.
+  '''
+  return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+class Trace:
+  '''
+  The stages of one request, and how long each took and how many database
+  queries it made.
+  '''
+
+  def __init__(self):
+    self.stages = {}
+    self.lock = threading.Lock()
+
+  def add(self, name: str, seconds: float, queries: int) -> None:
+    with self.lock:
+      total_seconds, total_queries = self.stages.get(name, (0, 0))
+      self.stages[name] = (total_seconds + seconds, total_queries + queries)
+
+  def summary(self) -> dict:
+    '''
+    The milliseconds and database queries of each stage, in the order the
+    stages first finished.
+    '''
+    with self.lock:
+      return {name: {'ms': round(seconds * 1000, 1), 'queries': queries}
+              for name, (seconds, queries) in self.stages.items()}
+
+  def server_timing(self) -> str:
+    '''
+    The stages as a Server-Timing header value.
+    '''
+    return ', '.join(
+        f'{name};dur={timing["ms"]};desc="{timing["queries"]} queries"'
+        for name, timing in self.summary().items())
+
+
+_trace = contextvars.ContextVar('analysis_trace', default=None)
+_stage = contextvars.ContextVar('analysis_stage', default=None)
+
+
+@contextmanager
+def trace():
+  '''
+  Collect the stages run within the block, including those run in other
+  threads or tasks that copied the block's context, into a Trace.
+  '''
+  # The previous value is restored rather than reset with a token, which
+  # fails if an async generator is closed from another context
+  previous = _trace.get()
+  current = Trace()
+  _trace.set(current)
+  try:
+    yield current
+  finally:
+    _trace.set(previous)
+
+
+@contextmanager
+def stage(name: str, count_queries: bool = True):
+  '''
+  Record the wall time and database queries of an analysis stage, both in the
+  process metrics and in the current request's trace. It can also decorate a
+  function that runs a whole stage.
+
+  :param name: The stage's name
+  :param count_queries: Whether to count the database queries made by this
+                        thread during the stage. Stages that overlap on one
+                        thread, like concurrent async tasks, cannot count them.
+  '''
+  queries = 0
+
+  def count_query(execute, sql, params, many, context):
+    nonlocal queries
+    queries += 1
+    return execute(sql, params, many, context)
+
+  previous = _stage.get()
+  _stage.set(name)
+  start = time.perf_counter()
+  try:
+    if count_queries:
+      with connection.execute_wrapper(count_query):
+        yield
+    else:
+      yield
+  finally:
+    _stage.set(previous)
+    record_stage(name, time.perf_counter() - start, queries)
+
+
+def record_stage(name: str, seconds: float, queries: int = 0) -> None:
+  '''
+  Record an analysis stage timed by the caller.
+
+  :param name: The stage's name
+  :param seconds: The stage's wall time
+  :param queries: The database queries the stage made
+  '''
+  STAGE_SECONDS.observe(seconds, stage=name)
+  STAGE_DB_QUERIES.inc(queries, stage=name)
+  if (current := _trace.get()) is not None:
+    current.add(name, seconds, queries)
+
+
+def current_stage() -> str:
+  '''
+  The name of the stage being run, or an empty string outside of any stage.
+  '''
+  return _stage.get() or ''
+
+
+def _labels(names: tuple, values: tuple) -> str:
+  if not names:
+    return ''
+  return '{' + ','.join(
+      f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _escape(value) -> str:
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+from typing import AsyncIterator
+
+from django.conf import settings
+from django.core.cache import caches
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.runnables import RunnableSequence
+
+from .instrumentation import LLM_CACHE_REQUESTS, current_stage
+from .llms import get_model_name
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model_name: str, prompt: str, fingerprint: str = '') -> str:
+  '''
+  Build the cache key for an LLM response.
+
+  :param model_name: The name of the model that generates the response
+  :param prompt: The fully rendered prompt
+  :param fingerprint: A fingerprint of the data the prompt was built from, so
+                      responses are invalidated when the data changes
+  :return: The cache key
+  '''
+  prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+  key = hashlib.sha256(
+      f"{model_name}\0{prompt_hash}\0{fingerprint}".encode()).hexdigest()
+  return f"llm-response:{key}"
+
+
+def _cache():
+  return caches[settings.LLM_CACHE_ALIAS]
+
+
+def _count_lookup(hit: bool) -> None:
+  LLM_CACHE_REQUESTS.inc(stage=current_stage(), result='hit' if hit else 'miss')
+
+
+def _key_for(chain: RunnableSequence, llm: BaseChatModel, inputs: dict,
+             fingerprint: str) -> str:
+  # The first step of every pipeline chain is its prompt template
+  prompt = chain.first.format(**inputs)
+  return cache_key(get_model_name(llm), prompt, fingerprint)
+
+
+def invoke_cached(chain: RunnableSequence, llm: BaseChatModel, inputs: dict,
+                  fingerprint: str = ''):
+  '''
+  Invoke a ``prompt | llm | parser`` chain, returning the cached output if the
+  same model has already answered the same prompt for the same data.
+
+  :param chain: The chain to invoke
+  :param llm: The language model used by the chain
+  :param inputs: The inputs for the chain's prompt
+  :param fingerprint: A fingerprint of the data the inputs were built from
+  :return: The output of the chain
+  '''
+  key = _key_for(chain, llm, inputs, fingerprint)
+  cached = _cache().get(key)
+  _count_lookup(cached is not None)
+  if cached is not None:
+    logger.info(f"LLM cache hit for {key}")
+    return cached['output']
+
+  output = chain.invoke(inputs)
+  _cache().set(key, {'output': output})
+  return output
+
+
+async def ainvoke_cached(chain: RunnableSequence, llm: BaseChatModel,
+                         inputs: dict, fingerprint: str = ''):
+  '''
+  Async version of invoke_cached().
+  '''
+  key = _key_for(chain, llm, inputs, fingerprint)
+  cached = await _cache().aget(key)
+  _count_lookup(cached is not None)
+  if cached is not None:
+    logger.info(f"LLM cache hit for {key}")
+    return cached['output']
+
+  output = await chain.ainvoke(inputs)
+  await _cache().aset(key, {'output': output})
+  return output
+
+
+async def astream_cached(chain: RunnableSequence, llm: BaseChatModel,
+                         inputs: dict, fingerprint: str = '') -> AsyncIterator[str]:
+  '''
+  Stream the text output of a chain, caching the full text once the stream is
+  finished. A cached response is yielded as a single chunk.
+  '''
+  key = _key_for(chain, llm, inputs, fingerprint)
+  cached = await _cache().aget(key)
+  _count_lookup(cached is not None)
+  if cached is not None:
+    logger.info(f"LLM cache hit for {key}")
+    yield cached['output']
+    return
+
+  chunks = []
+  async for chunk in chain.astream(inputs):
+    chunks.append(chunk)
+    yield chunk
+  await _cache().aset(key, {'output': ''.join(chunks)})
@@ -1,47 +1,275 @@
+import contextlib
+import contextvars
+import functools
+import time
+from typing import ClassVar
+
+import anthropic
 from django.conf import settings
+import httpx
+import openai
 
 from langchain_anthropic import ChatAnthropic
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.pydantic_v1 import root_validator
 from langchain_openai import ChatOpenAI
 
 from .enums import LLMChoice
+from .prompt_data import count_tokens
+from .rate_limit import RateLimiter
+
+# The stages of the analysis pipeline that call a language model, in order.
+# Queries comparing several centers only run the comparison stage.
+PIPELINE_STAGES = ('filtering', 'trend', 'anomaly', 'insights', 'comparison')
+
+# The time.monotonic() value by which the LLM stage running in this context
+# must have its response, or None if it has no deadline
+_deadline = contextvars.ContextVar('llm_deadline', default=None)
 
 
+@functools.cache
 def get_llm(llm_choice: LLMChoice) -> BaseChatModel:
   '''
   Get the language model based on the user's choice.
 
+  Each model's client is created once per process and shared by every request,
+  so its pooled HTTP connections are reused. Requests are held until the
+  provider's rate limits allow them, and the provider SDK retries rate limit,
+  overload and connection errors with jittered exponential backoff.
+
   Args:
     llm_choice: The user's choice of language model.
   '''
   if llm_choice == LLMChoice.CLAUDE3_OPUS:
-    llm = ChatAnthropic(
+    llm = RateLimitedChatAnthropic(
         model='claude-3-opus-20240229',
         temperature=settings.LLM_TEMP,
     )
   elif llm_choice == LLMChoice.CLAUDE3_SONNET:
-    llm = ChatAnthropic(
+    llm = RateLimitedChatAnthropic(
         model='claude-3-sonnet-20240229',
         temperature=settings.LLM_TEMP,
     )
   elif llm_choice == LLMChoice.CLAUDE3_HAIKU:
-    llm = ChatAnthropic(
+    llm = RateLimitedChatAnthropic(
         model='claude-3-haiku-20240307',
         temperature=settings.LLM_TEMP,
     )
   elif llm_choice == LLMChoice.CLAUDE2:
-    llm = ChatAnthropic(
+    llm = RateLimitedChatAnthropic(
         model='claude-2.1',
         temperature=settings.LLM_TEMP,
     )
   elif llm_choice == LLMChoice.CHATGPT35:
-    llm = ChatOpenAI(
+    llm = RateLimitedChatOpenAI(
         model='gpt-3.5-turbo-0125',
         temperature=settings.LLM_TEMP,
+        **_openai_clients(),
     )
   else:  # default to ChatGPT-4
-    llm = ChatOpenAI(
+    llm = RateLimitedChatOpenAI(
         model='gpt-4-0125-preview',
         temperature=settings.LLM_TEMP,
+        **_openai_clients(),
     )
   return llm
+
+
+def get_provider(llm_choice: LLMChoice) -> str:
+  '''
+  Get the name of the API provider that serves the user's choice of language
+  model, as used in the LLM_PROVIDER_RATE_LIMITS setting.
+
+  Args:
+    llm_choice: The user's choice of language model.
+  '''
+  if llm_choice in (LLMChoice.CLAUDE2, LLMChoice.CLAUDE3_OPUS,
+                    LLMChoice.CLAUDE3_SONNET, LLMChoice.CLAUDE3_HAIKU):
+    return 'anthropic'
+  return 'openai'
+
+
+def get_stage_llm_choice(stage: str, llm_choice: LLMChoice) -> LLMChoice:
+  '''
+  Get the language model that runs a stage of the analysis pipeline, as routed
+  by the LLM_STAGE_MODELS setting.
+
+  Args:
+    stage: The pipeline stage, one of PIPELINE_STAGES.
+    llm_choice: The user's choice of language model.
+  '''
+  route = settings.LLM_STAGE_MODELS.get(stage, 'selected')
+  if route == 'selected':
+    return llm_choice
+  if route == 'fast':
+    # Stay with the user's provider, so only its API key is needed
+    return LLMChoice(settings.LLM_FAST_MODELS[get_provider(llm_choice)])
+  return LLMChoice(route)
+
+
+@functools.cache
+def get_rate_limiters(provider: str) -> tuple:
+  '''
+  Get the request and token rate limiters shared by every model of a provider
+  in this process.
+
+  Args:
+    provider: The provider's name, as returned by get_provider().
+
+  Returns:
+    A (requests, tokens) tuple of RateLimiters.
+  '''
+  limits = settings.LLM_PROVIDER_RATE_LIMITS[provider]
+  return (RateLimiter(limits['requests_per_minute']),
+          RateLimiter(limits['tokens_per_minute']))
+
+
+class _RateLimited:
+  '''
+  Holds each request to the provider until both its requests per minute and
+  tokens per minute budgets allow it. Only the prompt's tokens are counted,
+  since the length of the response is not known in advance.
+  '''
+  provider: ClassVar[str]
+
+  def _limiters(self, messages: list) -> list:
+    requests, tokens = get_rate_limiters(self.provider)
+    prompt_tokens = sum(count_tokens(str(message.content)) for message in messages)
+    return [(requests, 1), (tokens, prompt_tokens)]
+
+  def _generate(self, messages, *args, **kwargs):
+    for limiter, amount in self._limiters(messages):
+      limiter.acquire(amount, _deadline.get())
+    return super()._generate(messages, *args, **kwargs)
+
+  async def _agenerate(self, messages, *args, **kwargs):
+    for limiter, amount in self._limiters(messages):
+      await limiter.aacquire(amount)
+    return await super()._agenerate(messages, *args, **kwargs)
+
+  def _stream(self, messages, *args, **kwargs):
+    for limiter, amount in self._limiters(messages):
+      limiter.acquire(amount, _deadline.get())
+    yield from super()._stream(messages, *args, **kwargs)
+
+  async def _astream(self, messages, *args, **kwargs):
+    for limiter, amount in self._limiters(messages):
+      await limiter.aacquire(amount)
+    async for chunk in super()._astream(messages, *args, **kwargs):
+      yield chunk
+
+
+class RateLimitedChatOpenAI(_RateLimited, ChatOpenAI):
+  provider: ClassVar[str] = 'openai'
+
+
+class RateLimitedChatAnthropic(_RateLimited, ChatAnthropic):
+  provider: ClassVar[str] = 'anthropic'
+
+  @root_validator()
+  def use_pooled_clients(cls, values: dict) -> dict:
+    # ChatAnthropic does not take its clients as arguments, so replace the
+    # ones it creates with clients using the configured pool and retries
+    api_key = values['anthropic_api_key'].get_secret_value()
+    values['_client'] = anthropic.Client(
+        api_key=api_key, http_client=_http_client(),
+        max_retries=settings.LLM_MAX_RETRIES)
+    values['_async_client'] = anthropic.AsyncClient(
+        api_key=api_key, http_client=httpx.AsyncClient(**_http_client_options()),
+        max_retries=settings.LLM_MAX_RETRIES)
+    return values
+
+
+def _openai_clients() -> dict:
+  return {
+      'client': openai.OpenAI(
+          api_key=settings.OPENAI_API_KEY,
+          http_client=_http_client(),
+          max_retries=settings.LLM_MAX_RETRIES,
+      ).chat.completions,
+      'async_client': openai.AsyncOpenAI(
+          api_key=settings.OPENAI_API_KEY,
+          http_client=httpx.AsyncClient(**_http_client_options()),
+          max_retries=settings.LLM_MAX_RETRIES,
+      ).chat.completions,
+  }
+
+
+def _http_client_options() -> dict:
+  return {
+      'limits': httpx.Limits(
+          max_connections=settings.LLM_MAX_CONNECTIONS,
+          max_keepalive_connections=settings.LLM_MAX_CONNECTIONS,
+      ),
+      # A single request may not outlast the stage it belongs to
+      'timeout': settings.LLM_STAGE_TIMEOUT,
+  }
+
+
+def _http_client() -> httpx.Client:
+  options = _http_client_options()
+  return httpx.Client(
+      transport=_DeadlineTransport(limits=options.pop('limits')), **options)
+
+
+class _DeadlineTransport(httpx.HTTPTransport):
+  '''
+  Shortens each request's timeouts to what is left of its stage's deadline,
+  and fails the requests made once it has passed, like the SDK's retries of
+  a request that timed out. Async requests need none of this, since the
+  stages awaiting them are cancelled when they time out.
+  '''
+
+  def handle_request(self, request: httpx.Request) -> httpx.Response:
+    deadline = _deadline.get()
+    if deadline is not None:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise httpx.TimeoutException(
+            'The LLM stage timed out before the request', request=request)
+      request.extensions['timeout'] = {
+          phase: remaining if timeout is None else min(timeout, remaining)
+          for phase, timeout in request.extensions.get('timeout', {}).items()
+      } or httpx.Timeout(remaining).as_dict()
+    return super().handle_request(request)
+
+
+@contextlib.contextmanager
+def llm_deadline(deadline: float):
+  '''
+  Give up on the blocking requests to the models made in this context once
+  the deadline passes, retries included, so a stage that timed out does not
+  keep holding the thread it runs on.
+
+  Args:
+    deadline: The time.monotonic() value by which the responses are needed.
+  '''
+  token = _deadline.set(deadline)
+  try:
+    yield
+  finally:
+    _deadline.reset(token)
+
+
+def get_model_name(llm: BaseChatModel) -> str:
+  '''
+  Get the provider's name for the model behind a language model client.
+
+  Args:
+    llm: The language model client.
+  '''
+  # ChatOpenAI calls it model_name and ChatAnthropic calls it model
+  return (getattr(llm, 'model_name', None) or getattr(llm, 'model', None)
+          or llm._llm_type)
+
+
+def get_prompt_token_budget(llm_choice: LLMChoice) -> int:
+  '''
+  Get the maximum number of tokens of raw foot traffic data to put in a prompt
+  for the user's choice of language model.
+
+  Args:
+    llm_choice: The user's choice of language model.
+  '''
+  return settings.PROMPT_DATA_TOKEN_BUDGETS.get(
+      llm_choice.value, settings.PROMPT_DATA_DEFAULT_TOKEN_BUDGET)
@@ -0,0 +1,190 @@
+import datetime
+import hashlib
+import logging
+
+from django.db.models.query import QuerySet
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class TrafficSeries:
+  '''
+  A single shopping center's daily foot traffic held in NumPy arrays.
+
+  The series is loaded once (one query) and every statistic the analysis
+  pipeline needs -- z-scores, anomalies, mean/median/stddev and the monthly,
+  weekly and day-of-week aggregates -- is computed from the same buffer.
+  Missing foot traffic values are stored as NaN and ignored by the
+  aggregates, matching the behavior of the ORM's Avg/StdDev.
+  '''
+
+  def __init__(self, days: np.ndarray, ft: np.ndarray):
+    order = np.argsort(days, kind='stable')
+    self.days = days[order].astype('datetime64[D]')
+    self.ft = ft[order].astype(np.float64)
+
+  @classmethod
+  def from_rows(cls, rows) -> 'TrafficSeries':
+    '''
+    Build a series from an iterable of (day, ft) pairs.
+
+    :param rows: An iterable of (datetime.date, int or None) pairs
+    :return: A TrafficSeries
+    '''
+    rows = list(rows)
+    days = np.array([day for day, _ in rows], dtype='datetime64[D]')
+    ft = np.array([np.nan if ft is None else ft for _, ft in rows],
+                  dtype=np.float64)
+    return cls(days, ft)
+
+  @classmethod
+  def from_queryset(cls, queryset: QuerySet) -> 'TrafficSeries':
+    '''
+    Build a series from a queryset of FootTraffic objects with a single query.
+
+    :param queryset: A Django QuerySet of FootTraffic objects
+    :return: A TrafficSeries
+    '''
+    return cls.from_rows(queryset.values_list('day', 'ft'))
+
+  def fingerprint(self) -> str:
+    '''
+    A digest of every (day, ft) pair in the series. It changes whenever any row
+    is added, removed or modified, so it can be used to version anything
+    derived from the series.
+    '''
+    digest = hashlib.sha256(self.days.tobytes())
+    digest.update(self.ft.tobytes())
+    return digest.hexdigest()
+
+  def __len__(self) -> int:
+    return len(self.days)
+
+  @property
+  def earliest_date(self) -> datetime.date:
+    return self.days[0].item()
+
+  @property
+  def latest_date(self) -> datetime.date:
+    return self.days[-1].item()
+
+  @property
+  def mean(self) -> float:
+    return float(np.nanmean(self.ft))
+
+  @property
+  def median(self) -> float:
+    return float(np.nanmedian(self.ft))
+
+  @property
+  def stddev(self) -> float:
+    # Population standard deviation, like the ORM's StdDev aggregate
+    return float(np.nanstd(self.ft))
+
+  def z_scores(self) -> np.ndarray:
+    '''
+    Calculate the z-score of every day in the series. Days without a foot
+    traffic value get a NaN z-score.
+    '''
+    return calculate_z_scores(self.ft)
+
+  def daily_z_scores(self) -> dict:
+    '''
+    Returns a dictionary where the keys are the dates and the values are tuples
+    of the foot traffic value and the z-score for that value.
+    '''
+    z_scores = self.z_scores()
+    return {
+        day.item(): (_to_ft(ft), float(z_score))
+        for day, ft, z_score in zip(self.days, self.ft, z_scores)
+        if not np.isnan(ft)
+    }
+
+  def monthly_averages(self) -> pd.Series:
+    '''
+    Calculate the daily foot traffic average for each calendar month.
+
+    Returns a Series indexed by month end, including any empty months in the
+    middle of the range, like ``resample('ME').mean()``.
+    '''
+    months = self.days.astype('datetime64[M]')
+    first, last = months[0], months[-1]
+    month_range = np.arange(first, last + 1)
+    averages = _group_means(
+        (months - first).astype(np.int64), self.ft, len(month_range))
+    index = pd.DatetimeIndex(
+        (month_range + 1).astype('datetime64[D]') - np.timedelta64(1, 'D'))
+    return pd.Series(averages, index=index, name='foot_traffic_count')
+
+  def weekly_averages(self) -> list:
+    '''
+    Calculate the daily foot traffic average for each ISO week.
+
+    Returns a list of dictionaries with ``year``, ``week`` and ``avg_ft`` keys,
+    in ascending order of date.
+    '''
+    week_starts = self.days - _weekday(self.days)
+    unique_starts, inverse = np.unique(week_starts, return_inverse=True)
+    averages = _group_means(inverse, self.ft, len(unique_starts))
+    weekly = []
+    for week_start, avg_ft in zip(unique_starts, averages):
+      if np.isnan(avg_ft):
+        continue
+      iso_year, iso_week, _ = week_start.item().isocalendar()
+      weekly.append({'year': iso_year, 'week': iso_week, 'avg_ft': avg_ft})
+    return weekly
+
+  def day_of_week_averages(self) -> dict:
+    '''
+    Calculate the foot traffic average for each day of the week.
+
+    Returns a dictionary keyed by Django weekday (1 = Sunday, 7 = Saturday),
+    in ascending order of weekday, for the weekdays present in the data.
+    '''
+    # Monday-based weekday (0-6) to Django's Sunday-based weekday (1-7)
+    django_weekdays = (_weekday(self.days).astype(np.int64) + 1) % 7 + 1
+    averages = _group_means(django_weekdays - 1, self.ft, 7)
+    return {
+        weekday + 1: float(avg_ft)
+        for weekday, avg_ft in enumerate(averages)
+        if not np.isnan(avg_ft)
+    }
+
+
+def calculate_z_scores(values: np.ndarray) -> np.ndarray:
+  '''
+  Population z-scores of an array, ignoring NaNs.
+  '''
+  if values.size == 0 or np.all(np.isnan(values)):
+    return np.full(values.shape, np.nan)
+  stddev = np.nanstd(values)
+  if stddev == 0:
+    return np.zeros(values.shape)
+  return (values - np.nanmean(values)) / stddev
+
+
+def _group_means(groups: np.ndarray, values: np.ndarray, n_groups: int) -> np.ndarray:
+  '''
+  Mean of ``values`` per integer group label, ignoring NaNs. Groups without any
+  values get a NaN mean.
+  '''
+  present = ~np.isnan(values)
+  sums = np.bincount(groups[present], weights=values[present],
+                     minlength=n_groups)
+  counts = np.bincount(groups[present], minlength=n_groups)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return sums / counts
+
+
+def _weekday(days: np.ndarray) -> np.ndarray:
+  '''
+  Monday-based weekday (0-6) of an array of datetime64[D] values.
+  '''
+  # 1970-01-01 was a Thursday
+  return ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+
+
+def _to_ft(value: float):
+  return int(value) if float(value).is_integer() else float(value)
@@ -0,0 +1,137 @@
+import functools
+import logging
+
+import numpy as np
+
+from .metrics import TrafficSeries
+
+logger = logging.getLogger(__name__)
+
+# Rough characters per token, used when the tokenizer cannot be loaded
+CHARS_PER_TOKEN = 4
+
+
+@functools.cache
+def _encoding():
+  import tiktoken
+  try:
+    return tiktoken.get_encoding('cl100k_base')
+  except Exception as e:
+    # tiktoken downloads its encodings on first use, which fails offline
+    logger.warning(f"Could not load the tiktoken encoding, estimating token "
+                   f"counts instead: {e}")
+    return None
+
+
+def count_tokens(text: str) -> int:
+  '''
+  Count the tokens in a piece of prompt text.
+
+  Every provider's tokenizer is approximated with OpenAI's cl100k_base
+  encoding, which is close enough for budgeting.
+
+  :param text: The text to count
+  :return: The number of tokens
+  '''
+  encoding = _encoding()
+  if encoding is None:
+    return -(-len(text) // CHARS_PER_TOKEN)
+  return len(encoding.encode(text, disallowed_special=()))
+
+
+def format_series(series: TrafficSeries, label: str, token_budget: int) -> str:
+  '''
+  Render a foot traffic series as a compact block of text for a prompt.
+
+  The block has a single header naming the shopping center, followed by one
+  line per date range holding only the values. Daily values are used if they
+  fit within the token budget; otherwise the series is averaged by week, and
+  then by month, until it fits. If even the monthly averages do not fit, the
+  oldest lines are dropped.
+
+  :param series: The foot traffic series
+  :param label: The shopping center's name and location for the header
+  :param token_budget: The maximum number of tokens the block may use
+  :return: The rendered block
+  '''
+  for granularity in (_daily_lines, _weekly_lines, _monthly_lines):
+    header, lines = granularity(series, label)
+    block = '\n'.join([header, *lines])
+    if count_tokens(block) <= token_budget:
+      return block
+
+  # Keep the most recent lines that fit
+  kept = []
+  used = count_tokens(header)
+  for line in reversed(lines):
+    used += count_tokens(line) + 1
+    if used > token_budget:
+      break
+    kept.append(line)
+  logger.warning(f"Foot traffic for {label} does not fit in {token_budget} "
+                 f"tokens even as monthly averages, keeping the last "
+                 f"{len(kept)} of {len(lines)} lines")
+  return '\n'.join([header, *reversed(kept)])
+
+
+def _dense(series: TrafficSeries) -> tuple:
+  '''
+  The series with a value (NaN if missing) for every day in its range.
+  '''
+  days = np.arange(series.days[0], series.days[-1] + 1)
+  values = np.full(len(days), np.nan)
+  values[(series.days - series.days[0]).astype(np.int64)] = series.ft
+  return days, values
+
+
+def _daily_lines(series: TrafficSeries, label: str) -> tuple:
+  days, values = _dense(series)
+  # Start a new line every Monday (1970-01-01 was a Thursday)
+  mondays = np.flatnonzero((days.astype(np.int64) + 3) % 7 == 0)
+  breaks = [0, *mondays[mondays > 0], len(days)]
+  lines = [
+      f"{_day_label(days[start])}..{_day_label(days[end - 1])}: "
+      f"{_values(values[start:end])}"
+      for start, end in zip(breaks, breaks[1:])
+  ]
+  header = (f"Daily foot traffic for {label}, one line per week. Each line "
+            f"lists the value for every day in its date range, in order "
+            f"('-' means no data).")
+  return header, lines
+
+
+def _weekly_lines(series: TrafficSeries, label: str) -> tuple:
+  weeks = series.weekly_averages()
+  lines = []
+  # One line per quarter of weeks
+  for start in range(0, len(weeks), 13):
+    chunk = weeks[start:start + 13]
+    lines.append(
+        f"Weeks {chunk[0]['year']}-W{chunk[0]['week']:02d}.."
+        f"{chunk[-1]['year']}-W{chunk[-1]['week']:02d}: "
+        f"{_values(np.array([week['avg_ft'] for week in chunk]))}")
+  header = (f"Average daily foot traffic by ISO week for {label}. Each line "
+            f"lists the average for every week in its range, in order.")
+  return header, lines
+
+
+def _monthly_lines(series: TrafficSeries, label: str) -> tuple:
+  months = series.monthly_averages()
+  lines = []
+  for year in sorted(set(months.index.year)):
+    in_year = months[months.index.year == year]
+    lines.append(
+        f"{in_year.index[0].strftime('%Y-%m')}..{in_year.index[-1].strftime('%Y-%m')}: "
+        f"{_values(in_year.values)}")
+  header = (f"Average daily foot traffic by month for {label}. Each line "
+            f"lists the average for every month in its range, in order "
+            f"('-' means no data).")
+  return header, lines
+
+
+def _day_label(day: np.datetime64) -> str:
+  return day.item().strftime('%Y-%m-%d %a')
+
+
+def _values(values: np.ndarray) -> str:
+  return ' '.join('-' if np.isnan(value) else f"{value:.0f}" for value in values)
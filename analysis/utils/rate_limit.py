@@ -0,0 +1,62 @@
+import asyncio
+import threading
+import time
+
+
+class RateLimiter:
+  '''
+  A thread-safe token bucket that limits how much of a quota, like requests or
+  tokens, is used per minute. Up to a minute's worth can be used in a burst,
+  after which use is spread out evenly.
+  '''
+
+  def __init__(self, per_minute: float):
+    '''
+    :param per_minute: The sustained amount allowed per minute
+    '''
+    self.rate = per_minute / 60
+    self.capacity = per_minute
+    self.available = per_minute
+    self.updated_at = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self, amount: float = 1, deadline: float = None) -> None:
+    '''
+    Block until the given amount of the quota may be used.
+
+    :param amount: The amount about to be used
+    :param deadline: The time.monotonic() value after which to stop waiting,
+                     or None to wait as long as it takes
+    :raises TimeoutError: If the amount cannot be used by the deadline
+    '''
+    while wait := self._take(amount):
+      if deadline is not None and time.monotonic() + wait > deadline:
+        raise TimeoutError('The rate limit does not allow the request in time')
+      time.sleep(wait)
+
+  async def aacquire(self, amount: float = 1) -> None:
+    '''
+    Async version of acquire(), which waits without blocking the event loop.
+    '''
+    while wait := self._take(amount):
+      await asyncio.sleep(wait)
+
+  def _take(self, amount: float) -> float:
+    '''
+    Take the amount from the bucket if it is available.
+
+    :return: 0 if the amount was taken, otherwise the seconds to wait before
+             trying again
+    '''
+    with self.lock:
+      now = time.monotonic()
+      self.available = min(
+          self.capacity, self.available + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+      # An amount larger than the bucket waits for a full bucket, and the
+      # debt is paid off before anything else is let through
+      needed = min(amount, self.capacity)
+      if self.available >= needed:
+        self.available -= amount
+        return 0
+      return (needed - self.available) / self.rate
@@ -0,0 +1,208 @@
+from collections import defaultdict, namedtuple
+import logging
+import time
+
+from django.conf import settings
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+
+from ..models import ShoppingCenter
+from .data_version import VersionedValue
+
+logger = logging.getLogger(__name__)
+
+CenterMatch = namedtuple(
+    'CenterMatch', ['shopping_center_id', 'name', 'city', 'score'])
+ExtractedEntities = namedtuple(
+    'ExtractedEntities', ['shopping_center', 'city', 'confidence'])
+
+# Longest shopping center or city name, in words, looked for in a query
+MAX_PHRASE_WORDS = 8
+
+
+class CenterIndex:
+  '''
+  An in-memory index of the distinct shopping centers and cities, used to fuzzy
+  match the names extracted from a user's query without scanning the fact
+  table.
+
+  Names are matched with rapidfuzz's ratio scorer. When a city is known, only
+  the centers in that city are scored. Otherwise, candidates are first blocked
+  by the number of character trigrams they share with the query, and only the
+  best RESOLVER_MAX_CANDIDATES of them are scored.
+  '''
+
+  def __init__(self, centers):
+    '''
+    :param centers: An iterable of (shopping_center_id, name, city) tuples
+    '''
+    centers = sorted(set(centers), key=lambda c: c[0])
+    self.ids = [c[0] for c in centers]
+    self.names = [c[1] for c in centers]
+    self.cities = [c[2] for c in centers]
+    self.processed_names = [utils.default_process(name) for name in self.names]
+
+    centers_by_city = defaultdict(list)
+    for i, city in enumerate(self.cities):
+      if city:
+        centers_by_city[city].append(i)
+    self.centers_by_city = {
+        city: np.array(indices) for city, indices in centers_by_city.items()}
+    self.city_names = list(self.centers_by_city)
+    self.processed_city_names = [
+        utils.default_process(city) for city in self.city_names]
+
+    postings = defaultdict(list)
+    for i, name in enumerate(self.processed_names):
+      for trigram in _trigrams(name):
+        postings[trigram].append(i)
+    self.trigram_postings = {
+        trigram: np.array(indices, dtype=np.int32)
+        for trigram, indices in postings.items()}
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  def match_cities(self, city: str, limit: int = 5) -> list:
+    '''
+    Fuzzy match a city name against the cities in the index.
+
+    :param city: The city name to match
+    :param limit: The maximum number of matches to return
+    :return: A list of (city, score) tuples, best first, scoring at least
+             MIN_RATIO
+    '''
+    matches = process.extract(
+        city, self.city_names, scorer=fuzz.ratio,
+        processor=utils.default_process, score_cutoff=settings.MIN_RATIO,
+        limit=limit)
+    return [(match, score) for match, score, _ in matches]
+
+  def search(self, name: str, city: str = None, limit: int = 10) -> list:
+    '''
+    Fuzzy match a shopping center name, optionally within a city.
+
+    :param name: The shopping center name to match
+    :param city: An exact city name from the index, or None to search all
+                 cities
+    :param limit: The maximum number of matches to return
+    :return: A list of CenterMatch tuples, best first, scoring at least
+             MIN_RATIO
+    '''
+    if city is not None:
+      candidates = self.centers_by_city.get(city, np.array([], dtype=int))
+    else:
+      candidates = self._block(utils.default_process(name))
+
+    matches = process.extract(
+        utils.default_process(name),
+        [self.processed_names[i] for i in candidates],
+        scorer=fuzz.ratio, processor=None, score_cutoff=settings.MIN_RATIO,
+        limit=limit)
+    return [
+        CenterMatch(self.ids[candidates[j]], self.names[candidates[j]],
+                    self.cities[candidates[j]], score)
+        for _, score, j in matches
+    ]
+
+  def extract(self, query: str) -> ExtractedEntities:
+    '''
+    Find the shopping center and city mentioned in a free-text query without
+    calling an LLM, by scoring every window of consecutive words in the query
+    against the known names.
+
+    The city is looked for first, and the shopping center is then looked for
+    in the words around it (within that city, if one was found).
+
+    :param query: The user's query
+    :return: The best matching shopping center and city names (either may be
+             None) and the lowest of their scores as the confidence
+    '''
+    words = utils.default_process(query).split()
+
+    city, city_score, city_span = None, None, (0, 0)
+    if self.city_names:
+      match = _best_window(words, self.processed_city_names)
+      if match is not None and match[1] >= settings.MIN_RATIO:
+        city = self.city_names[match[0]]
+        city_score, city_span = match[1], match[2]
+
+    if city is not None:
+      candidates = self.centers_by_city[city]
+    else:
+      candidates = self._block(' '.join(words))
+    choices = [self.processed_names[i] for i in candidates]
+
+    name, name_score = None, 0.0
+    for segment in (words[:city_span[0]], words[city_span[1]:]):
+      match = _best_window(segment, choices)
+      if match is not None and match[1] > name_score:
+        name, name_score = self.names[candidates[match[0]]], match[1]
+
+    confidence = name_score if city_score is None else min(name_score, city_score)
+    return ExtractedEntities(name, city, confidence)
+
+  def _block(self, processed_name: str) -> np.ndarray:
+    '''
+    The indexes of the centers sharing the most trigrams with a name.
+    '''
+    postings = [self.trigram_postings[trigram]
+                for trigram in _trigrams(processed_name)
+                if trigram in self.trigram_postings]
+    if not postings:
+      return np.array([], dtype=int)
+    overlap = np.bincount(np.concatenate(postings), minlength=len(self))
+    candidates = np.flatnonzero(overlap)
+    max_candidates = settings.RESOLVER_MAX_CANDIDATES
+    if len(candidates) > max_candidates:
+      best = np.argpartition(overlap[candidates], -max_candidates)
+      candidates = candidates[best[-max_candidates:]]
+    return candidates
+
+
+def _best_window(words: list, choices: list):
+  '''
+  Score every window of consecutive words against every choice.
+
+  :return: A tuple of the index of the best choice, its score and the
+           (start, end) span of the words it matched, or None if there are no
+           words or choices. Ties go to the latest window, since names
+           usually follow the words that introduce them ("... in Miami").
+  '''
+  spans = [(start, end)
+           for start in range(len(words))
+           for end in range(start + 1, min(start + MAX_PHRASE_WORDS, len(words)) + 1)]
+  if not spans or not choices:
+    return None
+  windows = [' '.join(words[start:end]) for start, end in spans]
+  scores = process.cdist(windows, choices, scorer=fuzz.ratio, processor=None)
+  # Flip the windows so argmax, which returns the first maximum, prefers the
+  # latest one
+  flipped = scores[::-1]
+  window, choice = np.unravel_index(np.argmax(flipped), flipped.shape)
+  return choice, float(flipped[window, choice]), spans[len(spans) - 1 - window]
+
+
+def _trigrams(processed_name: str) -> set:
+  padded = f"  {processed_name} "
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_center_index() -> CenterIndex:
+  '''
+  Get this process's center index, building it on first use and rebuilding it
+  when data has been loaded since it was built.
+  '''
+  return _index.get()
+
+
+def build_center_index() -> CenterIndex:
+  start = time.perf_counter()
+  index = CenterIndex(
+      ShoppingCenter.objects.values_list('shopping_center_id', 'name', 'city'))
+  logger.info(f"Built center index of {len(index)} centers in "
+              f"{time.perf_counter() - start:.2f}s")
+  return index
+
+
+_index = VersionedValue(build_center_index)
@@ -0,0 +1,207 @@
+from collections import defaultdict
+import datetime
+from functools import reduce
+import math
+import operator
+
+import numpy as np
+import pandas as pd
+from django.db.models import Q
+
+from ..models import DayOfWeekTraffic, MonthlyTraffic, WeeklyTraffic
+
+
+def _week_start(day: datetime.date) -> datetime.date:
+  return day - datetime.timedelta(days=day.weekday())
+
+
+def _month_start(day: datetime.date) -> datetime.date:
+  return day.replace(day=1)
+
+
+def _django_weekday(day: datetime.date) -> int:
+  # Monday-based weekday (0-6) to Django's Sunday-based weekday (1-7)
+  return (day.weekday() + 1) % 7 + 1
+
+
+# Each rollup model, the field holding its period, and the period of a day
+ROLLUPS = [
+    (WeeklyTraffic, 'week_start', _week_start),
+    (MonthlyTraffic, 'month', _month_start),
+    (DayOfWeekTraffic, 'weekday', _django_weekday),
+]
+
+
+class RollupDeltas:
+  '''
+  Accumulates the totals of newly loaded foot traffic rows and adds them to
+  the weekly, monthly and day-of-week rollups in one pass when saved, after
+  each batch of a load. Only the rollup rows of the periods that received new
+  rows are read and written.
+
+  A row replacing one already in the FootTraffic table must have the old
+  value taken back with remove(), otherwise it is counted twice.
+  '''
+
+  def __init__(self):
+    self.deltas = {model: defaultdict(lambda: [0, 0, 0]) for model, _, _ in ROLLUPS}
+
+  def add(self, center_id: str, day: datetime.date, ft: int) -> None:
+    '''
+    Add a new day of foot traffic.
+
+    :param center_id: The shopping center's identifier
+    :param day: The date of the foot traffic
+    :param ft: The foot traffic value
+    '''
+    self._apply(center_id, day, ft, 1)
+
+  def remove(self, center_id: str, day: datetime.date, ft: int) -> None:
+    '''
+    Take back a day of foot traffic added earlier in the same load, like a
+    row replaced by a later row of the same center and day.
+
+    :param center_id: The shopping center's identifier
+    :param day: The date of the foot traffic
+    :param ft: The foot traffic value that was added
+    '''
+    self._apply(center_id, day, ft, -1)
+
+  def _apply(self, center_id: str, day: datetime.date, ft: int, sign: int) -> None:
+    for model, _, period in ROLLUPS:
+      delta = self.deltas[model][(center_id, period(day))]
+      delta[0] += sign
+      delta[1] += sign * ft
+      delta[2] += sign * ft * ft
+
+  def save(self) -> None:
+    '''
+    Add the accumulated totals to the rollup tables.
+    '''
+    for model, field, _ in ROLLUPS:
+      deltas = self.deltas[model]
+      if not deltas:
+        continue
+
+      existing = model.objects.filter(**{
+          'center_id__in': {center_id for center_id, _ in deltas},
+          f"{field}__in": {period for _, period in deltas},
+      }).values_list('center_id', field, 'count', 'total', 'total_sq')
+      totals = {(center_id, period): [count, total, total_sq]
+                for center_id, period, count, total, total_sq in existing}
+
+      rollups = []
+      emptied = []
+      for (center_id, period), (count, total, total_sq) in deltas.items():
+        old_count, old_total, old_total_sq = totals.get((center_id, period), (0, 0, 0))
+        if old_count + count <= 0:
+          # Every day of the period was taken back, like a day whose foot
+          # traffic was replaced by a blank one
+          emptied.append(Q(center_id=center_id, **{field: period}))
+          continue
+        rollups.append(model(**{
+            'center_id': center_id,
+            field: period,
+            'count': old_count + count,
+            'total': old_total + total,
+            'total_sq': old_total_sq + total_sq,
+        }))
+      if emptied:
+        model.objects.filter(reduce(operator.or_, emptied)).delete()
+      model.objects.bulk_create(
+          rollups,
+          update_conflicts=True,
+          unique_fields=['center', field],
+          update_fields=['count', 'total', 'total_sq'],
+          batch_size=1000,
+      )
+      deltas.clear()
+
+
+class CenterRollups:
+  '''
+  A shopping center's weekly, monthly and day-of-week rollups, read with one
+  small query per table.
+
+  It provides the same aggregates as TrafficSeries, so either can be used to
+  build the analysis prompts.
+  '''
+
+  def __init__(self, weekly: list, monthly: list, day_of_week: list):
+    '''
+    :param weekly: (week_start, count, total) tuples, in order of week
+    :param monthly: (month, count, total) tuples, in order of month
+    :param day_of_week: (weekday, count, total, total_sq) tuples, in order of
+                        weekday
+    '''
+    self.weekly = weekly
+    self.monthly = monthly
+    self.day_of_week = day_of_week
+
+  @classmethod
+  def load(cls, center_id: str) -> 'CenterRollups':
+    '''
+    Load the rollups of a shopping center.
+
+    :param center_id: The shopping center's identifier
+    :return: A CenterRollups, which is empty if the center has no rollups
+    '''
+    # A period without days, left by an earlier load, has no average
+    return cls(
+        list(WeeklyTraffic.objects.filter(center_id=center_id, count__gt=0).order_by(
+            'week_start').values_list('week_start', 'count', 'total')),
+        list(MonthlyTraffic.objects.filter(center_id=center_id, count__gt=0).order_by(
+            'month').values_list('month', 'count', 'total')),
+        list(DayOfWeekTraffic.objects.filter(center_id=center_id, count__gt=0).order_by(
+            'weekday').values_list('weekday', 'count', 'total', 'total_sq')),
+    )
+
+  def __bool__(self) -> bool:
+    return bool(self.day_of_week)
+
+  @property
+  def mean(self) -> float:
+    count = sum(row[1] for row in self.day_of_week)
+    total = sum(row[2] for row in self.day_of_week)
+    return total / count
+
+  @property
+  def stddev(self) -> float:
+    # Population standard deviation, like TrafficSeries.stddev. The sums are
+    # exact integers, so the variance is computed without cancellation error.
+    count = sum(row[1] for row in self.day_of_week)
+    total = sum(row[2] for row in self.day_of_week)
+    total_sq = sum(row[3] for row in self.day_of_week)
+    return math.sqrt((count * total_sq - total * total) / (count * count))
+
+  def monthly_averages(self) -> pd.Series:
+    '''
+    The daily foot traffic average for each calendar month, as a Series indexed
+    by month end that includes any empty months in the middle of the range.
+    '''
+    months = np.array([month for month, _, _ in self.monthly], dtype='datetime64[M]')
+    month_range = np.arange(months[0], months[-1] + 1)
+    averages = np.full(len(month_range), np.nan)
+    averages[(months - months[0]).astype(np.int64)] = [
+        total / count for _, count, total in self.monthly]
+    index = pd.DatetimeIndex(
+        (month_range + 1).astype('datetime64[D]') - np.timedelta64(1, 'D'))
+    return pd.Series(averages, index=index, name='foot_traffic_count')
+
+  def weekly_averages(self) -> list:
+    '''
+    The daily foot traffic average for each ISO week, as a list of dictionaries
+    with ``year``, ``week`` and ``avg_ft`` keys, in ascending order of date.
+    '''
+    weekly = []
+    for week_start, count, total in self.weekly:
+      iso_year, iso_week, _ = week_start.isocalendar()
+      weekly.append({'year': iso_year, 'week': iso_week, 'avg_ft': total / count})
+    return weekly
+
+  def day_of_week_averages(self) -> dict:
+    '''
+    The foot traffic average for each day of the week, keyed by Django weekday
+    (1 = Sunday, 7 = Saturday).
+    '''
+    return {weekday: total / count for weekday, count, total, _ in self.day_of_week}
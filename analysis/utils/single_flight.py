@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .instrumentation import SINGLE_FLIGHT_CALLS
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class _Call:
+  '''
+  A computation in progress in this process, which other threads wait on.
+  '''
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class SingleFlight:
+  '''
+  Coalesces concurrent identical computations. Callers with the same key wait
+  for the one computation in flight, instead of each computing the same
+  result: threads of this process wait on it directly, and other processes
+  wait on a lock in the shared cache and read the result it leaves there.
+  '''
+
+  def __init__(self, name: str):
+    '''
+    :param name: The name of the computations, which namespaces their keys and
+                 labels their metrics
+    '''
+    self.name = name
+    self.calls = {}
+    self.lock = threading.Lock()
+
+  def do(self, key: str, fn) -> tuple:
+    '''
+    Compute a key's result, or wait for the identical computation in flight.
+
+    :param key: The key identical computations share
+    :param fn: The function computing the result, called without arguments.
+               The result must be picklable to be shared across processes.
+    :return: A tuple of the result, and whether it was computed by another
+             caller
+    :raises: The exception raised by fn, also in the callers waiting on it in
+             this process
+    '''
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = _Call()
+
+    if not leader:
+      # The leader's stages have timeouts of their own, so this only bounds a
+      # stuck leader
+      if call.done.wait(timeout=settings.SINGLE_FLIGHT_LOCK_TIMEOUT):
+        SINGLE_FLIGHT_CALLS.inc(name=self.name, result='joined')
+        if call.error is not None:
+          raise call.error
+        return call.result, True
+      logger.warning(f"Gave up waiting for the {self.name} of {key}")
+      SINGLE_FLIGHT_CALLS.inc(name=self.name, result='timeout')
+      return fn(), False
+
+    try:
+      call.result, shared = self._lead(key, fn)
+      return call.result, shared
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+
+  def _lead(self, key: str, fn) -> tuple:
+    '''
+    Compute a key's result in this process, unless another process holds the
+    key's lock in the shared cache, in which case wait for its result.
+    '''
+    cache = caches[settings.SHARED_CACHE_ALIAS]
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    lock_key = f"single-flight:{self.name}:lock:{digest}"
+    result_key = f"single-flight:{self.name}:result:{digest}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_LOCK_TIMEOUT
+
+    while not cache.add(lock_key, token, timeout=settings.SINGLE_FLIGHT_LOCK_TIMEOUT):
+      # Another process holds the lock
+      time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+      result = cache.get(result_key, _MISSING)
+      if result is not _MISSING:
+        SINGLE_FLIGHT_CALLS.inc(name=self.name, result='shared')
+        return result, True
+      if time.monotonic() > deadline:
+        logger.warning(f"Gave up waiting for another process's {self.name} of {key}")
+        SINGLE_FLIGHT_CALLS.inc(name=self.name, result='timeout')
+        return fn(), False
+
+    SINGLE_FLIGHT_CALLS.inc(name=self.name, result='computed')
+    # So the processes waiting on the lock get this computation's result
+    cache.delete(result_key)
+    try:
+      result = fn()
+      # Kept briefly, only for the processes waiting on the lock
+      cache.set(result_key, result, timeout=settings.SINGLE_FLIGHT_RESULT_TIMEOUT)
+      return result, False
+    finally:
+      # Unless it expired and another process holds it now
+      if cache.get(lock_key) == token:
+        cache.delete(lock_key)
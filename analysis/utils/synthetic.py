@@ -0,0 +1,150 @@
+import csv
+import datetime
+import gzip
+
+import numpy as np
+
+# The columns load_csv_data reads, in the order of the real exports
+CSV_COLUMNS = ['day', 'id', 'name', 'ft', 'state', 'city', 'formatted_address',
+               'lon', 'lat']
+
+NAME_PREFIXES = [
+    'Skyview', 'Dolphin', 'Riverside', 'Lakeside', 'Northgate', 'Southpoint',
+    'Westfield', 'Eastland', 'Sunset', 'Harbor', 'Oak Ridge', 'Pine Hills',
+    'Cedar Creek', 'Maple Grove', 'Willow Bend', 'Stonebriar', 'Crystal',
+    'Golden Gate', 'Meadowbrook', 'Fox River', 'Briarwood', 'Cherry Hill',
+    'Valley View', 'Park Meadows', 'Bay Street', 'Town Center', 'Grand Oaks',
+    'Silver Lake', 'Highland', 'Canyon Ridge',
+]
+NAME_SUFFIXES = [
+    'Mall', 'Plaza', 'Galleria', 'Square', 'Commons', 'Crossing',
+    'Marketplace', 'Outlets', 'Promenade', 'Shopping Center',
+]
+# City, state, latitude and longitude
+CITIES = [
+    ('Miami', 'FL', 25.76, -80.19), ('Satellite Beach', 'FL', 28.17, -80.6),
+    ('Orlando', 'FL', 28.54, -81.38), ('Austin', 'TX', 30.27, -97.74),
+    ('Dallas', 'TX', 32.78, -96.8), ('Houston', 'TX', 29.76, -95.37),
+    ('Bloomington', 'MN', 44.84, -93.3), ('Minneapolis', 'MN', 44.98, -93.27),
+    ('Chicago', 'IL', 41.88, -87.63), ('Columbus', 'OH', 39.96, -83.0),
+    ('Atlanta', 'GA', 33.75, -84.39), ('Charlotte', 'NC', 35.23, -80.84),
+    ('Nashville', 'TN', 36.16, -86.78), ('Denver', 'CO', 39.74, -104.99),
+    ('Phoenix', 'AZ', 33.45, -112.07), ('Las Vegas', 'NV', 36.17, -115.14),
+    ('Los Angeles', 'CA', 34.05, -118.24), ('San Diego', 'CA', 32.72, -117.16),
+    ('San Jose', 'CA', 37.34, -121.89), ('Seattle', 'WA', 47.61, -122.33),
+    ('Portland', 'OR', 45.52, -122.68), ('Boston', 'MA', 42.36, -71.06),
+    ('Newark', 'NJ', 40.74, -74.17), ('Philadelphia', 'PA', 39.95, -75.17),
+]
+# Foot traffic relative to the center's average, Monday to Sunday
+WEEKDAY_FACTORS = np.array([0.85, 0.8, 0.82, 0.88, 1.05, 1.4, 1.2])
+# How much injected anomalies scale a day's foot traffic
+ANOMALY_FACTORS = np.array([0.15, 0.35, 2.2, 3.0])
+
+
+def generate_centers(count: int, rng: np.random.Generator) -> list:
+  '''
+  Generate shopping centers with realistic names and locations. Names repeat
+  across cities once the combinations run out, like real chains do.
+
+  :param count: The number of centers
+  :param rng: The random number generator
+  :return: A list of dictionaries with the ShoppingCenter CSV columns
+  '''
+  names = [f"{prefix} {suffix}" for prefix in NAME_PREFIXES for suffix in NAME_SUFFIXES]
+  rng.shuffle(names)
+  centers = []
+  used = set()
+  for i in range(count):
+    name = names[i % len(names)]
+    city, state, lat, lon = CITIES[rng.integers(len(CITIES))]
+    while (name, city) in used:
+      if all((name, other[0]) in used for other in CITIES):
+        name = f"{name} {i}"
+      else:
+        city, state, lat, lon = CITIES[rng.integers(len(CITIES))]
+    used.add((name, city))
+    centers.append({
+        'id': f"syn-{i:06d}",
+        'name': name,
+        'state': state,
+        'city': city,
+        'formatted_address': f"{rng.integers(1, 9999)} {name} Blvd, {city}, {state}",
+        'lon': round(lon + rng.normal(0, 0.1), 5),
+        'lat': round(lat + rng.normal(0, 0.1), 5),
+    })
+  return centers
+
+
+def generate_traffic(days: int, rng: np.random.Generator,
+                     start: datetime.date = datetime.date(2022, 1, 1),
+                     anomaly_rate: float = 0.01, missing_rate: float = 0.0) -> tuple:
+  '''
+  Generate the daily foot traffic of one shopping center, with a day-of-week
+  pattern, yearly seasonality peaking in December, a linear trend, noise and
+  injected anomalies.
+
+  :param days: The number of consecutive days
+  :param rng: The random number generator
+  :param start: The first day
+  :param anomaly_rate: The share of days that are anomalies
+  :param missing_rate: The share of days without a foot traffic value
+  :return: A tuple of the days (datetime64[D]), the foot traffic (float, NaN
+           when missing) and a boolean mask of the injected anomalies
+  '''
+  day_array = np.datetime64(start, 'D') + np.arange(days)
+  day_of_year = (day_array - day_array.astype('datetime64[Y]')).astype(np.int64)
+  # 1970-01-01 was a Thursday
+  weekday = (day_array.astype(np.int64) + 3) % 7
+
+  base = rng.lognormal(mean=8, sigma=0.6)
+  weekday_factors = WEEKDAY_FACTORS * rng.normal(1, 0.05, size=7)
+  seasonality = 1 + rng.uniform(0.05, 0.25) * np.cos(
+      2 * np.pi * (day_of_year - 350) / 365.25)
+  trend = 1 + rng.normal(0, 0.1) * np.arange(days) / 365.25
+  noise = rng.normal(1, 0.06, size=days)
+  ft = base * weekday_factors[weekday] * seasonality * np.clip(trend, 0.2, None) * noise
+
+  anomalies = rng.random(days) < anomaly_rate
+  ft[anomalies] *= rng.choice(ANOMALY_FACTORS, size=anomalies.sum())
+  ft = np.round(np.clip(ft, 0, None))
+  ft[rng.random(days) < missing_rate] = np.nan
+  return day_array, ft, anomalies
+
+
+def write_synthetic_csv(path: str, centers: int, days: int, seed: int = 0,
+                        start: datetime.date = datetime.date(2022, 1, 1),
+                        anomaly_rate: float = 0.01, missing_rate: float = 0.0) -> dict:
+  '''
+  Write synthetic foot traffic in the CSV format load_csv_data reads.
+
+  :param path: The file to write, gzipped if it ends with .gz
+  :param centers: The number of shopping centers
+  :param days: The number of days of foot traffic of each center
+  :param seed: The random seed, so the same arguments write the same file
+  :param start: The first day
+  :param anomaly_rate: The share of days that are anomalies
+  :param missing_rate: The share of days without a foot traffic value
+  :return: A dictionary with the generated ``centers`` and ``rows`` count, and
+           the ``anomalies`` as (center id, ISO date) tuples
+  '''
+  rng = np.random.default_rng(seed)
+  center_rows = generate_centers(centers, rng)
+  rows = 0
+  anomalies = []
+  opener = gzip.open if path.endswith('.gz') else open
+  with opener(path, 'wt', newline='') as file:
+    writer = csv.writer(file)
+    writer.writerow(CSV_COLUMNS)
+    for center in center_rows:
+      day_array, ft, anomaly_mask = generate_traffic(
+          days, rng, start, anomaly_rate, missing_rate)
+      day_strings = day_array.astype(str)
+      ft_strings = ['' if np.isnan(value) else str(int(value)) for value in ft]
+      writer.writerows(
+          [day, center['id'], center['name'], value, center['state'],
+           center['city'], center['formatted_address'], center['lon'],
+           center['lat']]
+          for day, value in zip(day_strings, ft_strings))
+      rows += days
+      anomalies.extend((center['id'], day) for day in day_strings[anomaly_mask])
+  return {'centers': center_rows, 'rows': rows, 'anomalies': anomalies}
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from .instrumentation import CACHE_REQUESTS
+
+_MISSING = object()
+
+
+class LRUCache:
+  '''
+  A thread-safe, size-bounded in-process cache that evicts the least recently
+  used entries, with an optional expiry per entry.
+  '''
+
+  def __init__(self, max_entries: int, timeout: float = None):
+    '''
+    :param max_entries: The most entries kept
+    :param timeout: The default seconds an entry is kept, or None to keep it
+                    until it is evicted
+    '''
+    self.max_entries = max_entries
+    self.timeout = timeout
+    # Keys to (expiry time or None, value), least recently used first
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key, _MISSING)
+      if entry is _MISSING:
+        return default
+      expires_at, value = entry
+      if expires_at is not None and expires_at <= time.monotonic():
+        del self.entries[key]
+        return default
+      self.entries.move_to_end(key)
+      return value
+
+  def set(self, key, value, timeout: float = None) -> None:
+    timeout = self.timeout if timeout is None else timeout
+    expires_at = None if timeout is None else time.monotonic() + timeout
+    with self.lock:
+      self.entries[key] = (expires_at, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def delete(self, key) -> None:
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self) -> None:
+    with self.lock:
+      self.entries.clear()
+
+
+class TieredCache(BaseCache):
+  '''
+  A Django cache backend that keeps the most recently used entries of a
+  shared cache (L2), like a database or file cache every worker reads, in an
+  in-process LRU cache (L1). Reads hit L1 without a round trip, and what any
+  worker writes is read by the others from L2.
+
+  Entries only leave L1 when they are evicted or expire after L1_TIMEOUT
+  seconds, so another worker's delete or overwrite is seen by this one after
+  at most that long. Keys that include a version of the data they were
+  derived from are never stale.
+
+  LOCATION is the alias of the L2 cache. OPTIONS may set L1_MAX_ENTRIES and
+  L1_TIMEOUT.
+  '''
+
+  def __init__(self, location: str, params: dict):
+    super().__init__(params)
+    options = params.get('OPTIONS', {})
+    self.l2_alias = location
+    self.l1 = LRUCache(options.get('L1_MAX_ENTRIES', 1000), options.get('L1_TIMEOUT', 300))
+
+  @property
+  def l2(self) -> BaseCache:
+    return caches[self.l2_alias]
+
+  def _l1_timeout(self, timeout) -> float | None:
+    if timeout is DEFAULT_TIMEOUT:
+      timeout = self.default_timeout
+    if timeout is None:
+      return self.l1.timeout
+    return timeout if self.l1.timeout is None else min(timeout, self.l1.timeout)
+
+  def _count(self, result: str, n: int = 1) -> None:
+    if n:
+      CACHE_REQUESTS.inc(n, cache=self.l2_alias, result=result)
+
+  def get(self, key, default=None, version=None):
+    l1_key = self.make_and_validate_key(key, version=version)
+    value = self.l1.get(l1_key, _MISSING)
+    if value is not _MISSING:
+      self._count('l1_hit')
+      return value
+    value = self.l2.get(key, _MISSING, version=version)
+    if value is _MISSING:
+      self._count('miss')
+      return default
+    self._count('l2_hit')
+    self.l1.set(l1_key, value)
+    return value
+
+  def get_many(self, keys, version=None) -> dict:
+    found = {}
+    missing = []
+    for key in keys:
+      value = self.l1.get(self.make_and_validate_key(key, version=version), _MISSING)
+      if value is _MISSING:
+        missing.append(key)
+      else:
+        found[key] = value
+    self._count('l1_hit', len(found))
+    if missing:
+      # One round trip for every key L1 does not have
+      from_l2 = self.l2.get_many(missing, version=version)
+      for key, value in from_l2.items():
+        self.l1.set(self.make_and_validate_key(key, version=version), value)
+      found.update(from_l2)
+      self._count('l2_hit', len(from_l2))
+      self._count('miss', len(missing) - len(from_l2))
+    return found
+
+  def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None) -> None:
+    l1_key = self.make_and_validate_key(key, version=version)
+    self.l2.set(key, value, timeout=timeout, version=version)
+    if timeout is not None and timeout is not DEFAULT_TIMEOUT and timeout <= 0:
+      self.l1.delete(l1_key)
+    else:
+      self.l1.set(l1_key, value, self._l1_timeout(timeout))
+
+  def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+    if not self.l2.add(key, value, timeout=timeout, version=version):
+      return False
+    self.l1.set(self.make_and_validate_key(key, version=version), value,
+                self._l1_timeout(timeout))
+    return True
+
+  def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+    return self.l2.touch(key, timeout=timeout, version=version)
+
+  def delete(self, key, version=None) -> bool:
+    self.l1.delete(self.make_and_validate_key(key, version=version))
+    return self.l2.delete(key, version=version)
+
+  def has_key(self, key, version=None) -> bool:
+    if self.l1.get(self.make_and_validate_key(key, version=version), _MISSING) is not _MISSING:
+      return True
+    return self.l2.has_key(key, version=version)
+
+  def incr(self, key, delta: int = 1, version=None) -> int:
+    self.l1.delete(self.make_and_validate_key(key, version=version))
+    return self.l2.incr(key, delta, version=version)
+
+  def clear(self) -> None:
+    self.l1.clear()
+    self.l2.clear()
+
+  def close(self, **kwargs) -> None:
+    self.l2.close(**kwargs)
@@ -153,6 +153,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'DEBUG',
         },
+        'analysis.pipeline': {
+            'handlers': ['console'],
+            'level': 'DEBUG',
+        },
     },
 }
 
@@ -160,7 +164,58 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
+    },
+    # LLM responses, shared by every worker and kept across restarts, with the
+    # most recently used ones also kept in each worker. Create the tables of
+    # the database caches with `python manage.py createcachetable`.
+    'llm': {
+        'BACKEND': 'analysis.utils.tiered_cache.TieredCache',
+        'LOCATION': 'llm_shared',
+        'TIMEOUT': 60 * 60 * 24 * 7,
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 2000,
+            'L1_TIMEOUT': 60 * 10,
+        },
+    },
+    'llm_shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'llm_response_cache',
+        'TIMEOUT': 60 * 60 * 24 * 7,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+            'CULL_FREQUENCY': 4,
+        },
+    },
+    # What the pipeline derives from the data before prompting, like resolved
+    # center names and each center's statistics, keyed by the data version
+    'analysis': {
+        'BACKEND': 'analysis.utils.tiered_cache.TieredCache',
+        'LOCATION': 'analysis_shared',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1000,
+            'L1_TIMEOUT': 60 * 10,
+        },
+    },
+    'analysis_shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'analysis_cache',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+            'CULL_FREQUENCY': 4,
+        },
+    },
+    # Short-lived state every worker needs to agree on, like the locks of the
+    # analyses in flight
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'shared_cache',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
 }
 
 
@@ -184,3 +239,142 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 LLM_TEMP = 0
 MIN_RATIO = 60
+
+# Cache alias LLM responses are stored in. With LLM_TEMP = 0 the responses are
+# effectively deterministic, so identical prompts on identical data reuse them.
+LLM_CACHE_ALIAS = 'llm'
+# Cache alias the resolved centers and the statistics prompted with are
+# stored in
+ANALYSIS_CACHE_ALIAS = 'analysis'
+SHARED_CACHE_ALIAS = 'shared'
+
+# Shopping center names scored by the resolver when no city narrows the search,
+# chosen by the number of trigrams they share with the extracted name
+RESOLVER_MAX_CANDIDATES = 256
+# Seconds each worker keeps the data version before reading it again, so its
+# center indexes and the cache keys derived from the data see newly loaded
+# data within this long
+RESOLVER_REFRESH_INTERVAL = 30
+# Minimum score (0-100) of a local match of the query against the known center
+# and city names for it to be used instead of asking the LLM to extract them
+FAST_PATH_MIN_SCORE = 90
+
+# Maximum tokens of raw foot traffic data in the trend analysis prompt, by
+# LLMChoice value. Longer series are averaged by week or month to fit.
+PROMPT_DATA_TOKEN_BUDGETS = {
+    'chatgpt3.5': 4000,
+    'chatgpt4.5': 8000,
+    'claude2': 8000,
+    'claude3_opus': 8000,
+    'claude3_sonnet': 8000,
+    'claude3_haiku': 8000,
+}
+PROMPT_DATA_DEFAULT_TOKEN_BUDGET = 4000
+
+# How the days and weeks given to the anomaly detection stage are found:
+# 'seasonal' compares each day to the ANOMALY_WINDOW days before it after
+# removing the center's day-of-week pattern, 'rolling' compares it to the days
+# before it as they are, 'mad' to the median and median absolute deviation of
+# the whole series, and 'zscore' to the mean and standard deviation of the
+# whole series. Weeks are compared to the ANOMALY_WEEKLY_WINDOW weeks before
+# them, except with 'mad' and 'zscore'.
+ANOMALY_METHOD = 'seasonal'
+ANOMALY_WINDOW = 28
+ANOMALY_WEEKLY_WINDOW = 8
+# Score (in standard deviations) above which a day or week is an anomaly
+ANOMALY_THRESHOLD = 3.5
+# Most anomalous days, and weeks, given to the anomaly detection stage
+ANOMALY_MAX_REPORTED = 20
+
+# Days of recent foot traffic that queries comparing shopping centers compare,
+# and whose growth is measured against the same days a year earlier
+COMPARISON_WINDOW = 90
+# Centers listed when ranking the centers of a state or city, unless the query
+# asks for a number ("top 5"), and the most ever listed
+COMPARISON_DEFAULT_LIMIT = 10
+COMPARISON_MAX_CENTERS = 50
+# Miles around a center whose neighbors are compared ("centers near X"),
+# unless the query gives a distance
+GEO_DEFAULT_RADIUS_MILES = 10
+
+# Items per page of the JSON API's lists, unless the request asks for a
+# page_size, and the largest page_size it may ask for
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# Concurrent analyses of the same center with the same model and data share
+# one computation, coordinated across processes by a lock in the shared
+# cache. Seconds the lock is held at most (keep it above ANALYSIS_TIMEOUT),
+# seconds the result is kept for the processes waiting on it, and seconds
+# between their checks.
+SINGLE_FLIGHT_LOCK_TIMEOUT = 180
+SINGLE_FLIGHT_RESULT_TIMEOUT = 30
+SINGLE_FLIGHT_POLL_INTERVAL = 0.25
+
+# Seconds an analysis job may run before it is presumed lost with its worker
+# and requeued, and the times a job is started before it is failed instead.
+# Keep it well above ANALYSIS_TIMEOUT, plus the time to claim and save the
+# job, so a slow job is not run twice.
+ANALYSIS_JOB_TIMEOUT = 450
+ANALYSIS_JOB_MAX_ATTEMPTS = 3
+# Jobs each run_analysis_worker process runs concurrently, and the seconds an
+# idle worker thread waits before checking the queue again
+ANALYSIS_WORKER_THREADS = 4
+ANALYSIS_WORKER_POLL_INTERVAL = 1.0
+
+# Directory the export_foot_traffic command writes columnar snapshots of the
+# foot traffic to. The analyses scan the current snapshot instead of the
+# database until data is loaded again, and read the database when there is
+# none.
+FOOT_TRAFFIC_SNAPSHOT_DIR = os.getenv(
+    'FOOT_TRAFFIC_SNAPSHOT_DIR', os.path.join(BASE_DIR, 'snapshots'))
+
+# Rendered insights whose HTML each process keeps, so displaying a cached
+# response again does not convert its Markdown again
+MARKDOWN_CACHE_SIZE = 256
+
+# Seconds an individual LLM stage (filtering, trend analysis, anomaly
+# detection, insights, comparison) may take, retries included, before the
+# analysis gives up on it and its requests to the provider are abandoned.
+LLM_STAGE_TIMEOUT = 75
+# Seconds a whole analysis may take. Each stage gets LLM_STAGE_TIMEOUT or what
+# is left of this, whichever is less. Keep it under the gunicorn --timeout in
+# the Procfile, so a slow analysis is answered with an error instead of its
+# worker being killed.
+ANALYSIS_TIMEOUT = 165
+# Threads per process available for running LLM stages concurrently
+LLM_STAGE_MAX_WORKERS = 8
+# Threads per process running the blocking work of the async views: whole
+# analyses for the form, which wait on their LLM stages, and the database
+# queries of streamed analyses. Each thread may hold a database connection.
+ANALYSIS_BLOCKING_MAX_WORKERS = 32
+
+# The model that runs each LLM stage of the analysis: 'selected' for the model
+# chosen in the form, 'fast' for the fastest model of the chosen model's
+# provider (LLM_FAST_MODELS), or an LLMChoice value. Extracting names and
+# summarizing the statistics do not need a large model, so only the insights
+# the user reads use the chosen one.
+LLM_STAGE_MODELS = {
+    'filtering': 'fast',
+    'trend': 'fast',
+    'anomaly': 'fast',
+    'insights': 'selected',
+    'comparison': 'selected',
+}
+LLM_FAST_MODELS = {
+    'openai': 'chatgpt3.5',
+    'anthropic': 'claude3_haiku',
+}
+
+# Requests and prompt tokens per minute each process may send to a provider.
+# Every process enforces them on its own, so with several web workers or an
+# analyze_centers run alongside them, divide the account's limits between them.
+LLM_PROVIDER_RATE_LIMITS = {
+    'openai': {'requests_per_minute': 500, 'tokens_per_minute': 300000},
+    'anthropic': {'requests_per_minute': 50, 'tokens_per_minute': 50000},
+}
+# Times a request that failed with a rate limit, overload or connection error
+# is retried, with jittered exponential backoff
+LLM_MAX_RETRIES = 4
+# Open HTTP connections kept per model client
+LLM_MAX_CONNECTIONS = 20
@@ -19,9 +19,18 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 
-from analysis.views import analyze_view
+from analysis import api
+from analysis.views import analyze_stream_view, analyze_view, metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('analysis/', analyze_view, name='analyze'),
+    path('analysis/stream/', analyze_stream_view, name='analyze_stream'),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/centers/', api.centers_view, name='api_centers'),
+    path('api/centers/<str:center_id>/series', api.center_series_view,
+         name='api_center_series'),
+    path('api/analyses/', api.analyses_view, name='api_analyses'),
+    path('api/jobs/', api.jobs_view, name='api_jobs'),
+    path('api/jobs/<uuid:job_id>/', api.job_view, name='api_job'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)